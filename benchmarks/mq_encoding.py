@@ -0,0 +1,113 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of the per-message cost of encoding, logging and publishing MQ
+responses. The `legacy` path declares the reply queue, base64-encodes the
+response and logs it in full for every message; the other paths use the
+connector's reply-queue declaration cache, summarized logging, and each
+supported response encoding. Bytes and CPU time per message are reported for
+a single user with many tokens and for a page of listed users.
+
+Usage: `python benchmarks/mq_encoding.py [--messages N] [--log-level LEVEL]`
+"""
+
+import argparse
+
+from time import process_time, time
+
+from neon_data_models.models.api.jwt import HanaToken
+from neon_data_models.models.user import User
+from neon_mq_connector.utils.network_utils import dict_to_b64
+from ovos_utils.log import LOG
+
+from neon_users_service.mq_connector import (NeonUsersConnector,
+                                             _encode_response)
+
+
+class _FakeChannel:
+    def __init__(self):
+        self.declares = 0
+
+    def queue_declare(self, queue: str):
+        self.declares += 1
+
+
+def _get_responses() -> dict:
+    now = round(time())
+    user = User(username="bench_user", password_hash="bench", tokens=[
+        HanaToken(exp=now, iat=now, jti=f"token_{i}.refresh",
+                  client_id="bench", roles=["users 10", "llm 10"],
+                  purpose="refresh") for i in range(50)])
+    users = [User(username=f"user_{i}", password_hash=None)
+             for i in range(100)]
+    return {"user": {"success": True, "user": user.model_dump(),
+                     "message_id": "bench"},
+            "list": {"success": True,
+                     "users": [u.model_dump() for u in users],
+                     "next_token": users[-1].user_id, "message_id": "bench"}}
+
+
+def run(num_messages: int = 1000) -> dict:
+    connector = NeonUsersConnector({
+        "MQ": {"server": "localhost",
+               "users": {"neon_users_service": {"user": "bench",
+                                                "password": "bench"}}},
+        "neon_users_service": {"module": "sqlite",
+                               "sqlite": {"db_path": ":memory:"}}})
+    results = dict()
+    for name, response in _get_responses().items():
+        channel = _FakeChannel()
+        start = process_time()
+        for _ in range(num_messages):
+            channel.queue_declare(queue="neon_users_output")
+            data = dict_to_b64(response)
+            LOG.info(f"Sent response to queue neon_users_output: {response}")
+        results[f"{name}_legacy"] = {
+            "bytes": len(data),
+            "cpu_us": (process_time() - start) / num_messages * 1e6,
+            "declares": channel.declares / num_messages}
+        for encoding in ("b64", "json", "zlib"):
+            channel = _FakeChannel()
+            start = process_time()
+            for _ in range(num_messages):
+                connector._declare_queue(channel, "neon_users_output")
+                data, _ = _encode_response(response, encoding)
+                connector._log_response("neon_users_output", response,
+                                        len(data))
+            results[f"{name}_{encoding}"] = {
+                "bytes": len(data),
+                "cpu_us": (process_time() - start) / num_messages * 1e6,
+                "declares": channel.declares / num_messages}
+    connector.service.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--log-level", default="WARNING",
+                        help="Log level to run with. Logged messages are "
+                             "written to stdout.")
+    args = parser.parse_args()
+    LOG.set_level(args.log_level)
+    for name, result in run(args.messages).items():
+        print(f"{name}: bytes={result['bytes']}, "
+              f"cpu_us={result['cpu_us']:.1f}, "
+              f"declares={result['declares']:.3f}")
+
+
+if __name__ == "__main__":
+    main()
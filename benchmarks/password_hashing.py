@@ -0,0 +1,77 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of `PasswordHasher` throughput for each configured scheme and cost,
+reported as hashes per second on one thread and on a pool of threads, along
+with the latency of a single hash. Use this to choose a cost that fits the
+authentication latency budget.
+
+Usage: `python benchmarks/password_hashing.py [--hashes N] [--workers N]`
+"""
+
+import argparse
+
+from time import perf_counter
+
+from neon_users_service.hashing import PasswordHasher
+
+CONFIGURATIONS = {
+    "sha256": {"scheme": "sha256"},
+    "pbkdf2_sha256-100k": {"scheme": "pbkdf2_sha256", "iterations": 100000},
+    "pbkdf2_sha256-600k": {"scheme": "pbkdf2_sha256", "iterations": 600000},
+    "scrypt-n14": {"scheme": "scrypt", "n": 2 ** 14, "r": 8, "p": 1},
+    "scrypt-n15": {"scheme": "scrypt", "n": 2 ** 15, "r": 8, "p": 1},
+}
+
+
+def _hashes_per_second(hasher: PasswordHasher, num_hashes: int) -> float:
+    passwords = [f"password_{i}" for i in range(num_hashes)]
+    start = perf_counter()
+    hasher.hash_many(passwords)
+    return num_hashes / (perf_counter() - start)
+
+
+def run(num_hashes: int = 20, workers: int = 4) -> dict:
+    results = dict()
+    for name, config in CONFIGURATIONS.items():
+        # Hash fast schemes enough times for a stable measurement
+        count = num_hashes * 1000 if config["scheme"] == "sha256" \
+            else num_hashes
+        serial = PasswordHasher(**config)
+        pooled = PasswordHasher(**config, workers=workers)
+        serial_rate = _hashes_per_second(serial, count)
+        results[name] = {
+            "hashes_per_s": serial_rate,
+            "pooled_hashes_per_s": _hashes_per_second(pooled, count),
+            "latency_ms": 1000 / serial_rate,
+        }
+        serial.shutdown()
+        pooled.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hashes", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    for name, result in run(args.hashes, args.workers).items():
+        print(f"{name}: " + ", ".join(f"{key}={value:.2f}"
+                                      for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
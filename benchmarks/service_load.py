@@ -0,0 +1,294 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Load-generation benchmark for `NeonUsersService`. Seeds a database with users,
+then runs a random mix of read, auth, and write operations from concurrent
+threads, either directly against the service or through the MQ request path
+of `NeonUsersConnector` with an in-process channel. Latency percentiles and
+throughput are reported per backend and path as JSON so that results can be
+compared across releases.
+
+Operations:
+- read: Look up a redacted user (over MQ, as an authenticated admin)
+- auth: Authenticate a user with a password
+- write: Patch a user's preferences
+
+Usage: `python benchmarks/service_load.py [--users N] [--ops N]
+    [--concurrency N] [--mix read=70,auth=20,write=10]
+    [--backends sqlite-file,sqlite-memory,mongomock] [--paths service,mq]
+    [--output results.json]`
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+from unittest.mock import Mock, patch
+
+from neon_data_models.enum import AccessRoles
+from neon_data_models.models.user import User
+from neon_mq_connector.utils.network_utils import b64_to_dict, dict_to_b64
+from ovos_utils.log import LOG
+
+BACKENDS = ("sqlite-file", "sqlite-memory", "mongomock")
+PATHS = ("service", "mq")
+OPERATIONS = ("read", "auth", "write")
+
+
+class _FakeChannel:
+    """
+    Stand-in for a pika channel that keeps published responses so that failed
+    requests can be counted after a run.
+    """
+    def __init__(self):
+        self.published = []
+
+    def queue_declare(self, queue: str):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append(body)
+
+    def count_failures(self) -> int:
+        """
+        Count unsuccessful responses published since the last call.
+        """
+        published, self.published = self.published, []
+        return sum(not b64_to_dict(body)["success"] for body in published)
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+
+def _get_service_config(backend: str, tmp_dir: str) -> dict:
+    if backend == "sqlite-file":
+        return {"module": "sqlite",
+                "sqlite": {"db_path": join(tmp_dir, "bench.sqlite"),
+                           "pool_size": 4}}
+    if backend == "sqlite-memory":
+        return {"module": "sqlite", "sqlite": {"db_path": ":memory:"}}
+    if backend == "mongomock":
+        return {"module": "mongodb", "mongodb": {"db_host": "localhost"}}
+    raise ValueError(f"Invalid backend: {backend}")
+
+
+def _percentile(latencies: List[float], q: float) -> float:
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def _summarize(latencies: List[float], elapsed: float, errors: int) -> dict:
+    latencies = sorted(latencies)
+    return {"ops": len(latencies),
+            "errors": errors,
+            "ops_per_s": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": _percentile(latencies, 0.5) * 1000,
+            "p95_ms": _percentile(latencies, 0.95) * 1000,
+            "p99_ms": _percentile(latencies, 0.99) * 1000}
+
+
+class _Workload:
+    """
+    Builds the callable for each operation against a seeded service.
+    """
+    def __init__(self, connector, users: List[User], admin: User):
+        self.connector = connector
+        self.service = connector.service
+        self.users = users
+        self.admin = admin
+        self.channel = _FakeChannel()
+        self._delivery_tag = Mock()
+
+    def _handle(self, request: dict):
+        body = dict_to_b64(request)
+        self.connector.handle_request(self.channel, self._delivery_tag,
+                                      None, body)
+
+    def get_operation(self, path: str, operation: str,
+                      rng: random.Random) -> Callable[[], object]:
+        idx = rng.randrange(len(self.users))
+        user = self.users[idx]
+        password = f"password_{idx}"
+        if path == "service":
+            if operation == "read":
+                return lambda: self.service.read_unauthenticated_user(
+                    user.username)
+            if operation == "auth":
+                return lambda: self.service.read_authenticated_user(
+                    user.username, password)
+            return lambda: self.service.patch_user(
+                user.user_id, {"klat.preferences": {"seed": rng.random()}})
+        if operation == "read":
+            request = {"operation": "read", "user_spec": user.username,
+                       "auth_user_spec": self.admin.username,
+                       "password": "admin"}
+        elif operation == "auth":
+            request = {"operation": "read", "user_spec": user.username,
+                       "auth_user_spec": user.username, "password": password}
+        else:
+            request = {"operation": "patch", "user_id": user.user_id,
+                       "auth_username": user.username,
+                       "auth_password": password,
+                       "patch": {"klat.preferences": {"seed": rng.random()}}}
+        return lambda: self._handle(request)
+
+
+def _get_connector(service_config: dict):
+    from neon_users_service.mq_connector import NeonUsersConnector
+    mq_config = {"server": "localhost",
+                 "users": {"neon_users_service": {"user": "bench",
+                                                  "password": "bench"}}}
+    return NeonUsersConnector({"MQ": mq_config,
+                               "neon_users_service": service_config})
+
+
+def _seed(service, num_users: int, batch_size: int = 500) -> List[User]:
+    users = []
+    for start in range(0, num_users, batch_size):
+        batch = [User(username=f"user_{i}", password_hash=f"password_{i}")
+                 for i in range(start, min(start + batch_size, num_users))]
+        users.extend(service.create_users(batch))
+    return users
+
+
+def run_backend(backend: str, paths: List[str], mix: Dict[str, int],
+                num_users: int, num_ops: int, concurrency: int,
+                seed: int = 0) -> dict:
+    """
+    Seed a service with `backend` and run the workload on each path.
+    @returns: dict of path to summary, with a breakdown per operation
+    """
+    results = dict()
+    with ExitStack() as stack:
+        tmp_dir = stack.enter_context(TemporaryDirectory())
+        if backend == "mongomock":
+            import mongomock
+            stack.enter_context(patch(
+                "neon_users_service.databases.mongodb.MongoClient",
+                mongomock.MongoClient))
+        connector = _get_connector(_get_service_config(backend, tmp_dir))
+        service = connector.service
+        users = _seed(service, num_users)
+        admin = service.create_user(User(username="admin",
+                                         password_hash="admin"))
+        admin.permissions.users = AccessRoles.ADMIN
+        service.update_user(admin)
+        workload = _Workload(connector, users, admin)
+
+        for path in paths:
+            rng = random.Random(seed)
+            names = rng.choices(list(mix), weights=list(mix.values()),
+                                k=num_ops)
+            operations = [(name, workload.get_operation(path, name, rng))
+                          for name in names]
+            latencies = {name: [] for name in mix}
+            errors = {name: 0 for name in mix}
+
+            def _run_slice(ops: list):
+                for name, operation in ops:
+                    start = perf_counter()
+                    try:
+                        operation()
+                    except Exception:
+                        errors[name] += 1
+                    latencies[name].append(perf_counter() - start)
+
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                list(executor.map(_run_slice, [operations[i::concurrency]
+                                               for i in range(concurrency)]))
+            elapsed = perf_counter() - start
+            # MQ requests respond with an error rather than raising one
+            failures = workload.channel.count_failures()
+            summary = _summarize([latency for values in latencies.values()
+                                  for latency in values], elapsed,
+                                 sum(errors.values()) + failures)
+            summary["operations"] = {
+                name: _summarize(latencies[name], elapsed, errors[name])
+                for name in mix if latencies[name]}
+            results[path] = summary
+        service.shutdown()
+    return results
+
+
+def run(backends: List[str] = BACKENDS, paths: List[str] = PATHS,
+        mix: Optional[Dict[str, int]] = None, num_users: int = 1000,
+        num_ops: int = 5000, concurrency: int = 4, seed: int = 0) -> dict:
+    mix = mix or {"read": 70, "auth": 20, "write": 10}
+    try:
+        package_version = version("neon-users-service")
+    except PackageNotFoundError:
+        package_version = None
+    return {
+        "version": package_version,
+        "python": platform.python_version(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "parameters": {"users": num_users, "ops": num_ops,
+                       "concurrency": concurrency, "mix": mix, "seed": seed},
+        "results": {backend: run_backend(backend, list(paths), mix,
+                                         num_users, num_ops, concurrency,
+                                         seed)
+                    for backend in backends}}
+
+
+def _parse_mix(value: str) -> Dict[str, int]:
+    mix = dict()
+    for item in value.split(","):
+        name, weight = item.split("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Invalid operation: {name}")
+        mix[name] = int(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--mix", type=_parse_mix,
+                        default="read=70,auth=20,write=10")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--paths", default=",".join(PATHS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="File to write JSON results to; defaults to "
+                             "stdout")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    LOG.set_level(args.log_level)
+    results = run(args.backends.split(","), args.paths.split(","), args.mix,
+                  args.users, args.ops, args.concurrency, args.seed)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark comparing SQLite `user_object` codecs: database file size, and the
+throughput of writing and reading users with many tokens and preferences.
+
+Usage: `python benchmarks/sqlite_codecs.py [--users N] [--tokens N]`
+"""
+
+import argparse
+
+from os.path import getsize, join
+from tempfile import TemporaryDirectory
+from time import perf_counter, time
+
+from neon_data_models.models.user import User
+from neon_data_models.models.api.jwt import HanaToken
+from neon_users_service.databases.sqlite import SQLiteUserDatabase, _CODECS
+
+
+def _get_users(num_users: int, num_tokens: int) -> list:
+    now = round(time())
+    users = []
+    for i in range(num_users):
+        user = User(username=f"user_{i}", password_hash="bench", tokens=[
+            HanaToken(exp=now, iat=now, jti=f"token_{i}_{t}.refresh",
+                      client_id="bench", roles=["users 10", "llm 10"],
+                      purpose="refresh") for t in range(num_tokens)])
+        user.klat.preferences = {f"pref_{p}": {"values": list(range(5)),
+                                               "name": f"preference_{p}"}
+                                 for p in range(num_tokens)}
+        users.append(user)
+    return users
+
+
+def run(num_users: int = 1000, num_tokens: int = 20) -> dict:
+    users = _get_users(num_users, num_tokens)
+    results = dict()
+    for codec in _CODECS:
+        with TemporaryDirectory() as tmp_dir:
+            db_path = join(tmp_dir, "bench.sqlite")
+            database = SQLiteUserDatabase(db_path, codec=codec)
+            start = perf_counter()
+            database.create_users(users)
+            write_time = perf_counter() - start
+            start = perf_counter()
+            for user in users:
+                database.read_user_by_id(user.user_id)
+            read_time = perf_counter() - start
+            database.connection.execute("VACUUM")
+            database.shutdown()
+            results[codec] = {"file_kib": getsize(db_path) / 1024,
+                              "writes_per_s": num_users / write_time,
+                              "reads_per_s": num_users / read_time}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tokens", type=int, default=20)
+    args = parser.parse_args()
+    for codec, values in run(args.users, args.tokens).items():
+        print(codec, " ".join(f"{key}: {value:.1f}"
+                              for key, value in values.items()))
+
+
+if __name__ == "__main__":
+    main()
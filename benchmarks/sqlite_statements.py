@@ -0,0 +1,83 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark comparing per-call cost of `read_user_by_id` lookups built with
+interpolated SQL (re-parsed on every call) against bound parameters (served
+from the sqlite3 statement cache).
+
+Usage: `python benchmarks/sqlite_statements.py [--users N] [--reads N]`
+"""
+
+import argparse
+
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from neon_data_models.models.user import User
+from neon_users_service.databases.sqlite import SQLiteUserDatabase
+
+
+def _time_per_call(func, args_list) -> float:
+    start = perf_counter()
+    for args in args_list:
+        func(*args)
+    return (perf_counter() - start) / len(args_list)
+
+
+def run(num_users: int = 1000, num_reads: int = 20000) -> dict:
+    with TemporaryDirectory() as tmp_dir:
+        database = SQLiteUserDatabase(join(tmp_dir, "bench.sqlite"))
+        user_ids = [database.create_user(User(username=f"user_{i}",
+                                              password_hash="bench")).user_id
+                    for i in range(num_users)]
+        lookups = [(user_ids[i % num_users],) for i in range(num_reads)]
+        connection = database.connection
+
+        def interpolated(user_id):
+            connection.execute(f"SELECT user_object FROM users WHERE "
+                               f"user_id = '{user_id}'").fetchall()
+
+        def parameterized(user_id):
+            connection.execute(
+                "SELECT user_object FROM users WHERE user_id = ?",
+                (user_id,)).fetchall()
+
+        results = {
+            "query_interpolated_us": _time_per_call(interpolated,
+                                                    lookups) * 1e6,
+            "query_parameterized_us": _time_per_call(parameterized,
+                                                     lookups) * 1e6,
+            "read_user_by_id_us": _time_per_call(database.read_user_by_id,
+                                                 lookups) * 1e6,
+        }
+        results["parse_savings_us"] = results["query_interpolated_us"] - \
+            results["query_parameterized_us"]
+        database.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--reads", type=int, default=20000)
+    args = parser.parse_args()
+    for key, value in run(args.users, args.reads).items():
+        print(f"{key}: {value:.2f}")
+
+
+if __name__ == "__main__":
+    main()
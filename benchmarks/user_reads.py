@@ -0,0 +1,117 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmark of reading users with large preference and token payloads: CPU time
+per parse of a stored user with `json.loads` compared to `model_validate_json`,
+and peak memory allocated by a redacted read compared to reading the full user
+and redacting it.
+
+Usage: `python benchmarks/user_reads.py [--reads N] [--tokens N]
+    [--log-level LEVEL]`
+"""
+
+import argparse
+import json
+import tracemalloc
+
+from time import process_time, time
+
+from ovos_utils.log import LOG
+from neon_data_models.models.user import User
+from neon_data_models.models.api.jwt import HanaToken
+from neon_users_service.databases.sqlite import SQLiteUserDatabase
+
+
+def _get_user(num_tokens: int) -> User:
+    now = round(time())
+    user = User(username="bench_user", tokens=[
+        HanaToken(exp=now, iat=now, jti=f"token_{i}.refresh",
+                  client_id="bench", roles=["users 10", "llm 10"],
+                  purpose="refresh") for i in range(num_tokens)])
+    user.klat.preferences = {f"pref_{i}": {"values": list(range(5)),
+                                           "name": f"preference_{i}"}
+                             for i in range(300)}
+    user.neon.skills = {f"skill_{i}": {"enabled": True} for i in range(100)}
+    return user
+
+
+def _cpu_per_read(parse, user_object: str, num_reads: int) -> float:
+    # Take the fastest of several runs to reduce noise
+    durations = []
+    for _ in range(3):
+        start = process_time()
+        for _ in range(num_reads):
+            parse(user_object)
+        durations.append((process_time() - start) / num_reads)
+    return min(durations)
+
+
+def _peak_allocation(read) -> int:
+    tracemalloc.start()
+    try:
+        read()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _redacted_read_allocation(user: User) -> dict:
+    database = SQLiteUserDatabase(":memory:")
+    database.create_user(user)
+
+    def _read_and_redact():
+        read = database.read_user(user.username)
+        read.password_hash = None
+        read.tokens = []
+        return read
+
+    results = {"redacted_kib": _peak_allocation(
+        lambda: database.read_redacted_user(user.username)) / 1024,
+        "read_and_redact_kib": _peak_allocation(_read_and_redact) / 1024}
+    database.shutdown()
+    return results
+
+
+def run(num_reads: int = 50, num_tokens: int = 200) -> dict:
+    user = _get_user(num_tokens)
+    user_object = user.model_dump_json()
+    database = SQLiteUserDatabase.__new__(SQLiteUserDatabase)
+    results = {
+        "legacy_ms": _cpu_per_read(lambda data: User(**json.loads(data)),
+                                   user_object, num_reads),
+        "validated_ms": _cpu_per_read(database._parse_user, user_object,
+                                      num_reads)}
+    return {"cpu_per_parse": {key: value * 1000
+                              for key, value in results.items()},
+            "peak_allocation": _redacted_read_allocation(user)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--log-level", default="WARNING",
+                        help="Log level to run with. Logged messages are "
+                             "written to stdout.")
+    args = parser.parse_args()
+    LOG.set_level(args.log_level)
+    for name, values in run(args.reads, args.tokens).items():
+        print(name, " ".join(f"{key}: {value:.3f}"
+                             for key, value in values.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,14 +13,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from neon_users_service.mq_connector import NeonUsersConnector
+import argparse
+
+from typing import Optional
+
 from ovos_utils import wait_for_exit_signal
 from ovos_utils.log import LOG, init_service_logger
 
 init_service_logger("neon-users-service")
 
 
-def main():
+def run_service():
+    from neon_users_service.mq_connector import NeonUsersConnector
     connector = NeonUsersConnector(None)
     LOG.info("Starting Neon Users Service")
     connector.run()
@@ -29,5 +33,105 @@ def main():
     LOG.info("Shut down")
 
 
+def _get_database(config_path: Optional[str]):
+    """
+    Build only the configured database, without the rest of the service (i.e.
+    caches or a metrics exporter), for commands that operate on the database.
+    """
+    from neon_users_service.exceptions import ConfigurationError
+    from neon_users_service.service import init_database
+    if config_path:
+        from ovos_config.models import LocalConf
+        config = LocalConf(config_path).get("neon_users_service")
+        if not config:
+            raise ValueError(f"No `neon_users_service` config in "
+                             f"{config_path}")
+    else:
+        from ovos_config import Configuration
+        config = Configuration().get("neon_users_service", {})
+    database = init_database(config)
+    if not database:
+        raise ConfigurationError(f"`{config.get('module')}` is not a valid "
+                                 f"database module.")
+    return database
+
+
+def export_users(output: str, config_path: Optional[str], batch_size: int):
+    from neon_users_service.transfer import export_users
+    database = _get_database(config_path)
+    try:
+        with open(output, "w", encoding="utf-8") as f:
+            export_users(database, f, batch_size)
+    finally:
+        database.shutdown()
+
+
+def import_users(input_file: str, config_path: Optional[str],
+                 batch_size: int):
+    from neon_users_service.transfer import import_users
+    database = _get_database(config_path)
+    try:
+        with open(input_file, "r", encoding="utf-8") as f:
+            _, failed = import_users(database, f, batch_size)
+    finally:
+        database.shutdown()
+    if failed:
+        LOG.warning(f"{failed} users were not imported")
+
+
+def reencode_users(config_path: Optional[str], codec: Optional[str],
+                   batch_size: int):
+    from neon_users_service.databases.sqlite import SQLiteUserDatabase
+    database = _get_database(config_path)
+    try:
+        if not isinstance(database, SQLiteUserDatabase):
+            raise ValueError("Re-encoding is only supported for SQLite "
+                             "databases")
+        converted = database.reencode(codec, batch_size)
+        LOG.info(f"Re-encoded {converted} users as "
+                 f"{codec or database.codec}")
+    finally:
+        database.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="neon_users_service",
+                                     description="Neon Users Service")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="Run the MQ service (default)")
+    for command, file_arg, file_help in (
+            ("export", "output", "JSON Lines file to write users to"),
+            ("import", "input", "JSON Lines file to read users from")):
+        subparser = subparsers.add_parser(
+            command, help=f"{command.capitalize()} users as JSON Lines")
+        subparser.add_argument(file_arg, help=file_help)
+        subparser.add_argument("--config", default=None,
+                               help="Config file with a `neon_users_service` "
+                                    "section defining the database to use. "
+                                    "Defaults to the service configuration")
+        subparser.add_argument("--batch-size", type=int, default=1000,
+                               help="Number of users per database batch")
+    subparser = subparsers.add_parser(
+        "reencode", help="Convert stored SQLite users to another codec")
+    subparser.add_argument("--codec", default=None,
+                           help="Codec to convert users to. Defaults to the "
+                                "configured `codec`")
+    subparser.add_argument("--config", default=None,
+                           help="Config file with a `neon_users_service` "
+                                "section defining the database to use. "
+                                "Defaults to the service configuration")
+    subparser.add_argument("--batch-size", type=int, default=500,
+                           help="Number of users converted per transaction")
+    args = parser.parse_args()
+    if args.command == "export":
+        export_users(args.output, args.config, args.batch_size)
+    elif args.command == "import":
+        import_users(args.input, args.config, args.batch_size)
+    elif args.command == "reencode":
+        reencode_users(args.config, args.codec, args.batch_size)
+    else:
+        run_service()
+
+
 if __name__ == "__main__":
     main()
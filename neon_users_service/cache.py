@@ -0,0 +1,292 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+
+from collections import OrderedDict
+from copy import copy, deepcopy
+from threading import Event, Lock, RLock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded cache with a per-entry time-to-live. The least
+    recently used entry is evicted when `max_size` is exceeded.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        """
+        @param max_size: Maximum number of entries to keep
+        @param ttl: Seconds an entry remains valid after it is added
+        @param on_evict: Optional callback with the key and value of entries
+            that are removed due to size or age (not explicit `pop` calls)
+        """
+        if max_size < 1:
+            raise ValueError(f"Invalid max_size: {max_size}")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._on_evict = on_evict
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        # Does not check expiration or affect hit/miss counters
+        return key in self._entries
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Get a cached value, or `default` if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expiration, value = entry
+            if expiration < monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                evicted = True
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+        if evicted and self._on_evict:
+            self._on_evict(key, value)
+        return default
+
+    def put(self, key: Hashable, value: Any):
+        """
+        Add or replace a cached value, evicting the least recently used entry
+        if the cache is full.
+        """
+        evicted = None
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                evicted = self._entries.popitem(last=False)
+                self.evictions += 1
+        if evicted and self._on_evict:
+            self._on_evict(evicted[0], evicted[1][1])
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove a cached value if present and return it.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        """
+        Remove all cached values.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Cache counters and current size.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class AuthCache:
+    """
+    Cache of authentication results, keyed by the requested user spec and a
+    digest of the supplied credentials so that plaintext credentials are not
+    kept in memory. Entries are indexed by `user_id` and user spec so that
+    every result for a user can be invalidated when that user changes.
+    """
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0):
+        """
+        @param max_size: Maximum number of authentication results to keep
+        @param ttl: Seconds an authentication result remains valid
+        """
+        self._cache = LRUCache(max_size, ttl, on_evict=self._on_evict)
+        self._keys: Dict[str, Set[Tuple[str, str]]] = dict()
+        # Reentrant, since evictions during `put` update the index
+        self._lock = RLock()
+        # Incremented on every invalidation so that a result read before an
+        # invalidation is not cached after it
+        self.generation = 0
+
+    @staticmethod
+    def get_key(user_spec: str, *credentials: Optional[str]) -> \
+            Tuple[str, str]:
+        """
+        Build the cache key for an authentication request.
+        @param user_spec: username or user_id being authenticated
+        @param credentials: Password and/or token identifier supplied
+        @returns: Tuple of `user_spec` and a digest of `credentials`
+        """
+        digest = hashlib.sha256()
+        for credential in credentials:
+            digest.update(f"{credential or ''}\0".encode("utf-8"))
+        return user_spec, digest.hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Cache counters and current size.
+        """
+        return self._cache.stats
+
+    def get(self, key: Tuple[str, str]) -> Any:
+        """
+        Get a cached authentication result, or `None` if there is no result.
+        """
+        return self._cache.get(key)
+
+    def put(self, key: Tuple[str, str], user_id: str, result: Any,
+            generation: int):
+        """
+        Cache an authentication result for the user with `user_id`, unless
+        the cache was invalidated after `generation` was read.
+        """
+        with self._lock:
+            if generation != self.generation:
+                return
+            for index in {key[0], user_id}:
+                self._keys.setdefault(index, set()).add(key)
+            self._cache.put(key, (user_id, result))
+
+    def invalidate(self, *user_specs: Optional[str]):
+        """
+        Remove all cached results for the users with the given `user_id`s or
+        usernames.
+        """
+        with self._lock:
+            self.generation += 1
+            keys = set()
+            for spec in user_specs:
+                keys.update(self._keys.pop(spec, set()) if spec else set())
+        for key in keys:
+            entry = self._cache.pop(key)
+            if entry:
+                self._on_evict(key, entry)
+
+    def clear(self):
+        """
+        Remove all cached results.
+        """
+        with self._lock:
+            self.generation += 1
+            self._keys.clear()
+            self._cache.clear()
+
+    def _on_evict(self, key: Tuple[str, str], entry: Tuple[str, Any]):
+        with self._lock:
+            for index in {key[0], entry[0]}:
+                keys = self._keys.get(index)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        self._keys.pop(index)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key, so that callers arriving
+    while a call is in progress wait for and share its result instead of
+    making the same call again. Shared results are copied with `copy_result`
+    so that each caller receives an independent object.
+    """
+    def __init__(self, copy_result: Callable[[Any], Any] = deepcopy):
+        """
+        @param copy_result: Function returning an independent copy of a result
+        """
+        self._copy = copy_result
+        self._calls: Dict[Hashable, _Call] = dict()
+        self._lock = Lock()
+        self.calls = 0
+        self.shared = 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Counts of calls made and of callers served by another caller's call.
+        """
+        return {"calls": self.calls, "shared": self.shared,
+                "in_flight": len(self._calls)}
+
+    def do(self, key: Hashable, func: Callable, *args) -> Any:
+        """
+        Call `func(*args)`, or wait for an in-progress call with the same
+        `key` and return a copy of its result. Exceptions are raised to every
+        waiting caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise copy(call.error)
+            return self._copy(call.result)
+        try:
+            call.result = func(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                waiters = call.waiters
+            call.done.set()
+        # Waiters copy the stored result, so the caller gets its own copy
+        return self._copy(call.result) if waiters else call.result
+
+    def forget(self):
+        """
+        Stop sharing in-progress calls with new callers, i.e. after a write
+        that in-progress calls may not reflect. Callers already waiting still
+        receive the result of the call they joined.
+        """
+        with self._lock:
+            self._calls.clear()
@@ -13,13 +13,35 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import re
+
 from abc import ABC, abstractmethod
+from typing import (Callable, Iterator, List, Union, Optional, Dict,
+                    Any, get_args, get_origin)
+
+from pydantic import BaseModel, TypeAdapter
 
 from neon_users_service.exceptions import UserNotFoundError, UserExistsError
 from neon_data_models.models.user import User
 
+try:
+    from types import UnionType
+except ImportError:
+    # `X | Y` annotations are not supported before Python 3.10
+    UnionType = None
+
+# Dotted path to a (possibly nested) `User` field, i.e. `permissions.users`
+_FIELD_PATH = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z0-9_]+)*$")
+
+_UNION_TYPES = (Union, UnionType) if UnionType else (Union,)
+
 
 class UserDatabase(ABC):
+    # Backends that enforce `user_id` and `username` uniqueness in the database
+    # and raise `UserExistsError`/`UserNotFoundError` from their `_db_*`
+    # methods set this to skip the existence checks before each write.
+    enforces_constraints: bool = False
+
     def create_user(self, user: User) -> User:
         """
         Add a new user to the database. Raises a `UserExistsError` if the input
@@ -27,16 +49,16 @@ class UserDatabase(ABC):
         @param user: `User` object to insert to the database
         @return: `User` object inserted into the database
         """
-        if self._check_user_exists(user):
+        if not self.enforces_constraints and self._check_user_exists(user):
             raise UserExistsError(user)
         return self._db_create_user(user)
 
     @abstractmethod
     def _db_create_user(self, user: User) -> User:
         """
-        Add a new user to the database. The `user` object has already been
-        validated as unique, so this just needs to perform the database
-        transaction.
+        Add a new user to the database. Unless `enforces_constraints` is set,
+        the `user` object has already been validated as unique, so this just
+        needs to perform the database transaction.
         @param user: `User` object to insert to the database
         @return: `User` object inserted into the database
         """
@@ -67,11 +89,48 @@ class UserDatabase(ABC):
         over `username`; it is possible (though unlikely) that a username
         exists with the same spec as another user's user_id.
         """
+        return self._db_read_user_by_spec(user_spec)
+
+    def _db_read_user_by_spec(self, user_spec: str) -> User:
+        """
+        Look up a user by `user_id` or `username`, giving priority to a
+        `user_id` match. Backends should override this to perform the lookup
+        in a single query.
+        @param user_spec: `user_id` or `username` to look up
+        @return: `User` object parsed from the database
+        """
         try:
             return self.read_user_by_id(user_spec)
         except UserNotFoundError:
             return self.read_user_by_username(user_spec)
 
+    def read_redacted_user(self, user_spec: str) -> User:
+        """
+        Get a `User` object by username or user_id, as in `read_user`, with
+        `password_hash` and `tokens` removed. Backends should override this to
+        avoid reading those fields from the database.
+        @param user_spec: `user_id` or `username` to look up
+        @return: Redacted `User` object parsed from the database
+        """
+        user = self.read_user(user_spec)
+        user.password_hash = None
+        user.tokens = []
+        return user
+
+    def authenticate_token(self, jti: str) -> User:
+        """
+        Get the `User` object that owns the token with the given `jti`. Raises
+        a `UserNotFoundError` if no user has a matching token. By default,
+        all users are scanned with `iter_users`; backends should index token
+        `jti`s and override this with a single lookup.
+        @param jti: Unique token identifier to look up
+        @return: `User` object parsed from the database
+        """
+        for user in self.iter_users():
+            if any(token.jti == jti for token in user.tokens or []):
+                return user
+        raise UserNotFoundError(f"No user with token: {jti}")
+
     def update_user(self, user: User) -> User:
         """
         Update a user entry in the database. Raises a `UserNotFoundError` if
@@ -79,26 +138,74 @@ class UserDatabase(ABC):
         @param user: `User` object to update in the database
         @return: Updated `User` object read from the database
         """
-        # Lookup user to ensure they exist in the database
-        existing_id = self.read_user_by_id(user.user_id)
-        try:
-            if self.read_user_by_username(user.username) != existing_id:
-                raise UserExistsError(f"Another user with username "
-                                      f"'{user.username}' already exists")
-        except UserNotFoundError:
-            pass
+        if not self.enforces_constraints:
+            # Lookup user to ensure they exist in the database
+            existing_id = self.read_user_by_id(user.user_id)
+            try:
+                if self.read_user_by_username(user.username) != existing_id:
+                    raise UserExistsError(f"Another user with username "
+                                          f"'{user.username}' already exists")
+            except UserNotFoundError:
+                pass
         return self._db_update_user(user)
 
     @abstractmethod
     def _db_update_user(self, user: User) -> User:
         """
-        Update a user entry in the database. The `user` object has already been
-        validated as existing and changes valid, so this just needs to perform
-        the database transaction.
+        Update a user entry in the database. Unless `enforces_constraints` is
+        set, the `user` object has already been validated as existing and
+        changes valid, so this just needs to perform the database transaction.
         @param user: `User` object to update in the database
         @return: Updated `User` object read from the database
         """
 
+    def patch_user(self, user_id: str, patch: Dict[str, Any],
+                   expected: Optional[Dict[str, Any]] = None) -> User:
+        """
+        Update only the specified fields of a user entry in the database.
+        Raises a `UserNotFoundError` if the `user_id` is not found in the
+        database, or does not have the `expected` values, or a `ValueError` if
+        `patch` is not valid for a `User`.
+        @param user_id: `user_id` of the user to update
+        @param patch: Dict of dotted field paths (i.e. `neon.units.time`) to
+            the new values for those fields
+        @param expected: Optional dict of dotted field paths to scalar values
+            that the stored user must have for the patch to be applied
+        @return: Updated `User` object read from the database
+        """
+        return self._db_patch_user(user_id, self._validate_patch(patch),
+                                   self._validate_filter(expected))
+
+    def _db_patch_user(self, user_id: str, patch: Dict[str, Any],
+                       expected: Optional[Dict[str, Any]] = None) -> User:
+        """
+        Apply a validated patch to a user entry in the database. Backends
+        should override this to update only the patched fields in a single
+        conditional write; by default, the user is read, checked, patched and
+        rewritten with `update_user`.
+        @param user_id: `user_id` of the user to update
+        @param patch: Dict of validated dotted field paths to JSON-compatible
+            values
+        @param expected: Dict of validated dotted field paths to the values
+            the stored user must have
+        @return: Updated `User` object read from the database
+        """
+        user = self.read_user_by_id(user_id).model_dump(mode="json")
+        for path, value in (expected or dict()).items():
+            target = user
+            for field in path.split("."):
+                target = target.get(field) if isinstance(target, dict) \
+                    else None
+            if target != value:
+                raise UserNotFoundError(f"{user_id} does not match {path}")
+        for path, value in patch.items():
+            *parents, field = path.split(".")
+            target = user
+            for parent in parents:
+                target = target.setdefault(parent, dict())
+            target[field] = value
+        return self.update_user(User(**user))
+
     def delete_user(self, user_id: str) -> User:
         """
         Remove a user from the database if it exists. Raises a
@@ -107,20 +214,160 @@ class UserDatabase(ABC):
         @param user_id: `user_id` to remove
         @return: User object removed from the database
         """
+        if self.enforces_constraints:
+            return self._db_delete_user(user_id)
         # Lookup user to ensure they exist in the database
         user_to_delete = self.read_user_by_id(user_id)
         return self._db_delete_user(user_to_delete)
 
     @abstractmethod
-    def _db_delete_user(self, user: User) -> User:
+    def _db_delete_user(self, user: Union[User, str]) -> User:
         """
         Remove a user from the database if it exists. The `user` object has
         already been validated as existing, so this just needs to perform the
-        database transaction.
-        @param user: User object to remove
+        database transaction. Backends that set `enforces_constraints` are
+        passed the `user_id` instead and raise `UserNotFoundError` themselves.
+        @param user: User object to remove, or its `user_id` if
+            `enforces_constraints` is set
         @return: User object removed from the database
         """
 
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        """
+        Add multiple users to the database. Each user is validated as in
+        `create_user`; a failure for one user does not prevent the others
+        from being created.
+        @param users: `User` objects to insert to the database
+        @return: The inserted `User` or the raised exception for each input
+        """
+        return self._apply_each(self.create_user, users)
+
+    def read_users(self, user_specs: List[str]) -> List[Union[User,
+                                                             Exception]]:
+        """
+        Get multiple `User` objects by username or user_id, as in `read_user`.
+        @param user_specs: usernames or user_ids to look up
+        @return: The `User` or the raised exception for each input
+        """
+        return self._apply_each(self.read_user, user_specs)
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        """
+        Update multiple user entries in the database. Each user is validated
+        as in `update_user`; a failure for one user does not prevent the
+        others from being updated.
+        @param users: `User` objects to update in the database
+        @return: The updated `User` or the raised exception for each input
+        """
+        return self._apply_each(self.update_user, users)
+
+    def delete_users(self, user_ids: List[str]) -> List[Union[User,
+                                                              Exception]]:
+        """
+        Remove multiple users from the database, as in `delete_user`.
+        @param user_ids: `user_id`s to remove
+        @return: The removed `User` or the raised exception for each input
+        """
+        return self._apply_each(self.delete_user, user_ids)
+
+    def iter_users(self, batch_size: int = 1000, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Iterator[User]:
+        """
+        Iterate over users in the database, ordered by `user_id`. Users are
+        read from the database in batches so that memory use does not grow
+        with the size of the database. Backends that do not override this
+        raise a `NotImplementedError`.
+        @param batch_size: Number of users to read from the database at a time
+        @param after: If set, only users with a `user_id` greater than this
+            value are returned. Pass the last `user_id` returned to resume.
+        @param filter: Optional dict of dotted field paths (i.e.
+            `permissions.users`) to scalar values that returned users must
+            match exactly
+        @return: Generator of `User` objects
+        """
+        raise NotImplementedError(f"{self.__class__.__name__} does not "
+                                  f"support iterating users")
+
+    @staticmethod
+    def _validate_filter(filter: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Validate an `iter_users` filter, raising a `ValueError` for any field
+        path or value that is not supported.
+        """
+        filter = filter or dict()
+        for path, value in filter.items():
+            if not isinstance(path, str) or not _FIELD_PATH.match(path):
+                raise ValueError(f"Invalid filter field: {path}")
+            if value is not None and \
+                    not isinstance(value, (str, int, float, bool)):
+                raise ValueError(f"Invalid filter value for {path}: {value}")
+        return filter
+
+    def _parse_user(self, data: Union[str, bytes, dict]) -> User:
+        """
+        Parse a `User` from a stored JSON string or document.
+        @param data: Serialized user, or a dict parsed from one
+        @return: `User` object
+        """
+        if isinstance(data, (str, bytes)):
+            return User.model_validate_json(data)
+        return User.model_validate(data)
+
+    @staticmethod
+    def _validate_patch(patch: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Validate a `patch_user` patch against the `User` schema, raising a
+        `ValueError` for any invalid field path or value.
+        @return: Dict of field paths to validated, JSON-compatible values
+        """
+        if not patch:
+            raise ValueError("No fields to patch")
+        validated = dict()
+        for path, value in patch.items():
+            if not isinstance(path, str) or not _FIELD_PATH.match(path):
+                raise ValueError(f"Invalid patch field: {path}")
+            if path.split(".")[0] in ("user_id", "created_timestamp"):
+                raise ValueError(f"Field is immutable: {path}")
+            if any(other.startswith(f"{path}.") for other in patch):
+                raise ValueError(f"Overlapping patch fields: {path}")
+            annotation = User
+            for field in path.split("."):
+                # Unwrap `Optional` fields to the nested model or dict
+                if get_origin(annotation) in _UNION_TYPES:
+                    annotation = next((arg for arg in get_args(annotation)
+                                       if arg is not type(None)), Any)
+                if isinstance(annotation, type) and \
+                        issubclass(annotation, BaseModel):
+                    if field not in annotation.model_fields:
+                        raise ValueError(f"Invalid patch field: {path}")
+                    annotation = annotation.model_fields[field].annotation
+                elif get_origin(annotation) is dict:
+                    annotation = get_args(annotation)[1]
+                elif annotation is not Any:
+                    raise ValueError(f"Invalid patch field: {path}")
+            adapter = TypeAdapter(annotation)
+            try:
+                validated[path] = adapter.dump_python(
+                    adapter.validate_python(value), mode="json")
+            except Exception as e:
+                raise ValueError(f"Invalid patch value for {path}: {e}")
+        return validated
+
+    @staticmethod
+    def _apply_each(func: Callable, items: list) -> list:
+        """
+        Call `func` for each item, collecting either the return value or the
+        raised exception.
+        """
+        results = []
+        for item in items:
+            try:
+                results.append(func(item))
+            except Exception as e:
+                results.append(e)
+        return results
+
     def _check_user_exists(self, user: User) -> bool:
         """
         Check if a user already exists with the given `username` or `user_id`.
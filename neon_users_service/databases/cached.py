@@ -0,0 +1,232 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from copy import deepcopy
+from threading import RLock
+from typing import Any, Dict, Optional, List, Union, Iterator
+
+from neon_users_service.cache import LRUCache
+from neon_users_service.databases import UserDatabase
+from neon_data_models.models.user.database import User
+
+
+class CachedUserDatabase(UserDatabase):
+    """
+    Read-through cache in front of another `UserDatabase`. Users are cached by
+    `user_id` with a `username` index, so lookups by either key are served
+    from memory until the entry expires or the user is modified through this
+    object. Cached `User` objects are copied on the way in and out so callers
+    may safely modify returned objects.
+    """
+    def __init__(self, database: UserDatabase, max_size: int = 1024,
+                 ttl: float = 60.0):
+        """
+        @param database: `UserDatabase` to cache reads from
+        @param max_size: Maximum number of users to cache
+        @param ttl: Seconds a cached user remains valid
+        """
+        self.database = database
+        self._users = LRUCache(max_size, ttl, on_evict=self._on_evict)
+        self._usernames: Dict[str, str] = dict()
+        # Re-entrant since `put` may evict, calling `_on_evict` under the lock
+        self._lock = RLock()
+        # Incremented on every invalidation so that a read which raced a
+        # write does not re-populate the cache with a stale user
+        self._generation = 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Cache hit/miss/eviction counters.
+        """
+        return self._users.stats
+
+    def _on_evict(self, user_id: str, user: User):
+        with self._lock:
+            if self._usernames.get(user.username) == user_id:
+                self._usernames.pop(user.username)
+
+    def _get(self, user_id: Optional[str]) -> Optional[User]:
+        user = self._users.get(user_id) if user_id else None
+        return user.model_copy(deep=True) if user else None
+
+    def _put(self, user: User, generation: int):
+        user = user.model_copy(deep=True)
+        with self._lock:
+            # Check and store together so an invalidation can't land between
+            if generation != self._generation:
+                return
+            self._usernames[user.username] = user.user_id
+            self._users.put(user.user_id, user)
+
+    def invalidate(self, user_id: Optional[str] = None,
+                   username: Optional[str] = None):
+        """
+        Remove a cached user by `user_id` and/or `username`. Removing a user
+        by `user_id` also removes any `username` it was cached under.
+        @param user_id: `user_id` of the user to remove
+        @param username: `username` of the user to remove
+        """
+        with self._lock:
+            self._generation += 1
+            user_id = user_id or self._usernames.get(username)
+            cached = self._users.pop(user_id) if user_id else None
+            for name in (username, cached.username if cached else None):
+                if name and self._usernames.get(name) == user_id:
+                    self._usernames.pop(name)
+
+    def clear(self):
+        """
+        Remove all cached users.
+        """
+        with self._lock:
+            self._generation += 1
+            self._usernames.clear()
+            self._users.clear()
+
+    def create_user(self, user: User) -> User:
+        return self.database.create_user(user)
+
+    def _db_create_user(self, user: User) -> User:
+        return self.database._db_create_user(user)
+
+    def read_user_by_id(self, user_id: str) -> User:
+        user = self._get(user_id)
+        if user:
+            return user
+        generation = self._generation
+        user = self.database.read_user_by_id(user_id)
+        self._put(user, generation)
+        return user
+
+    def read_user_by_username(self, username: str) -> User:
+        user = self._get(self._usernames.get(username))
+        if user and user.username == username:
+            return user
+        generation = self._generation
+        user = self.database.read_user_by_username(username)
+        self._put(user, generation)
+        return user
+
+    def _get_user_id(self, user_spec: str) -> str:
+        # A `username` hit is served from cache even though an uncached user
+        # could, in theory, have a `user_id` equal to that `username`
+        return user_spec if user_spec in self._users else \
+            self._usernames.get(user_spec, user_spec)
+
+    def _db_read_user_by_spec(self, user_spec: str) -> User:
+        user = self._get(self._get_user_id(user_spec))
+        if user:
+            return user
+        generation = self._generation
+        user = self.database.read_user(user_spec)
+        self._put(user, generation)
+        return user
+
+    def read_redacted_user(self, user_spec: str) -> User:
+        user = self._users.get(self._get_user_id(user_spec))
+        if user:
+            # Copy only the fields that are returned
+            return User.model_construct(
+                _fields_set=user.model_fields_set, password_hash=None,
+                tokens=[], **{key: deepcopy(value)
+                              for key, value in user.__dict__.items()
+                              if key not in ("password_hash", "tokens")})
+        # Cache the complete user so that authenticated reads also hit
+        generation = self._generation
+        user = self.database.read_user(user_spec)
+        self._put(user, generation)
+        user.password_hash = None
+        user.tokens = []
+        return user
+
+    def authenticate_token(self, jti: str) -> User:
+        # Tokens are not cached, so revoked tokens are rejected immediately
+        return self.database.authenticate_token(jti)
+
+    def update_user(self, user: User) -> User:
+        try:
+            return self.database.update_user(user)
+        finally:
+            self.invalidate(user.user_id, user.username)
+
+    def _db_update_user(self, user: User) -> User:
+        return self.database._db_update_user(user)
+
+    def patch_user(self, user_id: str, patch: Dict[str, Any],
+                   expected: Optional[Dict[str, Any]] = None) -> User:
+        try:
+            return self.database.patch_user(user_id, patch, expected)
+        finally:
+            self.invalidate(user_id, patch.get("username"))
+
+    def _db_patch_user(self, user_id: str, patch: Dict[str, Any],
+                       expected: Optional[Dict[str, Any]] = None) -> User:
+        return self.database._db_patch_user(user_id, patch, expected)
+
+    def delete_user(self, user_id: str) -> User:
+        try:
+            return self.database.delete_user(user_id)
+        finally:
+            self.invalidate(user_id)
+
+    def _db_delete_user(self, user: Union[User, str]) -> User:
+        return self.database._db_delete_user(user)
+
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        return self.database.create_users(users)
+
+    def read_users(self, user_specs: List[str]) -> List[Union[User,
+                                                             Exception]]:
+        results = [None] * len(user_specs)
+        missing = []
+        for idx, spec in enumerate(user_specs):
+            results[idx] = self._get(self._get_user_id(spec))
+            if not results[idx]:
+                missing.append(idx)
+        if missing:
+            generation = self._generation
+            users = self.database.read_users([user_specs[idx]
+                                              for idx in missing])
+            for idx, user in zip(missing, users):
+                if isinstance(user, User):
+                    self._put(user, generation)
+                results[idx] = user
+        return results
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        try:
+            return self.database.update_users(users)
+        finally:
+            for user in users:
+                self.invalidate(user.user_id, user.username)
+
+    def delete_users(self, user_ids: List[str]) -> List[Union[User,
+                                                              Exception]]:
+        try:
+            return self.database.delete_users(user_ids)
+        finally:
+            for user_id in user_ids:
+                self.invalidate(user_id)
+
+    def iter_users(self, batch_size: int = 1000, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Iterator[User]:
+        # Iteration is not cached
+        return self.database.iter_users(batch_size, after, filter)
+
+    def shutdown(self):
+        self.clear()
+        self.database.shutdown()
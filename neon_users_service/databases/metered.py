@@ -0,0 +1,128 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+from neon_users_service.databases import UserDatabase
+from neon_users_service.metrics import Metrics
+from neon_data_models.models.user.database import User
+
+
+class MeteredUserDatabase(UserDatabase):
+    """
+    Wrapper around another `UserDatabase` that records the duration of each
+    call in the `db_seconds` histogram, labelled with the backend class and
+    method name.
+    """
+    def __init__(self, database: UserDatabase, metrics: Metrics):
+        """
+        @param database: `UserDatabase` to time calls to
+        @param metrics: Metrics registry to record timings in
+        """
+        self.database = database
+        self.metrics = metrics
+        self.backend = database.__class__.__name__
+
+    def _call(self, method: str, func: Callable, *args) -> Any:
+        with self.metrics.timer("db_seconds", backend=self.backend,
+                                method=method):
+            return func(*args)
+
+    def create_user(self, user: User) -> User:
+        return self._call("create_user", self.database.create_user, user)
+
+    def _db_create_user(self, user: User) -> User:
+        return self.database._db_create_user(user)
+
+    def read_user_by_id(self, user_id: str) -> User:
+        return self._call("read_user_by_id", self.database.read_user_by_id,
+                          user_id)
+
+    def read_user_by_username(self, username: str) -> User:
+        return self._call("read_user_by_username",
+                          self.database.read_user_by_username, username)
+
+    def read_user(self, user_spec: str) -> User:
+        return self._call("read_user", self.database.read_user, user_spec)
+
+    def read_redacted_user(self, user_spec: str) -> User:
+        return self._call("read_redacted_user",
+                          self.database.read_redacted_user, user_spec)
+
+    def authenticate_token(self, jti: str) -> User:
+        return self._call("authenticate_token",
+                          self.database.authenticate_token, jti)
+
+    def update_user(self, user: User) -> User:
+        return self._call("update_user", self.database.update_user, user)
+
+    def _db_update_user(self, user: User) -> User:
+        return self.database._db_update_user(user)
+
+    def patch_user(self, user_id: str, patch: Dict[str, Any],
+                   expected: Optional[Dict[str, Any]] = None) -> User:
+        return self._call("patch_user", self.database.patch_user, user_id,
+                          patch, expected)
+
+    def _db_patch_user(self, user_id: str, patch: Dict[str, Any],
+                       expected: Optional[Dict[str, Any]] = None) -> User:
+        return self.database._db_patch_user(user_id, patch, expected)
+
+    def delete_user(self, user_id: str) -> User:
+        return self._call("delete_user", self.database.delete_user, user_id)
+
+    def _db_delete_user(self, user: Union[User, str]) -> User:
+        return self.database._db_delete_user(user)
+
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        return self._call("create_users", self.database.create_users, users)
+
+    def read_users(self, user_specs: List[str]) -> List[Union[User,
+                                                             Exception]]:
+        return self._call("read_users", self.database.read_users, user_specs)
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        return self._call("update_users", self.database.update_users, users)
+
+    def delete_users(self, user_ids: List[str]) -> List[Union[User,
+                                                              Exception]]:
+        return self._call("delete_users", self.database.delete_users,
+                          user_ids)
+
+    def iter_users(self, batch_size: int = 1000, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Iterator[User]:
+        # Only time spent in the backend is recorded, not time spent by the
+        # caller between users
+        histogram = self.metrics.histogram("db_seconds", backend=self.backend,
+                                           method="iter_users")
+        iterator = self.database.iter_users(batch_size, after, filter)
+        elapsed = 0.0
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    user = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += perf_counter() - start
+                yield user
+        finally:
+            histogram.observe(elapsed)
+
+    def shutdown(self):
+        self.database.shutdown()
@@ -13,48 +13,323 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from pymongo import MongoClient
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import quote_plus
+
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.read_preferences import (make_read_preference,
+                                      read_pref_mode_from_name)
+from pymongo.write_concern import WriteConcern
 from neon_users_service.databases import UserDatabase
 from neon_data_models.models.user.database import User
-from neon_users_service.exceptions import UserNotFoundError
+from neon_users_service.exceptions import (UserNotFoundError, UserExistsError,
+                                           ConfigurationError, DatabaseError)
 
 
 class MongoDbUserDatabase(UserDatabase):
-    def __init__(self, db_host: str, db_port: int, db_user: str, db_pass: str,
-                 db_name: str = "neon-users", collection_name: str = "users"):
-        connection_string = f"mongodb://{db_user}:{db_pass}@{db_host}:{db_port}"
-        self.client = MongoClient(connection_string)
+    # `user_id` is stored as `_id` and `username` has a unique index
+    enforces_constraints = True
+
+    # Fields excluded from redacted reads
+    _redacted_projection = {"password_hash": 0, "tokens": 0}
+
+    def __init__(self, db_host: Optional[str] = None, db_port: int = 27017,
+                 db_user: Optional[str] = None, db_pass: Optional[str] = None,
+                 db_name: str = "neon-users", collection_name: str = "users",
+                 connection_string: Optional[str] = None,
+                 replica_set: Optional[str] = None,
+                 max_pool_size: Optional[int] = None,
+                 min_pool_size: Optional[int] = None,
+                 server_selection_timeout_ms: Optional[int] = None,
+                 compressors: Optional[Union[str, List[str]]] = None,
+                 read_preference: Optional[str] = None,
+                 write_concern: Optional[Dict[str, Any]] = None):
+        """
+        @param db_host: MongoDB host, if `connection_string` is not specified
+        @param db_port: MongoDB port, if `connection_string` is not specified
+        @param db_user: MongoDB user, if `connection_string` is not specified.
+            If either `db_user` or `db_pass` is not set, no credentials are
+            used.
+        @param db_pass: MongoDB password, if `connection_string` is not
+            specified
+        @param db_name: Name of the database containing users
+        @param collection_name: Name of the collection containing users
+        @param connection_string: Full MongoDB URI, i.e. for a replica set
+        @param replica_set: Name of the replica set to connect to
+        @param max_pool_size: Maximum number of connections per server
+        @param min_pool_size: Minimum number of connections per server
+        @param server_selection_timeout_ms: Milliseconds to wait for an
+            available server before raising an exception
+        @param compressors: Wire compressors to negotiate (i.e. `zstd,zlib`)
+        @param read_preference: Read preference applied to unauthenticated
+            reads and to listing users (i.e. `secondaryPreferred`). Writes,
+            reads used to authenticate a user and reads that validate a
+            write always use the primary.
+        @param write_concern: Write concern options applied to writes
+            (i.e. `{"w": "majority", "wtimeout": 5000}`)
+        """
+        if not connection_string:
+            if not db_host:
+                raise ConfigurationError("One of `connection_string` or "
+                                         "`db_host` is required")
+            credentials = ""
+            if db_user and db_pass:
+                credentials = f"{quote_plus(db_user)}:{quote_plus(db_pass)}@"
+            connection_string = f"mongodb://{credentials}{db_host}:{db_port}"
+        client_options = {"replicaSet": replica_set,
+                          "maxPoolSize": max_pool_size,
+                          "minPoolSize": min_pool_size,
+                          "serverSelectionTimeoutMS":
+                              server_selection_timeout_ms,
+                          "compressors": ",".join(compressors)
+                          if isinstance(compressors, list) else compressors}
+        self.client = MongoClient(connection_string,
+                                  **{key: value for key, value in
+                                     client_options.items()
+                                     if value is not None})
         self.db = self.client[db_name]
         self.collection = self.db[collection_name]
+        if write_concern:
+            self.collection = self.collection.with_options(
+                write_concern=WriteConcern(**write_concern))
+        # Only used for reads that neither authenticate nor precede a write
+        self.read_collection = self.collection
+        if read_preference:
+            self.read_collection = self.collection.with_options(
+                read_preference=make_read_preference(
+                    read_pref_mode_from_name(read_preference), None))
+        self._ensure_indexes()
+
+    def _ensure_indexes(self):
+        """
+        Create indexes used for lookups. Users are keyed on `_id`, which is
+        always the `user_id`, so `username` and token `jti`s need additional
+        indexes. This is a no-op if the indexes already exist.
+        """
+        self.collection.create_index("username", unique=True,
+                                     name="username_unique")
+        self.collection.create_index("tokens.jti", name="tokens_jti")
 
     def _db_create_user(self, user: User) -> User:
-        self.collection.insert_one({**user.model_dump(),
-                                    "_id": user.user_id})
-        return self.read_user_by_id(user.user_id)
+        try:
+            self.collection.insert_one({**user.model_dump(),
+                                        "_id": user.user_id})
+        except DuplicateKeyError:
+            raise UserExistsError(user)
+        # Return a copy, so the caller cannot modify the created user
+        return user.model_copy(deep=True)
 
     def read_user_by_id(self, user_id: str) -> User:
-        result = self.collection.find_one({"user_id": user_id})
+        result = self.collection.find_one({"_id": user_id})
         if not result:
             raise UserNotFoundError(user_id)
-        return User(**result)
+        return self._parse_user(result)
 
     def read_user_by_username(self, username: str) -> User:
         result = self.collection.find_one({"username": username})
         if not result:
             raise UserNotFoundError(username)
-        return User(**result)
+        return self._parse_user(result)
+
+    def _find_by_spec(self, user_spec: str,
+                      projection: Optional[dict] = None,
+                      collection: Optional[Collection] = None) -> dict:
+        # At most one user matches each field; prefer the `user_id` match
+        collection = collection or self.collection
+        results = list(collection.find(
+            {"$or": [{"_id": user_spec}, {"username": user_spec}]},
+            projection).limit(2))
+        if not results:
+            raise UserNotFoundError(user_spec)
+        return next((r for r in results if r["_id"] == user_spec),
+                    results[0])
+
+    def _db_read_user_by_spec(self, user_spec: str) -> User:
+        return self._parse_user(self._find_by_spec(user_spec))
+
+    def read_redacted_user(self, user_spec: str) -> User:
+        return self._parse_user(self._find_by_spec(
+            user_spec, dict(self._redacted_projection), self.read_collection))
+
+    def authenticate_token(self, jti: str) -> User:
+        result = self.collection.find_one({"tokens.jti": jti})
+        if not result:
+            raise UserNotFoundError(jti)
+        return self._parse_user(result)
 
     def _db_update_user(self, user: User) -> User:
         update = user.model_dump()
         update.pop("user_id")
         update.pop("created_timestamp")
-        self.collection.update_one({"user_id": user.user_id},
-                                   {"$set": update})
-        return self.read_user_by_id(user.user_id)
+        try:
+            # Return the document as written, since some fields are immutable
+            result = self.collection.find_one_and_update(
+                {"_id": user.user_id}, {"$set": update},
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            raise UserExistsError(f"Another user with username "
+                                  f"'{user.username}' already exists")
+        if not result:
+            raise UserNotFoundError(user.user_id)
+        return self._parse_user(result)
+
+    def _db_patch_user(self, user_id: str, patch: Dict[str, Any],
+                       expected: Optional[Dict[str, Any]] = None) -> User:
+        try:
+            result = self.collection.find_one_and_update(
+                {**(expected or dict()), "_id": user_id}, {"$set": patch},
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            raise UserExistsError(f"Another user with username "
+                                  f"'{patch['username']}' already exists")
+        if not result:
+            raise UserNotFoundError(user_id)
+        return self._parse_user(result)
+
+    def _db_delete_user(self, user: Union[User, str]) -> User:
+        user_id = user if isinstance(user, str) else user.user_id
+        result = self.collection.find_one_and_delete({"_id": user_id})
+        if not result:
+            raise UserNotFoundError(user_id)
+        return self._parse_user(result)
+
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        taken_ids = set()
+        taken_names = set()
+        for result in self.collection.find(
+                {"$or": [{"_id": {"$in": [u.user_id for u in users]}},
+                         {"username": {"$in": [u.username for u in users]}}]},
+                {"username": 1}):
+            taken_ids.add(result["_id"])
+            taken_names.add(result["username"])
+        results = []
+        documents = []
+        for user in users:
+            if user.user_id in taken_ids or user.username in taken_names:
+                results.append(UserExistsError(user))
+                continue
+            taken_ids.add(user.user_id)
+            taken_names.add(user.username)
+            documents.append({**user.model_dump(), "_id": user.user_id})
+            results.append(user.model_copy(deep=True))
+        if documents:
+            try:
+                self.collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Another writer created a conflicting user after the check
+                created = [idx for idx, result in enumerate(results)
+                           if isinstance(result, User)]
+                for idx, error in self._write_errors(e, created):
+                    results[idx] = UserExistsError(users[idx]) \
+                        if error is None else error
+        return results
+
+    def read_users(self, user_specs: List[str]) -> List[Union[User,
+                                                             Exception]]:
+        by_id = dict()
+        by_name = dict()
+        for result in self.collection.find(
+                {"$or": [{"_id": {"$in": user_specs}},
+                         {"username": {"$in": user_specs}}]}):
+            by_id[result["_id"]] = result
+            by_name[result["username"]] = result
+        results = []
+        for spec in user_specs:
+            result = by_id.get(spec) or by_name.get(spec)
+            results.append(self._parse_user(result) if result
+                           else UserNotFoundError(spec))
+        return results
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        existing_ids = set()
+        name_owners = dict()
+        for result in self.collection.find(
+                {"$or": [{"_id": {"$in": [u.user_id for u in users]}},
+                         {"username": {"$in": [u.username for u in users]}}]},
+                {"username": 1}):
+            existing_ids.add(result["_id"])
+            name_owners[result["username"]] = result["_id"]
+        results = []
+        operations = []
+        for user in users:
+            if user.user_id not in existing_ids:
+                results.append(UserNotFoundError(user.user_id))
+                continue
+            if name_owners.get(user.username,
+                               user.user_id) != user.user_id:
+                results.append(UserExistsError(
+                    f"Another user with username '{user.username}' already "
+                    f"exists"))
+                continue
+            name_owners[user.username] = user.user_id
+            update = user.model_dump()
+            update.pop("user_id")
+            update.pop("created_timestamp")
+            operations.append(UpdateOne({"_id": user.user_id},
+                                        {"$set": update}))
+            results.append(user.user_id)
+        if operations:
+            try:
+                self.collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                # Another writer took a username after the check
+                updating = [idx for idx, result in enumerate(results)
+                            if isinstance(result, str)]
+                for idx, error in self._write_errors(e, updating):
+                    results[idx] = UserExistsError(
+                        f"Another user with username '{users[idx].username}' "
+                        f"already exists") if error is None else error
+        # Read back updated users, since some fields are immutable
+        updated = {result["_id"]: result for result in
+                   self.collection.find({"_id": {"$in": [
+                       r for r in results if isinstance(r, str)]}})}
+        return [(self._parse_user(updated[r]) if r in updated
+                 else UserNotFoundError(r)) if isinstance(r, str)
+                else r for r in results]
+
+    @staticmethod
+    def _write_errors(error: BulkWriteError, positions: List[int]) -> \
+            Iterator[Tuple[int, Optional[Exception]]]:
+        """
+        Map the write errors of a bulk write back to the batch items that
+        failed.
+        @param error: Error raised by the bulk write
+        @param positions: Index in the batch of each document or operation
+            that was written
+        @return: Generator of batch index and `None` for a duplicate key, or
+            a `DatabaseError` for any other failure
+        """
+        for write_error in error.details.get("writeErrors", []):
+            position = positions[write_error["index"]]
+            if write_error.get("code") == 11000:
+                yield position, None
+            else:
+                yield position, DatabaseError(write_error.get("errmsg"))
+
+    def delete_users(self, user_ids: List[str]) -> List[Union[User,
+                                                              Exception]]:
+        existing = {result["_id"]: result for result in
+                    self.collection.find({"_id": {"$in": user_ids}})}
+        if existing:
+            self.collection.delete_many({"_id": {"$in": list(existing)}})
+        results = []
+        for user_id in user_ids:
+            result = existing.pop(user_id, None)
+            results.append(self._parse_user(result) if result
+                           else UserNotFoundError(user_id))
+        return results
 
-    def _db_delete_user(self, user: User) -> User:
-        self.collection.delete_one({"user_id": user.user_id})
-        return user
+    def iter_users(self, batch_size: int = 1000, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Iterator[User]:
+        query = dict(self._validate_filter(filter))
+        if after:
+            query["_id"] = {"$gt": after}
+        for result in self.read_collection.find(query).sort(
+                "_id", 1).batch_size(batch_size):
+            yield self._parse_user(result)
 
     def shutdown(self):
         self.client.close()
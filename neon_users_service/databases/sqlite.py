@@ -14,94 +14,679 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
+import lzma
+import zlib
 
+from contextlib import contextmanager
+from ovos_utils.log import LOG
 from os import makedirs
 from os.path import expanduser, dirname
-from sqlite3 import connect
+from queue import Queue
+from sqlite3 import connect, Connection, IntegrityError
 from threading import Lock
-from typing import Optional, List
+from typing import (Optional, List, Iterator, Union, Dict, Any, Callable,
+                    NamedTuple, Tuple)
 
 from neon_users_service.databases import UserDatabase
-from neon_users_service.exceptions import UserNotFoundError, DatabaseError
+from neon_users_service.exceptions import (UserNotFoundError, DatabaseError,
+                                           UserExistsError)
 from neon_data_models.models.user.database import User
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class _Codec(NamedTuple):
+    # Encode a user's JSON serialization for storage
+    encode: Callable[[str], Union[str, bytes]]
+    # Decode a stored value to JSON text or bytes, or to a dict
+    decode: Callable[[Union[str, bytes]], Union[str, bytes, dict]]
+
+
+# Storage formats for `user_object`; the codec of each row is stored with it
+_CODECS = {
+    "json": _Codec(lambda text: text, lambda data: data),
+    "zlib": _Codec(lambda text: zlib.compress(text.encode("utf-8")),
+                   zlib.decompress),
+    "lzma": _Codec(lambda text: lzma.compress(text.encode("utf-8")),
+                   lzma.decompress),
+}
+if msgpack:
+    _CODECS["msgpack"] = _Codec(lambda text: msgpack.packb(json.loads(text)),
+                                msgpack.unpackb)
+
+
+def _get_codec(codec: str) -> _Codec:
+    try:
+        return _CODECS[codec]
+    except KeyError:
+        raise DatabaseError(f"Unsupported user_object codec: {codec}")
+
+
+def _encode_sql(codec: str, text: str) -> Union[str, bytes]:
+    """
+    SQL function `encode_user(codec, json)` encoding a user's JSON for storage.
+    """
+    return _get_codec(codec).encode(text)
+
+
+def _decode_sql(codec: str, data: Union[str, bytes]) -> str:
+    """
+    SQL function `decode_user(codec, user_object)` returning a stored user's
+    JSON text, so that JSON functions can be used with any codec.
+    """
+    decoded = _get_codec(codec).decode(data)
+    if isinstance(decoded, dict):
+        return json.dumps(decoded)
+    return decoded.decode("utf-8") if isinstance(decoded, bytes) else decoded
+
+
+def _user_json(prefix: str = "") -> str:
+    """
+    Build an SQL expression for the JSON text of a user row, only calling
+    `decode_user` for rows that are not stored as JSON.
+    @param prefix: Table or row prefix, i.e. `NEW.`
+    """
+    return f"CASE {prefix}codec WHEN 'json' THEN {prefix}user_object " \
+           f"ELSE decode_user({prefix}codec, {prefix}user_object) END"
+
+
+def _chunks(items: list, size: int = 500) -> Iterator[list]:
+    """
+    Split `items` into lists of at most `size` elements, to keep queries
+    within SQLite's bound parameter limit.
+    """
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def _migrate_v1(connection: Connection):
+    """
+    Replace the original, unindexed `users` table with one keyed on `user_id`
+    and with a unique index on `username`. Any existing rows are copied into
+    the new table; duplicate entries (which could never be read) are dropped.
+    """
+    legacy = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name='users'"
+    ).fetchone()
+    if legacy:
+        connection.execute("ALTER TABLE users RENAME TO users_legacy")
+    connection.execute(
+        '''CREATE TABLE users
+        (user_id text PRIMARY KEY NOT NULL,
+         created_timestamp integer,
+         username text NOT NULL,
+         user_object text NOT NULL)'''
+    )
+    connection.execute(
+        "CREATE UNIQUE INDEX idx_users_username ON users (username)")
+    if legacy:
+        legacy_count = connection.execute(
+            "SELECT COUNT(*) FROM users_legacy").fetchone()[0]
+        connection.execute(
+            '''INSERT OR IGNORE INTO users
+            SELECT user_id, created_timestamp, username, user_object
+            FROM users_legacy ORDER BY rowid'''
+        )
+        migrated_count = connection.execute(
+            "SELECT COUNT(*) FROM users").fetchone()[0]
+        if migrated_count != legacy_count:
+            LOG.warning(f"Dropped {legacy_count - migrated_count} duplicate "
+                        f"user entries during migration")
+        connection.execute("DROP TABLE users_legacy")
+
+
+def _migrate_v2(connection: Connection):
+    """
+    Add a `codec` column recording the storage format of each `user_object`;
+    existing rows are JSON. Add a `tokens` table mapping each token `jti` to
+    the `user_id` it belongs to, so tokens can be authenticated without
+    scanning `user_object`s, and populate it from any existing users.
+
+    `tokens` is written by this service in the same transaction as each user;
+    there are no insert or update triggers, since those would need the
+    service's `decode_user` function and prevent other SQLite clients from
+    writing users. Deleting a user removes its tokens with a trigger that only
+    uses built-in functions.
+    """
+    connection.execute("ALTER TABLE users ADD COLUMN codec text NOT NULL "
+                       "DEFAULT 'json'")
+    connection.execute(
+        '''CREATE TABLE tokens
+        (jti text PRIMARY KEY NOT NULL,
+         user_id text NOT NULL)'''
+    )
+    connection.execute("CREATE INDEX idx_tokens_user_id ON tokens (user_id)")
+    connection.execute(
+        "CREATE TRIGGER users_tokens_delete AFTER DELETE ON users "
+        "BEGIN DELETE FROM tokens WHERE user_id = OLD.user_id; END")
+    connection.execute(
+        '''INSERT OR REPLACE INTO tokens (jti, user_id)
+        SELECT json_extract(value, '$.jti'), user_id
+        FROM users, json_each(users.user_object, '$.tokens')
+        WHERE json_extract(value, '$.jti') IS NOT NULL'''
+    )
+
 
 class SQLiteUserDatabase(UserDatabase):
-    def __init__(self, db_path: Optional[str] = None):
+    # `user_id` and `username` uniqueness is enforced by the schema
+    enforces_constraints = True
+
+    # Ordered schema migrations. The database `user_version` is the number of
+    # migrations that have already been applied.
+    _migrations = (_migrate_v1, _migrate_v2)
+
+    _journal_modes = ("delete", "truncate", "persist", "memory", "wal", "off")
+    _synchronous_modes = ("off", "normal", "full", "extra")
+
+    def __init__(self, db_path: Optional[str] = None, pool_size: int = 0,
+                 journal_mode: Optional[str] = None,
+                 synchronous: Optional[Union[str, int]] = None,
+                 cache_size: Optional[int] = None,
+                 mmap_size: Optional[int] = None,
+                 cached_statements: int = 128,
+                 codec: str = "json"):
+        """
+        @param db_path: Path to the SQLite database file, or `:memory:` for a
+            non-persistent database (i.e. for tests and benchmarks)
+        @param pool_size: Number of dedicated reader connections. If `0`, all
+            reads and writes share a single connection. Otherwise, writes use
+            one connection and reads are served concurrently from the pool;
+            `journal_mode` defaults to `wal` in this case.
+        @param journal_mode: Optional `PRAGMA journal_mode` to set
+        @param synchronous: Optional `PRAGMA synchronous` to set
+        @param cache_size: Optional `PRAGMA cache_size` to set per connection
+        @param mmap_size: Optional `PRAGMA mmap_size` to set per connection
+        @param cached_statements: Number of prepared statements to cache per
+            connection
+        @param codec: Storage format for users written to the database; one
+            of `json`, `zlib`, `lzma` or `msgpack` (if installed). Rows
+            written with other codecs remain readable.
+        """
+        if codec not in _CODECS:
+            raise ValueError(f"Invalid codec: {codec}")
+        self.codec = codec
         db_path = expanduser(db_path or "~/.local/share/neon/user-db.sqlite")
-        makedirs(dirname(db_path), exist_ok=True)
-        self.connection = connect(db_path, check_same_thread=False)
+        if db_path == ":memory:":
+            # Each connection would open a separate in-memory database
+            if pool_size:
+                raise ValueError("`pool_size` is not supported for in-memory "
+                                 "databases")
+        else:
+            makedirs(dirname(db_path), exist_ok=True)
+        if pool_size and not journal_mode:
+            journal_mode = "wal"
+        self._pragmas = self._validate_pragmas(journal_mode, synchronous,
+                                               cache_size, mmap_size)
+        self._cached_statements = cached_statements
+        self.connection = self._connect(db_path)
         self._db_lock = Lock()
-        self.connection.execute(
-            '''CREATE TABLE IF NOT EXISTS users
-            (user_id text,
-             created_timestamp integer,
-             username text,
-             user_object text)'''
-        )
-        self.connection.commit()
+        self._migrate()
+
+        self._readers: Optional[Queue] = None
+        if pool_size:
+            self._readers = Queue(maxsize=pool_size)
+            for _ in range(pool_size):
+                reader = self._connect(db_path)
+                reader.execute("PRAGMA query_only = ON")
+                self._readers.put(reader)
+
+    @classmethod
+    def _validate_pragmas(cls, journal_mode: Optional[str],
+                          synchronous: Optional[Union[str, int]],
+                          cache_size: Optional[int],
+                          mmap_size: Optional[int]) -> List[str]:
+        """
+        Validate configured pragma values and build the statements to apply
+        to each new connection.
+        """
+        pragmas = []
+        if journal_mode:
+            if journal_mode.lower() not in cls._journal_modes:
+                raise ValueError(f"Invalid journal_mode: {journal_mode}")
+            pragmas.append(f"PRAGMA journal_mode = {journal_mode.lower()}")
+        if synchronous is not None:
+            if isinstance(synchronous, str):
+                if synchronous.lower() not in cls._synchronous_modes:
+                    raise ValueError(f"Invalid synchronous: {synchronous}")
+                synchronous = synchronous.lower()
+            else:
+                synchronous = int(synchronous)
+            pragmas.append(f"PRAGMA synchronous = {synchronous}")
+        if cache_size is not None:
+            pragmas.append(f"PRAGMA cache_size = {int(cache_size)}")
+        if mmap_size is not None:
+            pragmas.append(f"PRAGMA mmap_size = {int(mmap_size)}")
+        return pragmas
+
+    def _connect(self, db_path: str) -> Connection:
+        """
+        Open a new connection to the database with configured pragmas applied.
+        """
+        connection = connect(db_path, check_same_thread=False,
+                             cached_statements=self._cached_statements)
+        connection.create_function("encode_user", 2, _encode_sql,
+                                   deterministic=True)
+        connection.create_function("decode_user", 2, _decode_sql,
+                                   deterministic=True)
+        for pragma in self._pragmas:
+            connection.execute(pragma)
+        return connection
+
+    @contextmanager
+    def _read_connection(self) -> Iterator[Connection]:
+        """
+        Get a connection to use for a read-only query. If a reader pool is
+        configured, a pooled connection is used; otherwise this waits for the
+        shared connection.
+        """
+        if not self._readers:
+            with self._db_lock:
+                yield self.connection
+            return
+        connection = self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put(connection)
+
+    @property
+    def schema_version(self) -> int:
+        """
+        Schema version of the connected database, as recorded in
+        `PRAGMA user_version`.
+        """
+        return self.connection.execute("PRAGMA user_version").fetchone()[0]
+
+    def _migrate(self):
+        """
+        Apply any schema migrations that have not yet been applied to the
+        connected database. Each migration is applied in its own transaction
+        along with the `user_version` update that records it.
+        """
+        version = self.schema_version
+        if version > len(self._migrations):
+            raise DatabaseError(f"Database schema version {version} is newer "
+                                f"than supported version "
+                                f"{len(self._migrations)}")
+        for new_version, migration in enumerate(self._migrations[version:],
+                                                start=version + 1):
+            LOG.info(f"Migrating database schema to version {new_version}")
+            with self._db_lock:
+                try:
+                    self.connection.execute("BEGIN")
+                    migration(self.connection)
+                    self.connection.execute(
+                        f"PRAGMA user_version = {new_version}")
+                    self.connection.commit()
+                except Exception:
+                    self.connection.rollback()
+                    raise
+
+    def _encode_user(self, user: User) -> Tuple[str, Union[str, bytes]]:
+        """
+        Serialize a user for storage with the configured codec.
+        @return: Codec name and encoded `user_object`
+        """
+        return self.codec, _CODECS[self.codec].encode(user.model_dump_json())
+
+    def _decode_user(self, codec: str, user_object: Union[str, bytes]) -> User:
+        """
+        Parse a user stored with the given codec.
+        """
+        return self._parse_user(_get_codec(codec).decode(user_object))
+
+    @staticmethod
+    def _write_tokens(connection: Connection, tokens: Dict[str, List[str]]):
+        """
+        Replace the indexed token `jti`s of users. This must be called in the
+        same transaction as the write to `users` that changes their tokens.
+        @param tokens: Dict of `user_id` to the `jti`s of that user's tokens
+        """
+        for chunk in _chunks(list(tokens)):
+            connection.execute(
+                f"DELETE FROM tokens WHERE user_id IN "
+                f"({', '.join('?' * len(chunk))})", chunk)
+        connection.executemany(
+            "INSERT OR REPLACE INTO tokens (jti, user_id) VALUES (?, ?)",
+            [(jti, user_id) for user_id, jtis in tokens.items()
+             for jti in jtis])
+
+    @staticmethod
+    def _get_jtis(user: User) -> List[str]:
+        return [token.jti for token in user.tokens or [] if token.jti]
 
     def _db_create_user(self, user: User) -> User:
         with self._db_lock:
-            self.connection.execute(
-                f'''INSERT INTO users VALUES 
-                ('{user.user_id}',
-                '{user.created_timestamp}',
-                '{user.username}',
-                '{user.model_dump_json()}')'''
-            )
-            self.connection.commit()
+            try:
+                self.connection.execute(
+                    "INSERT INTO users (user_id, created_timestamp, username, "
+                    "codec, user_object) VALUES (?, ?, ?, ?, ?)",
+                    (user.user_id, user.created_timestamp, user.username,
+                     *self._encode_user(user))
+                )
+                self._write_tokens(self.connection,
+                                   {user.user_id: self._get_jtis(user)})
+                self.connection.commit()
+            except IntegrityError:
+                self.connection.rollback()
+                raise UserExistsError(user)
         return user
 
     @staticmethod
-    def _parse_lookup_results(user_spec: str, rows: List[tuple]) -> str:
+    def _parse_lookup_results(user_spec: str, rows: List[tuple]) -> tuple:
         if len(rows) > 1:
             raise DatabaseError(f"User with spec '{user_spec}' has duplicate entries!")
         elif len(rows) == 0:
             raise UserNotFoundError(user_spec)
-        return rows[0][0]
+        return rows[0]
 
     def read_user_by_id(self, user_id: str) -> User:
-        with self._db_lock:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                f'''SELECT user_object FROM users WHERE
-                user_id = '{user_id}'
-                '''
-            )
-            rows = cursor.fetchall()
-            cursor.close()
-        return User(**json.loads(self._parse_lookup_results(user_id, rows)))
+        with self._read_connection() as connection:
+            rows = connection.execute(
+                "SELECT codec, user_object FROM users WHERE user_id = ?",
+                (user_id,)).fetchall()
+        return self._decode_user(*self._parse_lookup_results(user_id, rows))
 
     def read_user_by_username(self, username: str) -> User:
-        with self._db_lock:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                f'''SELECT user_object FROM users WHERE
-                username = '{username}'
-                '''
-            )
-            rows = cursor.fetchall()
-            cursor.close()
-        return User(**json.loads(self._parse_lookup_results(username, rows)))
+        with self._read_connection() as connection:
+            rows = connection.execute(
+                "SELECT codec, user_object FROM users WHERE username = ?",
+                (username,)).fetchall()
+        return self._decode_user(*self._parse_lookup_results(username, rows))
+
+    def _db_read_user_by_spec(self, user_spec: str) -> User:
+        with self._read_connection() as connection:
+            row = connection.execute(
+                "SELECT codec, user_object FROM users "
+                "WHERE user_id = ?1 OR username = ?1 "
+                "ORDER BY user_id = ?1 DESC LIMIT 1",
+                (user_spec,)).fetchone()
+        if not row:
+            raise UserNotFoundError(user_spec)
+        return self._decode_user(*row)
+
+    def read_redacted_user(self, user_spec: str) -> User:
+        # Redact in SQL so that tokens are never parsed into objects
+        with self._read_connection() as connection:
+            row = connection.execute(
+                f"SELECT json_set({_user_json()}, '$.password_hash', NULL, "
+                f"'$.tokens', json('[]')) FROM users "
+                f"WHERE user_id = ?1 OR username = ?1 "
+                f"ORDER BY user_id = ?1 DESC LIMIT 1",
+                (user_spec,)).fetchone()
+        if not row:
+            raise UserNotFoundError(user_spec)
+        return self._parse_user(row[0])
+
+    def authenticate_token(self, jti: str) -> User:
+        with self._read_connection() as connection:
+            row = connection.execute(
+                "SELECT codec, user_object FROM tokens "
+                "JOIN users ON users.user_id = tokens.user_id "
+                "WHERE tokens.jti = ?", (jti,)).fetchone()
+        if not row:
+            raise UserNotFoundError(jti)
+        return self._decode_user(*row)
 
     def _db_update_user(self, user: User) -> User:
         with self._db_lock:
-            self.connection.execute(
-                f'''UPDATE users SET username = '{user.username}',
-                user_object = '{user.model_dump_json()}' 
-                WHERE user_id = '{user.user_id}'
-                '''
-            )
-            self.connection.commit()
-        return self.read_user_by_id(user.user_id)
+            try:
+                row = self.connection.execute(
+                    "UPDATE users SET username = ?, codec = ?, user_object = ? "
+                    "WHERE user_id = ? RETURNING codec, user_object",
+                    (user.username, *self._encode_user(user), user.user_id)
+                ).fetchone()
+                if row:
+                    self._write_tokens(self.connection,
+                                       {user.user_id: self._get_jtis(user)})
+                self.connection.commit()
+            except IntegrityError:
+                self.connection.rollback()
+                raise UserExistsError(f"Another user with username "
+                                      f"'{user.username}' already exists")
+        if not row:
+            raise UserNotFoundError(user.user_id)
+        return self._decode_user(*row)
 
-    def _db_delete_user(self, user: User) -> User:
+    def _db_patch_user(self, user_id: str, patch: Dict[str, Any],
+                       expected: Optional[Dict[str, Any]] = None) -> User:
+        # Paths are validated against the `User` schema and values are bound.
+        # The patched user is re-encoded with the configured codec.
+        params = [self.codec, self.codec]
+        for path, value in patch.items():
+            params.extend((f"$.{path}", json.dumps(value)))
+        columns = f"codec = ?, user_object = encode_user(?, json_set(" \
+                  f"{_user_json()}{', ?, json(?)' * len(patch)}))"
+        if "username" in patch:
+            columns += ", username = ?"
+            params.append(patch["username"])
+        params.append(user_id)
+        # Only update the user if it still has the `expected` values
+        conditions = ""
+        for path, value in (expected or dict()).items():
+            conditions += f" AND json_extract({_user_json()}, ?) IS ?"
+            params.extend((f"$.{path}", value))
         with self._db_lock:
-            self.connection.execute(
-                f"DELETE FROM users WHERE user_id = '{user.user_id}'")
+            try:
+                row = self.connection.execute(
+                    f"UPDATE users SET {columns} WHERE user_id = ?"
+                    f"{conditions} RETURNING codec, user_object",
+                    params).fetchone()
+                if row and "tokens" in patch:
+                    self._write_tokens(self.connection, {user_id: [
+                        token["jti"] for token in patch["tokens"] or []
+                        if token.get("jti")]})
+                self.connection.commit()
+            except IntegrityError:
+                self.connection.rollback()
+                raise UserExistsError(f"Another user with username "
+                                      f"'{patch['username']}' already exists")
+        if not row:
+            raise UserNotFoundError(user_id)
+        return self._decode_user(*row)
+
+    def _db_delete_user(self, user: Union[User, str]) -> User:
+        user_id = user if isinstance(user, str) else user.user_id
+        with self._db_lock:
+            row = self.connection.execute(
+                "DELETE FROM users WHERE user_id = ? "
+                "RETURNING codec, user_object", (user_id,)).fetchone()
             self.connection.commit()
-        return user
+        if not row:
+            raise UserNotFoundError(user_id)
+        return self._decode_user(*row)
+
+    @staticmethod
+    def _select_in(connection: Connection, columns: str, key: str,
+                   values: list) -> List[tuple]:
+        """
+        Select `columns` from every row where `key` is in `values`.
+        """
+        rows = []
+        for chunk in _chunks(list(set(values))):
+            rows.extend(connection.execute(
+                f"SELECT {columns} FROM users WHERE {key} IN "
+                f"({', '.join('?' * len(chunk))})", chunk).fetchall())
+        return rows
+
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        results = []
+        rows = []
+        with self._db_lock:
+            taken_ids = {row[0] for row in self._select_in(
+                self.connection, "user_id", "user_id",
+                [u.user_id for u in users])}
+            taken_names = {row[0] for row in self._select_in(
+                self.connection, "username", "username",
+                [u.username for u in users])}
+            for user in users:
+                if user.user_id in taken_ids or user.username in taken_names:
+                    results.append(UserExistsError(user))
+                    continue
+                taken_ids.add(user.user_id)
+                taken_names.add(user.username)
+                rows.append((user.user_id, user.created_timestamp,
+                             user.username, *self._encode_user(user)))
+                results.append(user)
+            try:
+                self.connection.executemany(
+                    "INSERT INTO users (user_id, created_timestamp, username, "
+                    "codec, user_object) VALUES (?, ?, ?, ?, ?)", rows)
+                self._write_tokens(self.connection, {
+                    user.user_id: self._get_jtis(user) for user in results
+                    if isinstance(user, User)})
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        return results
+
+    def read_users(self, user_specs: List[str]) -> List[Union[User,
+                                                             Exception]]:
+        by_id: Dict[str, tuple] = dict()
+        by_name: Dict[str, tuple] = dict()
+        with self._read_connection() as connection:
+            for chunk in _chunks(list(set(user_specs))):
+                params = ', '.join('?' * len(chunk))
+                for user_id, username, *row in connection.execute(
+                        f"SELECT user_id, username, codec, user_object "
+                        f"FROM users WHERE user_id IN ({params}) "
+                        f"OR username IN ({params})",
+                        chunk + chunk).fetchall():
+                    by_id[user_id] = row
+                    by_name[username] = row
+        results = []
+        for spec in user_specs:
+            row = by_id.get(spec) or by_name.get(spec)
+            results.append(self._decode_user(*row) if row
+                           else UserNotFoundError(spec))
+        return results
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        results = []
+        rows = []
+        with self._db_lock:
+            existing_ids = {row[0] for row in self._select_in(
+                self.connection, "user_id", "user_id",
+                [u.user_id for u in users])}
+            name_owners = dict(self._select_in(
+                self.connection, "username, user_id", "username",
+                [u.username for u in users]))
+            for user in users:
+                if user.user_id not in existing_ids:
+                    results.append(UserNotFoundError(user.user_id))
+                    continue
+                if name_owners.setdefault(user.username,
+                                          user.user_id) != user.user_id:
+                    results.append(UserExistsError(
+                        f"Another user with username '{user.username}' "
+                        f"already exists"))
+                    continue
+                rows.append((user.username, *self._encode_user(user),
+                             user.user_id))
+                results.append(user)
+            try:
+                self.connection.executemany(
+                    "UPDATE users SET username = ?, codec = ?, user_object = ? "
+                    "WHERE user_id = ?", rows)
+                self._write_tokens(self.connection, {
+                    user.user_id: self._get_jtis(user) for user in results
+                    if isinstance(user, User)})
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        return results
+
+    def delete_users(self, user_ids: List[str]) -> List[Union[User,
+                                                              Exception]]:
+        with self._db_lock:
+            existing = {user_id: row for user_id, *row in self._select_in(
+                self.connection, "user_id, codec, user_object", "user_id",
+                user_ids)}
+            try:
+                for chunk in _chunks(list(existing)):
+                    self.connection.execute(
+                        f"DELETE FROM users WHERE user_id IN "
+                        f"({', '.join('?' * len(chunk))})", chunk)
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+        results = []
+        for user_id in user_ids:
+            row = existing.pop(user_id, None)
+            results.append(self._decode_user(*row) if row
+                           else UserNotFoundError(user_id))
+        return results
+
+    def iter_users(self, batch_size: int = 1000, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Iterator[User]:
+        filter = self._validate_filter(filter)
+        conditions = "".join(f" AND json_extract({_user_json()}, ?) IS ?"
+                             for _ in filter)
+        filter_params = [param for path, value in filter.items()
+                         for param in (f"$.{path}", value)]
+        last_id = after or ""
+        while True:
+            # Each page is a separate indexed query, so no read transaction
+            # or connection is held between pages
+            with self._read_connection() as connection:
+                rows = connection.execute(
+                    f"SELECT user_id, codec, user_object FROM users "
+                    f"WHERE user_id > ?{conditions} "
+                    f"ORDER BY user_id LIMIT ?",
+                    (last_id, *filter_params, batch_size)).fetchall()
+            for _, codec, user_object in rows:
+                yield self._decode_user(codec, user_object)
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def reencode(self, codec: Optional[str] = None,
+                 batch_size: int = 500) -> int:
+        """
+        Re-encode stored users with a different codec, i.e. after changing the
+        configured `codec`. Rows are converted in batches, each in its own
+        transaction, so this may be interrupted and resumed.
+        @param codec: Codec to convert rows to; defaults to the configured one
+        @param batch_size: Number of rows to convert per transaction
+        @return: Number of rows that were re-encoded
+        """
+        codec = codec or self.codec
+        if codec not in _CODECS:
+            raise ValueError(f"Invalid codec: {codec}")
+        converted = 0
+        last_id = ""
+        while True:
+            with self._db_lock:
+                rows = self.connection.execute(
+                    "SELECT user_id, codec, user_object FROM users "
+                    "WHERE user_id > ? AND codec != ? ORDER BY user_id "
+                    "LIMIT ?", (last_id, codec, batch_size)).fetchall()
+                try:
+                    self.connection.executemany(
+                        "UPDATE users SET codec = ?, user_object = ? "
+                        "WHERE user_id = ?",
+                        [(codec, _CODECS[codec].encode(
+                            _decode_sql(row_codec, user_object)), user_id)
+                         for user_id, row_codec, user_object in rows])
+                    self.connection.commit()
+                except Exception:
+                    self.connection.rollback()
+                    raise
+            converted += len(rows)
+            if len(rows) < batch_size:
+                return converted
+            last_id = rows[-1][0]
 
     def shutdown(self):
-        self.connection.close()
+        with self._db_lock:
+            self.connection.close()
+        if self._readers:
+            while not self._readers.empty():
+                self._readers.get().close()
@@ -0,0 +1,221 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import re
+
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+from os import urandom
+from typing import List, Optional, Tuple
+
+from ovos_utils.log import LOG
+
+# Hex-encoded SHA-256 digest, as stored by the legacy scheme
+_SHA256_HEX = re.compile(r"^[a-f0-9]{64}$")
+
+
+class PasswordHasher:
+    """
+    Hashes passwords for storage with a configurable scheme and cost.
+
+    Passwords are first reduced to their hex SHA-256 digest, so clients may
+    send either a plaintext password or its SHA-256 digest. Key derivation
+    schemes are then applied to that digest with a random salt, which allows
+    stored legacy SHA-256 hashes to be upgraded when a user next logs in.
+    Encoded hashes have the form `<scheme>$<params>$<salt>$<hash>`.
+    """
+    schemes = ("sha256", "pbkdf2_sha256", "scrypt")
+
+    def __init__(self, scheme: str = "sha256", iterations: int = 600000,
+                 n: int = 2 ** 14, r: int = 8, p: int = 1,
+                 salt_size: int = 16, workers: int = 0,
+                 accept_stored_hash: bool = False):
+        """
+        @param scheme: Hashing scheme for new hashes; one of `schemes`
+        @param iterations: Number of iterations for `pbkdf2_sha256`
+        @param n: CPU/memory cost for `scrypt`
+        @param r: Block size for `scrypt`
+        @param p: Parallelization for `scrypt`
+        @param salt_size: Number of random salt bytes for new hashes
+        @param workers: If set, `hash_many` hashes batches on a pool of this
+            many threads; hashlib releases the GIL while deriving keys, so
+            these are hashed in parallel. Single passwords are always hashed
+            on the calling thread.
+        @param accept_stored_hash: If True, a stored key derivation hash is
+            accepted in place of the password, for legacy clients that
+            authenticate with the hash they read. This allows anyone with a
+            copy of the database to log in, so it is off by default.
+        """
+        if scheme not in self.schemes:
+            raise ValueError(f"Invalid scheme: {scheme}")
+        self.scheme = scheme
+        self.iterations = iterations
+        self.n, self.r, self.p = n, r, p
+        self.salt_size = salt_size
+        self.accept_stored_hash = accept_stored_hash
+        self._executor = ThreadPoolExecutor(
+            workers, thread_name_prefix="password_hasher") if workers else None
+
+    @staticmethod
+    def _prehash(password: str) -> str:
+        if _SHA256_HEX.match(password):
+            return password
+        return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+    @property
+    def _params(self) -> Tuple[int, ...]:
+        if self.scheme == "pbkdf2_sha256":
+            return (self.iterations,)
+        if self.scheme == "scrypt":
+            return self.n, self.r, self.p
+        return tuple()
+
+    @staticmethod
+    def _derive(scheme: str, params: Tuple[int, ...], prehash: str,
+                salt: bytes) -> bytes:
+        if scheme == "pbkdf2_sha256":
+            return hashlib.pbkdf2_hmac("sha256", prehash.encode("utf-8"),
+                                       salt, params[0])
+        n, r, p = params
+        return hashlib.scrypt(prehash.encode("utf-8"), salt=salt, n=n, r=r,
+                              p=p, maxmem=128 * n * r * p + 1024 * 1024)
+
+    def _parse(self, password_hash: str) -> \
+            Optional[Tuple[str, Tuple[int, ...], bytes, bytes]]:
+        """
+        Parse an encoded hash into its scheme, parameters, salt and key, or
+        return `None` if it is not a supported key derivation hash.
+        """
+        scheme, *fields = password_hash.split("$")
+        if scheme not in self.schemes[1:] or len(fields) < 3:
+            return None
+        try:
+            params = tuple(int(field) for field in fields[:-2])
+            salt, key = b64decode(fields[-2]), b64decode(fields[-1])
+        except ValueError:
+            return None
+        if len(params) != (1 if scheme == "pbkdf2_sha256" else 3):
+            return None
+        return scheme, params, salt, key
+
+    def is_hashed(self, value: str) -> bool:
+        """
+        Check if `value` is a stored password hash for any supported scheme.
+        A hex SHA-256 digest is considered hashed only by the `sha256` scheme,
+        since other schemes derive a key from it.
+        """
+        if _SHA256_HEX.match(value):
+            return self.scheme == "sha256"
+        return self._parse(value) is not None
+
+    def hash(self, password: str) -> str:
+        """
+        Hash a plaintext password or SHA-256 digest for storage.
+        @param password: Plaintext password or its hex SHA-256 digest
+        @returns: Encoded password hash
+        """
+        return self._hash(password)
+
+    def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        Hash multiple passwords, as in `hash`, in parallel if a pool is
+        configured.
+        """
+        if self._executor:
+            return list(self._executor.map(self._hash, passwords))
+        return [self._hash(password) for password in passwords]
+
+    def _hash(self, password: str) -> str:
+        prehash = self._prehash(password)
+        if self.scheme == "sha256":
+            return prehash
+        salt = urandom(self.salt_size)
+        key = self._derive(self.scheme, self._params, prehash, salt)
+        params = "$".join(str(param) for param in self._params)
+        return f"{self.scheme}${params}${b64encode(salt).decode()}$" \
+               f"{b64encode(key).decode()}"
+
+    def ensure_hashed(self, value: str) -> str:
+        """
+        Get the hash to store for `value`, which may already be a hash.
+        """
+        return value if self.is_hashed(value) else self.hash(value)
+
+    def verify(self, password: str, password_hash: str) -> bool:
+        """
+        Check a password against a stored hash. The stored hash itself is
+        only accepted if `accept_stored_hash` is set.
+        @param password: Plaintext password or its SHA-256 digest
+        @param password_hash: Stored password hash
+        @returns: True if `password` matches `password_hash`
+        """
+        return self.verify_and_update(password, password_hash)[0]
+
+    def verify_and_update(self, password: str, password_hash: str) -> \
+            Tuple[bool, Optional[str]]:
+        """
+        Check a password against a stored hash, as in `verify`, and get a new
+        hash to store if the stored hash uses outdated settings.
+        @returns: True if `password` matches and an updated hash or `None`
+        """
+        if not password or not password_hash:
+            return False, None
+        if self.accept_stored_hash and \
+                not _SHA256_HEX.match(password_hash) and hmac.compare_digest(
+                password.encode("utf-8"), password_hash.encode("utf-8")):
+            # Without the password, the hash cannot be upgraded
+            return True, None
+        return self._verify_and_update(password, password_hash)
+
+    def _verify_and_update(self, password: str, password_hash: str) -> \
+            Tuple[bool, Optional[str]]:
+        prehash = self._prehash(password)
+        if _SHA256_HEX.match(password_hash):
+            valid = hmac.compare_digest(prehash, password_hash)
+        else:
+            parsed = self._parse(password_hash)
+            if not parsed:
+                return False, None
+            scheme, params, salt, key = parsed
+            valid = hmac.compare_digest(
+                self._derive(scheme, params, prehash, salt), key)
+        if valid and self.needs_rehash(password_hash):
+            return True, self._hash(prehash)
+        return valid, None
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """
+        Check if a stored hash was created with a different scheme or cost
+        than is configured. Key derivation hashes are never replaced with
+        unsalted `sha256` hashes.
+        """
+        if _SHA256_HEX.match(password_hash):
+            return self.scheme != "sha256"
+        parsed = self._parse(password_hash)
+        if parsed and self.scheme == "sha256":
+            LOG.warning(f"Not replacing a {parsed[0]} hash with a weaker "
+                        f"sha256 hash")
+            return False
+        return not parsed or parsed[0] != self.scheme or \
+            parsed[1] != self._params or len(parsed[2]) != self.salt_size
+
+    def shutdown(self):
+        """
+        Stop the hashing thread pool, if any.
+        """
+        if self._executor:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,99 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Callable, Dict, List, Optional
+from uuid import uuid4
+
+from ovos_utils.log import LOG
+
+
+InvalidationCallback = Callable[[Optional[str], Optional[str]], None]
+
+
+class InvalidationChannel(ABC):
+    """
+    Broadcasts user invalidations to peer service instances so they can drop
+    locally cached data for a modified user. Messages published by this
+    instance are not delivered back to it.
+    """
+    def __init__(self):
+        self.origin = uuid4().hex
+        self._callbacks: List[InvalidationCallback] = []
+
+    def subscribe(self, callback: InvalidationCallback):
+        """
+        Register a callback to be called with `user_id` and `username` for
+        each invalidation received from a peer.
+        """
+        self._callbacks.append(callback)
+
+    @abstractmethod
+    def publish(self, user_id: Optional[str] = None,
+                username: Optional[str] = None):
+        """
+        Notify peers that the specified user has been modified.
+        @param user_id: `user_id` of the modified user
+        @param username: `username` of the modified user
+        """
+
+    def _on_invalidation(self, message: dict):
+        """
+        Handle an invalidation message received from a peer.
+        """
+        if message.get("origin") == self.origin:
+            return
+        for callback in self._callbacks:
+            try:
+                callback(message.get("user_id"), message.get("username"))
+            except Exception as e:
+                LOG.exception(f"Invalidation callback failed: {e}")
+
+    def shutdown(self):
+        """
+        Stop receiving invalidations.
+        """
+        self._callbacks.clear()
+
+
+class LocalInvalidationChannel(InvalidationChannel):
+    """
+    In-process invalidation channel. All instances created with the same
+    `name` are peers of each other.
+    """
+    _peers: Dict[str, List['LocalInvalidationChannel']] = dict()
+    _peers_lock = Lock()
+
+    def __init__(self, name: str = "neon_users_invalidation"):
+        InvalidationChannel.__init__(self)
+        self.name = name
+        with self._peers_lock:
+            self._peers.setdefault(name, []).append(self)
+
+    def publish(self, user_id: Optional[str] = None,
+                username: Optional[str] = None):
+        message = {"user_id": user_id, "username": username,
+                   "origin": self.origin}
+        with self._peers_lock:
+            peers = list(self._peers.get(self.name, []))
+        for peer in peers:
+            peer._on_invalidation(message)
+
+    def shutdown(self):
+        with self._peers_lock:
+            if self in self._peers.get(self.name, []):
+                self._peers[self.name].remove(self)
+        InvalidationChannel.shutdown(self)
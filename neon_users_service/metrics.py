@@ -0,0 +1,415 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from ovos_utils.log import LOG
+
+
+# Default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """
+    Thread-safe histogram of observed values with fixed bucket bounds.
+    """
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        @param buckets: Sorted upper bounds of each bucket. Values greater than
+            the last bound are counted in an implicit `+Inf` bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """
+        Record one observed value.
+        """
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating within the bucket containing it.
+        Values in the `+Inf` bucket are reported as the largest bound.
+        @param q: Quantile to estimate, between 0 and 1
+        @returns: Estimated value, or 0.0 if nothing has been observed
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for idx, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if idx == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[idx - 1] if idx else 0.0
+                return lower + (self.buckets[idx] - lower) * \
+                    (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class _Timer:
+    """
+    Context manager that observes its elapsed time in a histogram.
+    """
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(perf_counter() - self._start)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """
+    In-process registry of counters and latency histograms, identified by name
+    and labels. Values provided by other objects (i.e. cache statistics) may
+    be added as gauges with `register_collector`.
+    """
+    def __init__(self, namespace: str = "neon_users",
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        @param namespace: Prefix of exported metric names
+        @param buckets: Upper bounds of histogram buckets, in seconds
+        """
+        self.namespace = namespace
+        self.buckets = tuple(buckets)
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+        self.counters: Dict[Tuple[str, Labels], int] = dict()
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = dict()
+        self._lock = Lock()
+
+    def histogram(self, name: str, **labels: str) -> Histogram:
+        """
+        Get the histogram with `name` and `labels`, creating it if necessary.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(
+                    key, Histogram(self.buckets))
+        return histogram
+
+    def timer(self, name: str, **labels: str) -> _Timer:
+        """
+        Get a context manager that records its duration in seconds to the
+        histogram with `name` and `labels`.
+        """
+        return _Timer(self.histogram(name, **labels))
+
+    def observe(self, name: str, value: float, **labels: str):
+        """
+        Record a value in the histogram with `name` and `labels`.
+        """
+        self.histogram(name, **labels).observe(value)
+
+    def increment(self, name: str, value: int = 1, **labels: str):
+        """
+        Increment the counter with `name` and `labels`.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register_collector(self, name: str,
+                           collector: Callable[[], Dict[str, float]]):
+        """
+        Register a callable returning gauge values to be exported as
+        `<name>_<key>`, i.e. `cache.stats`.
+        """
+        self._collectors[name] = collector
+
+    def collect(self) -> Dict[str, float]:
+        """
+        Get the current value of all registered gauges.
+        """
+        gauges = dict()
+        for name, collector in list(self._collectors.items()):
+            try:
+                for key, value in collector().items():
+                    gauges[f"{name}_{key}"] = value
+            except Exception as e:
+                LOG.error(f"Failed to collect {name} metrics: {e}")
+        return gauges
+
+    def snapshot(self) -> dict:
+        """
+        Get a summary of all metrics, with histogram counts, totals, and
+        estimated quantiles.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            "counters": {_format_name(*key): value
+                         for key, value in counters.items()},
+            "histograms": {_format_name(*key): {
+                "count": histogram.count, "sum": histogram.sum,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95),
+                "p99": histogram.quantile(0.99)}
+                for key, histogram in histograms.items()},
+            "gauges": self.collect()}
+
+    def render_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(),
+                                key=lambda item: item[0])
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            name = f"{self.namespace}_{name}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{_format_name(name, labels)} {value}")
+        for (name, labels), histogram in histograms:
+            name = f"{self.namespace}_{name}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            with histogram._lock:
+                counts = list(histogram.counts)
+                count, total = histogram.count, histogram.sum
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                bucket = _format_name(f"{name}_bucket",
+                                      labels + (("le", str(bound)),))
+                lines.append(f"{bucket} {cumulative}")
+            lines.append(f"{_format_name(f'{name}_sum', labels)} {total}")
+            lines.append(f"{_format_name(f'{name}_count', labels)} {count}")
+        for name, value in sorted(self.collect().items()):
+            name = f"{self.namespace}_{name}"
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class NullMetrics(Metrics):
+    """
+    Metrics registry that records nothing, used when metrics are disabled so
+    that instrumented code does not need to check for a registry.
+    """
+    def __bool__(self):
+        return False
+
+    def timer(self, name: str, **labels: str) -> _NullTimer:
+        return _NULL_TIMER
+
+    def observe(self, name: str, value: float, **labels: str):
+        pass
+
+    def increment(self, name: str, value: int = 1, **labels: str):
+        pass
+
+    def register_collector(self, name: str,
+                           collector: Callable[[], Dict[str, float]]):
+        pass
+
+
+def _format_name(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    label_str = ",".join(f'{key}="{value}"' for key, value in labels)
+    return f"{name}{{{label_str}}}"
+
+
+class MetricsExporter:
+    """
+    Base class for exporting metrics from a running service.
+    """
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def start(self):
+        """
+        Start exporting metrics.
+        """
+
+    def shutdown(self):
+        """
+        Stop exporting metrics.
+        """
+
+
+class PrometheusExporter(MetricsExporter):
+    """
+    Serves metrics in the Prometheus text format over HTTP.
+    """
+    def __init__(self, metrics: Metrics, host: str = "0.0.0.0",
+                 port: int = 9464, path: str = "/metrics"):
+        """
+        @param metrics: Metrics to export
+        @param host: Address to listen on
+        @param port: Port to listen on; 0 selects a free port
+        @param path: Path metrics are served at
+        """
+        MetricsExporter.__init__(self, metrics)
+        exporter = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != path:
+                    self.send_error(404)
+                    return
+                body = exporter.metrics.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self._thread = Thread(target=self.server.serve_forever, daemon=True,
+                              name="neon_users_metrics")
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        if self._thread.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+
+class LogExporter(MetricsExporter):
+    """
+    Periodically logs a one-line summary of request rates, latencies, error
+    codes, and gauges.
+    """
+    def __init__(self, metrics: Metrics, interval: float = 60.0):
+        """
+        @param metrics: Metrics to export
+        @param interval: Seconds between log lines
+        """
+        MetricsExporter.__init__(self, metrics)
+        self.interval = interval
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, daemon=True,
+                              name="neon_users_metrics")
+        self._last_counts: Dict[str, int] = dict()
+        self._last_time = monotonic()
+
+    def format_summary(self) -> str:
+        """
+        Build a summary of metrics since the previous summary.
+        """
+        snapshot = self.metrics.snapshot()
+        now = monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        self._last_time = now
+        parts = []
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            new = histogram["count"] - self._last_counts.get(name, 0)
+            self._last_counts[name] = histogram["count"]
+            if not new:
+                continue
+            parts.append(f"{name} rate={new / elapsed:.2f}/s "
+                         f"p50={histogram['p50'] * 1000:.2f}ms "
+                         f"p95={histogram['p95'] * 1000:.2f}ms "
+                         f"p99={histogram['p99'] * 1000:.2f}ms")
+        parts.extend(f"{name}={value}" for name, value in
+                     sorted(snapshot["counters"].items()))
+        parts.extend(f"{name}={value:.3g}" for name, value in
+                     sorted(snapshot["gauges"].items()))
+        return "; ".join(parts)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                summary = self.format_summary()
+                if summary:
+                    LOG.info(f"Metrics: {summary}")
+            except Exception as e:
+                LOG.error(f"Failed to log metrics: {e}")
+
+    def start(self):
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopped.set()
+
+
+def init_exporter(metrics: Metrics, exporter: Optional[str] = None,
+                  **kwargs) -> Optional[MetricsExporter]:
+    """
+    Create and start the configured metrics exporter.
+    @param metrics: Metrics to export
+    @param exporter: `prometheus`, `log`, or `None` to only collect metrics
+    @param kwargs: Exporter-specific options
+    @returns: The running exporter, if one is configured
+    """
+    if not exporter:
+        return None
+    if exporter == "prometheus":
+        instance = PrometheusExporter(metrics, **kwargs)
+    elif exporter == "log":
+        instance = LogExporter(metrics, **kwargs)
+    else:
+        raise ValueError(f"Invalid metrics exporter: {exporter}")
+    instance.start()
+    return instance
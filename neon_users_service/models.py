@@ -0,0 +1,58 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Any, Dict, Literal, Optional
+
+from pydantic import Field, model_validator
+
+from neon_data_models.models.api.jwt import HanaToken
+from neon_data_models.models.base.contexts import MQContext
+
+
+class ListUsersRequest(MQContext):
+    operation: Literal["list"] = "list"
+    auth_user_spec: str = Field(description="Username or ID to authorize "
+                                            "the listing")
+    access_token: Optional[HanaToken] = Field(
+        None, description="Token associated with `auth_user_spec`")
+    password: Optional[str] = Field(None,
+                                    description="Password associated with "
+                                                "`auth_user_spec`")
+    limit: int = Field(100, ge=1, le=1000,
+                       description="Maximum number of users to return")
+    after: Optional[str] = Field(None,
+                                 description="`next_token` from a previous "
+                                             "response to continue from")
+    filter: Dict[str, Any] = Field(default_factory=dict,
+                                   description="Dotted field paths to values "
+                                               "that listed users must match")
+
+    @model_validator(mode="after")
+    def validate_params(self) -> 'ListUsersRequest':
+        if self.access_token and self.access_token.purpose != "access":
+            raise ValueError(f"Expected an access token but got: "
+                             f"{self.access_token.purpose}")
+        return self
+
+
+class PatchUserRequest(MQContext):
+    operation: Literal["patch"] = "patch"
+    user_id: str = Field(description="ID of the user to update")
+    patch: Dict[str, Any] = Field(description="Dotted field paths (i.e. "
+                                              "`neon.units.time`) to updated "
+                                              "values")
+    auth_username: str = Field(description="Username to authorize the change")
+    auth_password: str = Field(description="Password (clear or hashed) "
+                                           "associated with `auth_username`")
@@ -13,22 +13,272 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional
+import json
+import logging
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from random import random
+from queue import Full, Queue
+from threading import BoundedSemaphore, Thread
+from time import perf_counter
+from typing import Any, Dict, Optional, Tuple
 
 import pika.channel
+import pika.exceptions
 from ovos_utils import LOG
+from pydantic_core import to_json
+from pika.exchange_type import ExchangeType
 from ovos_config.config import Configuration
 
 from neon_data_models.enum import AccessRoles
 from neon_mq_connector.connector import MQConnector
+from neon_mq_connector.consumers import (BlockingConsumerThread,
+                                         SelectConsumerThread)
 from neon_mq_connector.utils.network_utils import b64_to_dict, dict_to_b64
+from neon_users_service.cache import LRUCache
 from neon_users_service.exceptions import UserNotFoundError, AuthenticationError, UserNotMatchedError, UserExistsError
 from neon_data_models.models.api.mq import (UserDbRequest, CreateUserRequest,
                                             ReadUserRequest, UpdateUserRequest,
                                             DeleteUserRequest)
 
+from neon_data_models.models.user import User
+from neon_users_service.invalidation import InvalidationChannel
+from neon_users_service.models import ListUsersRequest, PatchUserRequest
 from neon_users_service.service import NeonUsersService
 
+# Operations reported in metrics; others are reported as `invalid`
+_OPERATIONS = frozenset(("create", "read", "update", "delete", "patch",
+                         "list", "batch"))
+
+# Response body encodings. `b64` is the default `neon_mq_connector` format;
+# `json` and `zlib` are raw and compressed JSON bytes
+_ENCODINGS = ("b64", "json", "zlib")
+
+
+def _decode_request(body: bytes,
+                    properties: Optional[pika.spec.BasicProperties]) -> \
+        Tuple[dict, str]:
+    """
+    Parse a request body. Bodies with a `content_type` of `application/json`
+    are JSON, compressed if `content_encoding` is `zlib`; others are base64.
+    @returns: Parsed request and the encoding it was received in
+    """
+    if getattr(properties, "content_type", None) != "application/json":
+        return b64_to_dict(body), "b64"
+    if getattr(properties, "content_encoding", None) == "zlib":
+        return json.loads(zlib.decompress(body)), "zlib"
+    return json.loads(body), "json"
+
+
+def _encode_response(response: dict, encoding: str) -> \
+        Tuple[bytes, Dict[str, str]]:
+    """
+    Serialize a response body.
+    @returns: Encoded body and the `BasicProperties` describing its encoding
+    """
+    if encoding == "b64":
+        return dict_to_b64(response), {}
+    data = to_json(response)
+    if encoding == "zlib":
+        return zlib.compress(data), {"content_type": "application/json",
+                                     "content_encoding": "zlib"}
+    return data, {"content_type": "application/json"}
+
+
+def _log_enabled(level: int) -> bool:
+    """
+    Check if messages at `level` will be logged. `LOG` inspects the stack on
+    every call, so this is checked before building or logging messages.
+    """
+    configured = LOG.level
+    if isinstance(configured, str):
+        configured = logging.getLevelName(configured.upper())
+    return not isinstance(configured, int) or configured <= level
+
+
+class _ResponseSummary:
+    """
+    Loggable summary of a response that identifies returned users without
+    including their data. The summary is only built if it is logged.
+    """
+    __slots__ = ("response",)
+
+    def __init__(self, response: dict):
+        self.response = response
+
+    @staticmethod
+    def _summarize(value: Any) -> Any:
+        if isinstance(value, dict):
+            if "user" in value and isinstance(value["user"], dict):
+                value = {**value, "user": {
+                    key: value["user"].get(key)
+                    for key in ("user_id", "username")}}
+            if "users" in value:
+                value = {**value, "users": len(value["users"])}
+            if "results" in value:
+                value = {**value, "results": [_ResponseSummary._summarize(r)
+                                              for r in value["results"]]}
+        return value
+
+    def __str__(self):
+        return str(self._summarize(self.response))
+
+
+class _BlockingConsumerThread(BlockingConsumerThread):
+    """
+    Blocking consumer that sets a configurable prefetch count on its channel
+    before it starts consuming.
+    """
+    def __init__(self, *args, prefetch_count: int = 50, **kwargs):
+        BlockingConsumerThread.__init__(self, *args, **kwargs)
+        self.prefetch_count = prefetch_count
+
+    def _create_connection(self):
+        self.connection = pika.BlockingConnection(self.connection_params)
+        self.channel = self.connection.channel()
+        self.channel.basic_qos(prefetch_count=self.prefetch_count)
+        if self.queue_reset:
+            self.channel.queue_delete(queue=self.queue)
+        declared_queue = self.channel.queue_declare(
+            queue=self.queue, auto_delete=False,
+            exclusive=self.queue_exclusive)
+        if self.exchange:
+            if self.exchange_reset:
+                self.channel.exchange_delete(exchange=self.exchange)
+            self.channel.exchange_declare(exchange=self.exchange,
+                                          exchange_type=self.exchange_type,
+                                          auto_delete=False)
+            self.channel.queue_bind(queue=declared_queue.method.queue,
+                                    exchange=self.exchange)
+        self.channel.basic_consume(on_message_callback=self.callback_func,
+                                   queue=self.queue, auto_ack=self.auto_ack)
+
+
+class _SelectConsumerThread(SelectConsumerThread):
+    """
+    Asynchronous consumer that sets a configurable prefetch count on its
+    channel before it starts consuming.
+    """
+    def __init__(self, *args, prefetch_count: int = 50, **kwargs):
+        SelectConsumerThread.__init__(self, *args, **kwargs)
+        self.prefetch_count = prefetch_count
+
+    def set_qos(self, _unused_frame=None):
+        self.channel.basic_qos(prefetch_count=self.prefetch_count,
+                               callback=self.start_consuming)
+
+
+class MQInvalidationChannel(InvalidationChannel):
+    """
+    Invalidation channel that broadcasts over a fanout exchange on the
+    connector's vhost, so every service replica receives each invalidation.
+
+    Invalidations are queued and published by a background thread over one
+    long-lived connection, so publishing never blocks or fails a write.
+    """
+    def __init__(self, connector: MQConnector,
+                 exchange: str = "neon_users_invalidation",
+                 max_pending: int = 1000, expiration_ms: int = 1000):
+        """
+        @param connector: Connector used to subscribe and connect to MQ
+        @param exchange: Fanout exchange to broadcast invalidations on
+        @param max_pending: Maximum number of invalidations waiting to be
+            published; further invalidations are dropped and logged
+        @param expiration_ms: TTL of published invalidations
+        """
+        InvalidationChannel.__init__(self)
+        self.connector = connector
+        self.exchange = exchange
+        self._expiration = str(expiration_ms)
+        self._pending = Queue(max_pending)
+        self._connection: Optional[pika.BlockingConnection] = None
+        self._channel: Optional[pika.channel.Channel] = None
+        self._publisher = Thread(target=self._publish_pending, daemon=True,
+                                 name="neon_users_invalidation")
+        self._publisher.start()
+        connector.register_subscriber("neon_users_invalidation",
+                                      connector.vhost, self.handle_message,
+                                      exchange=exchange)
+
+    def publish(self, user_id: Optional[str] = None,
+                username: Optional[str] = None):
+        try:
+            self._pending.put_nowait({"user_id": user_id,
+                                      "username": username,
+                                      "origin": self.origin})
+        except Full:
+            LOG.error(f"Dropped invalidation for {user_id}; too many "
+                      f"pending invalidations")
+
+    def _publish_pending(self):
+        """
+        Publish queued invalidations until `None` is queued by `shutdown`.
+        """
+        while True:
+            message = self._pending.get()
+            if message is None:
+                break
+            try:
+                self._get_channel().basic_publish(
+                    exchange=self.exchange, routing_key="",
+                    body=dict_to_b64(message),
+                    properties=pika.BasicProperties(
+                        expiration=self._expiration))
+            except Exception as e:
+                LOG.error(f"Failed to publish invalidation for "
+                          f"{message['user_id']}: {e}")
+                # Reconnect for the next invalidation
+                self._close_connection()
+        self._close_connection()
+
+    def _get_channel(self) -> pika.channel.Channel:
+        """
+        Get the publishing channel, connecting and declaring the exchange if
+        there is no open channel.
+        """
+        if self._channel is None or not self._channel.is_open:
+            self._close_connection()
+            self._connection = self.connector.create_mq_connection(
+                vhost=self.connector.vhost)
+            self._channel = self._connection.channel()
+            self._channel.exchange_declare(exchange=self.exchange,
+                                           exchange_type=ExchangeType.fanout,
+                                           auto_delete=False)
+        return self._channel
+
+    def _close_connection(self):
+        connection, self._connection, self._channel = \
+            self._connection, None, None
+        try:
+            if connection and connection.is_open:
+                connection.close()
+        except Exception as e:
+            LOG.debug(f"Failed to close invalidation connection: {e}")
+
+    def shutdown(self):
+        InvalidationChannel.shutdown(self)
+        try:
+            self._pending.put(None, timeout=5)
+        except Full:
+            LOG.warning("Stopping with unpublished invalidations")
+            return
+        self._publisher.join(timeout=5)
+
+    def handle_message(self,
+                       channel: pika.channel.Channel,
+                       method: pika.spec.Basic.Deliver,
+                       _: pika.spec.BasicProperties,
+                       body: bytes):
+        """
+        Handles invalidation messages published by peers.
+        """
+        try:
+            self._on_invalidation(b64_to_dict(body))
+        except Exception as e:
+            LOG.exception(f"Failed to handle invalidation: {e}")
+
 
 class NeonUsersConnector(MQConnector):
     def __init__(self, config: Optional[dict],
@@ -37,7 +287,48 @@ class NeonUsersConnector(MQConnector):
         self.vhost = '/neon_users'
         module_config = (config or Configuration()).get('neon_users_service',
                                                         {})
-        self.service = NeonUsersService(module_config)
+        invalidation = None
+        if "invalidation" in module_config:
+            invalidation = MQInvalidationChannel(
+                self, **(module_config["invalidation"] or {}))
+        self.service = NeonUsersService(module_config, invalidation)
+        self.metrics = self.service.metrics
+
+        # Optionally process requests on a pool of worker threads
+        concurrency = module_config.get("concurrency") or {}
+        workers = concurrency.get("workers", 0)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        if workers:
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="neon_users_worker")
+        self._prefetch = concurrency.get("prefetch", workers)
+        self._pending = BoundedSemaphore(concurrency.get("max_pending",
+                                                         2 * workers) or 1)
+
+        responses = module_config.get("responses") or {}
+        # Reply queues declared recently enough that they need not be
+        # declared again before publishing
+        self._declared_queues: Optional[LRUCache] = None
+        if responses.get("declare_cache_size", 1024):
+            self._declared_queues = LRUCache(
+                responses.get("declare_cache_size", 1024),
+                responses.get("declare_cache_ttl", 300))
+        self._log_sample_rate = responses.get("log_sample_rate", 1.0)
+        expiration = responses.get("expiration_ms", 1000)
+        self._expiration = str(int(expiration)) if expiration else None
+        self._priority = responses.get("priority")
+        self._use_reply_to = responses.get("use_reply_to", True)
+        # Reply queues declared by this service dead-letter expired responses
+        # to this exchange so that they can be counted
+        self._queue_arguments = None
+        self.expired_responses = 0
+        if responses.get("dead_letter_exchange"):
+            self._queue_arguments = {
+                "x-dead-letter-exchange": responses["dead_letter_exchange"]}
+            self.register_subscriber("neon_users_expired", self.vhost,
+                                     self.handle_expired_response,
+                                     exchange=responses[
+                                         "dead_letter_exchange"])
 
     def parse_mq_request(self, mq_req: dict) -> dict:
         """
@@ -54,41 +345,39 @@ class NeonUsersConnector(MQConnector):
             will be read for the user being updated. A user may modify their own
             configuration (except permissions) and any user with a diana role of
             `ADMIN` or higher may modify other users.
+        Patch: Updates only the fields in `patch` for the user with
+            `user_id`. Permissions are checked as for Update.
         Delete: Deletes a User from the database. The request object must match
             the database entry exactly, so no additional validation is required.
+        Batch: Accepts a list of `requests`, each of which is one of the
+            above operations, and returns a list of `results` in the same
+            order.
+        List: Returns a page of redacted `users` and a `next_token` to
+            request the following page. The authenticating user must have a
+            users role of `ADMIN` or higher.
         """
-        mq_req = UserDbRequest(**mq_req)
+        if mq_req.get("operation") == "batch":
+            return self._parse_batch_request(mq_req)
+        with self.metrics.timer("stage_seconds", stage="parse"):
+            if mq_req.get("operation") == "list":
+                mq_req = ListUsersRequest(**mq_req)
+            elif mq_req.get("operation") == "patch":
+                mq_req = PatchUserRequest(**mq_req)
+            else:
+                mq_req = UserDbRequest(**mq_req)
+        if isinstance(mq_req, ListUsersRequest):
+            return self._parse_list_request(mq_req)
+        if isinstance(mq_req, PatchUserRequest):
+            return self._parse_patch_request(mq_req)
 
         try:
             if isinstance(mq_req, CreateUserRequest):
                 user = self.service.create_user(mq_req.user)
             elif isinstance(mq_req, ReadUserRequest):
-                if mq_req.user_spec == mq_req.auth_user_spec:
-                    user = self.service.read_authenticated_user(mq_req.user_spec,
-                                                                mq_req.password,
-                                                                mq_req.access_token)
-                else:
-                    auth_user = self.service.read_authenticated_user(
-                        mq_req.auth_user_spec, mq_req.password,
-                        mq_req.access_token)
-                    if auth_user.permissions.users < AccessRoles.USER:
-                        raise PermissionError(f"User {auth_user.username} does "
-                                              f"not have permission to read "
-                                              f"other users")
-                    user = self.service.read_unauthenticated_user(
-                        mq_req.user_spec)
+                user = self._authorize_read(mq_req) or \
+                    self.service.read_unauthenticated_user(mq_req.user_spec)
             elif isinstance(mq_req, UpdateUserRequest):
-                # Get the authenticating user, maybe raising an AuthenticationError
-                auth = self.service.read_authenticated_user(mq_req.auth_username,
-                                                            mq_req.auth_password)
-                if auth.permissions.users < AccessRoles.ADMIN:
-                    if auth.user_id != mq_req.user.user_id:
-                        raise PermissionError(f"User {auth.username} does not "
-                                              f"have permission to modify "
-                                              f"other users")
-                    # Do not allow this non-admin to change their permissions
-                    mq_req.user.permissions = auth.permissions
-
+                self._authorize_update(mq_req)
                 user = self.service.update_user(mq_req.user)
             elif isinstance(mq_req, DeleteUserRequest):
                 # If the passed User object isn't an exact match, this will fail
@@ -96,60 +385,405 @@ class NeonUsersConnector(MQConnector):
             else:
                 raise RuntimeError(f"Unsupported operation requested: "
                                    f"{mq_req}")
+            return self._user_response(user)
+        except Exception as e:
+            return self._error_response(e)
+
+    def _user_response(self, user: User) -> dict:
+        """
+        Build the response for a request that returns a single user.
+        """
+        with self.metrics.timer("stage_seconds", stage="serialize"):
             return {"success": True, "user": user.model_dump()}
-        except UserExistsError:
+
+    @staticmethod
+    def _error_response(error: Exception) -> dict:
+        """
+        Build the response for a request that raised `error`.
+        """
+        if isinstance(error, UserExistsError):
             return {"success": False, "error": "User already exists",
                     "code": 409}
-        except UserNotFoundError:
+        if isinstance(error, UserNotFoundError):
             return {"success": False, "error": "User does not exist",
                     "code": 404}
-        except UserNotMatchedError:
+        if isinstance(error, UserNotMatchedError):
             return {"success": False, "error": "Invalid user", "code": 401}
-        except AuthenticationError:
+        if isinstance(error, AuthenticationError):
             return {"success": False, "error": "Invalid username or password",
                     "code": 401}
+        return {"success": False, "error": repr(error), "code": 500}
+
+    def _authorize_read(self, mq_req: ReadUserRequest) -> Optional[User]:
+        """
+        Authenticate a read request. If the requested user is the
+        authenticating user, the authenticated user is returned. Otherwise,
+        this checks that the authenticating user may read other users and
+        returns `None`.
+        """
+        if mq_req.user_spec == mq_req.auth_user_spec:
+            return self.service.read_authenticated_user(mq_req.user_spec,
+                                                        mq_req.password,
+                                                        mq_req.access_token)
+        auth_user = self.service.read_authenticated_user(
+            mq_req.auth_user_spec, mq_req.password, mq_req.access_token)
+        if auth_user.permissions.users < AccessRoles.USER:
+            raise PermissionError(f"User {auth_user.username} does "
+                                  f"not have permission to read "
+                                  f"other users")
+        return None
+
+    def _authorize_update(self, mq_req: UpdateUserRequest):
+        """
+        Authenticate an update request, raising an exception if the
+        authenticating user may not make the requested change.
+        """
+        # Get the authenticating user, maybe raising an AuthenticationError
+        auth = self.service.read_authenticated_user(mq_req.auth_username,
+                                                    mq_req.auth_password)
+        if auth.permissions.users < AccessRoles.ADMIN:
+            if auth.user_id != mq_req.user.user_id:
+                raise PermissionError(f"User {auth.username} does not "
+                                      f"have permission to modify "
+                                      f"other users")
+            # Do not allow this non-admin to change their permissions
+            mq_req.user.permissions = auth.permissions
+
+    def _parse_patch_request(self, mq_req: PatchUserRequest) -> dict:
+        """
+        Handle a request to update some fields of a user. A user may patch
+        their own configuration (except permissions) and any user with a users
+        role of `ADMIN` or higher may patch other users.
+        """
+        try:
+            auth = self.service.read_authenticated_user(mq_req.auth_username,
+                                                        mq_req.auth_password)
+            patch = mq_req.patch
+            if auth.permissions.users < AccessRoles.ADMIN:
+                if auth.user_id != mq_req.user_id:
+                    raise PermissionError(f"User {auth.username} does not "
+                                          f"have permission to modify "
+                                          f"other users")
+                # Do not allow this non-admin to change their permissions
+                patch = {path: value for path, value in patch.items()
+                         if path.split(".")[0] != "permissions"}
+            user = self.service.patch_user(mq_req.user_id, patch)
+            return self._user_response(user)
         except Exception as e:
-            return {"success": False, "error": repr(e), "code": 500}
+            return self._error_response(e)
+
+    def _parse_list_request(self, mq_req: ListUsersRequest) -> dict:
+        """
+        Handle a request to list users.
+        """
+        try:
+            auth_user = self.service.read_authenticated_user(
+                mq_req.auth_user_spec, mq_req.password, mq_req.access_token)
+            if auth_user.permissions.users < AccessRoles.ADMIN:
+                raise PermissionError(f"User {auth_user.username} does not "
+                                      f"have permission to list users")
+            users, next_token = self.service.list_users(mq_req.limit,
+                                                        mq_req.after,
+                                                        mq_req.filter)
+            return {"success": True,
+                    "users": [user.model_dump() for user in users],
+                    "next_token": next_token}
+        except Exception as e:
+            return self._error_response(e)
+
+    def _parse_batch_request(self, mq_req: dict) -> dict:
+        """
+        Handle a batch of requests. Sub-requests are grouped by operation and
+        applied in the order: create, read, update, delete, so that each
+        group is a single bulk database operation.
+        """
+        requests = mq_req.get("requests")
+        if not isinstance(requests, list):
+            raise ValueError(f"Expected a list of requests; got: {requests}")
+        results = [None] * len(requests)
+        grouped = {"create": [], "read": [], "update": [], "delete": []}
+        for idx, request in enumerate(requests):
+            try:
+                request = UserDbRequest(**request)
+                grouped[request.operation].append((idx, request))
+            except Exception as e:
+                results[idx] = self._error_response(e)
+
+        def _set_results(indices: list, outcomes: list):
+            for idx, outcome in zip(indices, outcomes):
+                results[idx] = self._error_response(outcome) if \
+                    isinstance(outcome, Exception) else \
+                    {"success": True, "user": outcome.model_dump()}
+
+        _set_results([idx for idx, _ in grouped["create"]],
+                     self.service.create_users(
+                         [req.user for _, req in grouped["create"]]))
+
+        to_read = []
+        for idx, req in grouped["read"]:
+            try:
+                user = self._authorize_read(req)
+                if user:
+                    _set_results([idx], [user])
+                else:
+                    to_read.append((idx, req.user_spec))
+            except Exception as e:
+                _set_results([idx], [e])
+        _set_results([idx for idx, _ in to_read],
+                     self.service.read_unauthenticated_users(
+                         [spec for _, spec in to_read]))
+
+        to_update = []
+        for idx, req in grouped["update"]:
+            try:
+                self._authorize_update(req)
+                to_update.append((idx, req.user))
+            except Exception as e:
+                _set_results([idx], [e])
+        _set_results([idx for idx, _ in to_update],
+                     self.service.update_users(
+                         [user for _, user in to_update]))
+
+        _set_results([idx for idx, _ in grouped["delete"]],
+                     self.service.delete_users(
+                         [req.user for _, req in grouped["delete"]]))
+        return {"success": True, "results": results}
 
     def handle_request(self,
                        channel: pika.channel.Channel,
                        method: pika.spec.Basic.Deliver,
-                       _: pika.spec.BasicProperties,
+                       properties: pika.spec.BasicProperties,
                        body: bytes):
         """
-        Handles input MQ request objects.
+        Handles input MQ request objects. If a worker pool is configured, the
+        request is processed on a worker thread and the response is published
+        and acknowledged back on the channel's connection thread.
         @param channel: MQ channel object (pika.channel.Channel)
         @param method: MQ return method (pika.spec.Basic.Deliver)
-        @param _: MQ properties (pika.spec.BasicProperties)
+        @param properties: MQ properties (pika.spec.BasicProperties)
         @param body: request body (bytes)
         """
+        if not self._executor:
+            self._handle_request(channel, method, properties, body)
+            return
+        # Block the consumer if too many requests are already in progress
+        self._pending.acquire()
+        try:
+            self._executor.submit(self._handle_request, channel, method,
+                                  properties, body, True, perf_counter())
+        except Exception:
+            self._pending.release()
+            raise
+
+    def _handle_request(self,
+                        channel: pika.channel.Channel,
+                        method: pika.spec.Basic.Deliver,
+                        properties: Optional[pika.spec.BasicProperties],
+                        body: bytes, threaded: bool = False,
+                        queued: Optional[float] = None):
+        """
+        Parse a request and publish the response. The response is encoded as
+        requested by the request's `response_encoding` (one of `b64`, `json`
+        or `zlib`), or else with the same encoding as the request.
+        @param threaded: If True, this is running on a worker thread and
+            channel operations must be scheduled on the connection thread
+        @param queued: `perf_counter` time the request was queued for a
+            worker thread, if it was
+        """
+        start = perf_counter()
+        if queued is not None:
+            self.metrics.observe("stage_seconds", start - queued,
+                                 stage="queue")
+            start = queued
         message_id = None
+        operation = "invalid"
+        code = 500
         try:
             if not isinstance(body, bytes):
                 raise TypeError(f'Invalid body received, expected bytes string;'
                                 f' got: {type(body)}')
-            request = b64_to_dict(body)
+            with self.metrics.timer("stage_seconds", stage="decode"):
+                request, encoding = _decode_request(body, properties)
             message_id = request.get("message_id")
+            if request.get("response_encoding") in _ENCODINGS:
+                encoding = request["response_encoding"]
+            if request.get("operation") in _OPERATIONS:
+                operation = request["operation"]
             response = self.parse_mq_request(request)
+            code = response.get("code", 200)
             response["message_id"] = message_id
-            data = dict_to_b64(response)
+            with self.metrics.timer("stage_seconds", stage="encode"):
+                data, encoding_properties = _encode_response(response,
+                                                             encoding)
+
+            # Prefer the standard AMQP reply properties, if provided
+            reply_to = getattr(properties, "reply_to", None) \
+                if self._use_reply_to else None
+            routing_key = reply_to or request.get('routing_key',
+                                                  'neon_users_output')
+            correlation_id = getattr(properties, "correlation_id", None) or \
+                message_id
+            publish = partial(self._publish_response, channel,
+                              method.delivery_tag, routing_key, data,
+                              message_id, pika.BasicProperties(
+                                  expiration=self._expiration,
+                                  priority=self._priority,
+                                  correlation_id=correlation_id,
+                                  **encoding_properties),
+                              not reply_to)
+            if threaded:
+                self._run_threadsafe(channel, publish)
+            else:
+                publish()
+            self._log_response(routing_key, response, len(data))
+        except Exception as e:
+            LOG.exception(f"message_id={message_id}: {e}")
+        finally:
+            if threaded:
+                self._pending.release()
+            self.metrics.observe("request_seconds", perf_counter() - start,
+                                 operation=operation)
+            self.metrics.increment("responses_total", operation=operation,
+                                   code=str(code))
+
+    def _log_response(self, routing_key: str, response: dict, size: int):
+        """
+        Log a sent response. At `DEBUG`, every response is logged with user
+        data summarized; otherwise a `log_sample_rate` fraction of responses
+        is logged at `INFO` without user data.
+        """
+        if _log_enabled(logging.DEBUG):
+            LOG.debug("Sent response to queue %s (%d bytes): %s",
+                      routing_key, size, _ResponseSummary(response))
+        elif self._log_sample_rate and _log_enabled(logging.INFO) and \
+                (self._log_sample_rate >= 1 or
+                 random() < self._log_sample_rate):
+            LOG.info(f"Sent response to queue {routing_key} ({size} bytes): "
+                     f"message_id={response.get('message_id')} "
+                     f"code={response.get('code', 200)}")
 
-            routing_key = request.get('routing_key', 'neon_users_output')
+    def _declare_queue(self, channel: pika.channel.Channel, queue: str):
+        """
+        Declare a reply queue, unless it was declared recently.
+        """
+        if self._declared_queues is not None and \
+                self._declared_queues.get(queue):
+            return
+        if self._queue_arguments:
+            self._declare_dead_letter_queue(channel.connection, queue)
+        else:
             # queue declare is idempotent, just making sure queue exists
-            channel.queue_declare(queue=routing_key)
-
-            channel.basic_publish(
-                exchange='',
-                routing_key=routing_key,
-                body=data,
-                properties=pika.BasicProperties(expiration='1000')
-            )
-            LOG.info(f"Sent response to queue {routing_key}: {response}")
-            channel.basic_ack(method.delivery_tag)
+            channel.queue_declare(queue=queue)
+        if self._declared_queues is not None:
+            self._declared_queues.put(queue, True)
+
+    def _declare_dead_letter_queue(self, connection: pika.BlockingConnection,
+                                   queue: str):
+        """
+        Declare a reply queue with the dead-letter exchange argument, unless
+        the queue already exists. The broker closes the channel if a passive
+        declare finds no queue, or if an existing queue was declared with
+        other arguments, so queues are declared on a temporary channel rather
+        than on the channel consuming requests.
+        """
+        channel = connection.channel()
+        try:
+            try:
+                channel.queue_declare(queue=queue, passive=True)
+                return
+            except pika.exceptions.ChannelClosedByBroker:
+                channel = connection.channel()
+            channel.queue_declare(queue=queue,
+                                  arguments=self._queue_arguments)
+        except pika.exceptions.ChannelClosedByBroker as e:
+            # The client declared the queue after the passive declare
+            LOG.debug(f"Reply queue {queue} exists without dead-lettering: "
+                      f"{e}")
+        finally:
+            if channel.is_open:
+                channel.close()
+
+    def _publish_response(self, channel: pika.channel.Channel,
+                          delivery_tag: int, routing_key: str, data: bytes,
+                          message_id: Optional[str],
+                          properties: pika.BasicProperties,
+                          declare: bool = True):
+        """
+        Publish a response and acknowledge the request it answers. This must
+        be called on the thread that owns `channel`.
+        @param declare: If False, `routing_key` is a queue owned by the client
+            (i.e. its `reply_to` queue) and is not declared
+        """
+        try:
+            with self.metrics.timer("stage_seconds", stage="publish"):
+                if declare:
+                    self._declare_queue(channel, routing_key)
+
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=routing_key,
+                    body=data,
+                    properties=properties
+                )
+                channel.basic_ack(delivery_tag)
         except Exception as e:
             LOG.exception(f"message_id={message_id}: {e}")
 
+    def handle_expired_response(self,
+                                channel: pika.channel.Channel,
+                                method: pika.spec.Basic.Deliver,
+                                properties: pika.spec.BasicProperties,
+                                body: bytes):
+        """
+        Count a response that expired before its client consumed it.
+        """
+        self.expired_responses += 1
+        self.metrics.increment("responses_expired_total")
+        if _log_enabled(logging.DEBUG):
+            LOG.debug("Response expired in queue %s: correlation_id=%s",
+                      method.routing_key,
+                      getattr(properties, "correlation_id", None))
+
+    @staticmethod
+    def _run_threadsafe(channel: pika.channel.Channel, callback: callable):
+        """
+        Schedule `callback` to run on the thread that owns `channel`.
+        """
+        connection = channel.connection
+        if hasattr(connection, "add_callback_threadsafe"):
+            # BlockingConnection
+            connection.add_callback_threadsafe(callback)
+        else:
+            # SelectConnection
+            connection.ioloop.add_callback_threadsafe(callback)
+
+    def stop(self):
+        MQConnector.stop(self)
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    @property
+    def consumer_thread_cls(self):
+        if self.async_consumers_enabled:
+            return _SelectConsumerThread
+        return _BlockingConsumerThread
+
+    def run(self, run_consumers: bool = True, run_sync: bool = True,
+            run_observer: Optional[bool] = None, **kwargs):
+        if run_observer is None:
+            # Observe blocking consumers only, as `MQConnector` does
+            run_observer = not self.async_consumers_enabled
+        MQConnector.run(self, run_consumers=run_consumers, run_sync=run_sync,
+                        run_observer=run_observer, **kwargs)
+
     def pre_run(self, **kwargs):
         self.register_consumer("neon_users_consumer", self.vhost,
                                "neon_users_input", self.handle_request,
                                auto_ack=False)
+        if self._prefetch:
+            # Applied when the consumer opens its channel, before anything is
+            # delivered; kept in the properties used to restart the consumer
+            consumer = self.consumer_properties["neon_users_consumer"]
+            consumer["properties"]["prefetch_count"] = self._prefetch
+            self.consumers["neon_users_consumer"].prefetch_count = \
+                self._prefetch
@@ -13,54 +13,152 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import hashlib
-import re
-
-from copy import copy
-from typing import Optional
+from itertools import islice
+from typing import Optional, List, Union, Dict, Any, Tuple, Callable
 from ovos_config import Configuration
+from ovos_utils.log import LOG
 
 from neon_data_models.models.api.jwt import HanaToken
+from neon_users_service.cache import AuthCache, SingleFlight
 from neon_users_service.databases import UserDatabase
+from neon_users_service.hashing import PasswordHasher
+from neon_users_service.databases.cached import CachedUserDatabase
+from neon_users_service.databases.metered import MeteredUserDatabase
 from neon_users_service.exceptions import (ConfigurationError,
                                            AuthenticationError,
-                                           UserNotMatchedError)
+                                           UserNotMatchedError,
+                                           UserNotFoundError)
+from neon_users_service.invalidation import InvalidationChannel
+from neon_users_service.metrics import Metrics, NullMetrics, init_exporter
 from neon_data_models.models.user import User
 
 
+def init_database(config: dict) -> Optional[UserDatabase]:
+    """
+    Build the database backend selected by a `neon_users_service` config.
+    @param config: `neon_users_service` configuration
+    @return: Database for the configured `module`, or `None` if the module is
+        not supported
+    """
+    module = config.get("module")
+    module_config = config.get(module)
+    if module == "sqlite":
+        from neon_users_service.databases.sqlite import SQLiteUserDatabase
+        return SQLiteUserDatabase(**module_config)
+    elif module == "mongodb":
+        from neon_users_service.databases.mongodb import MongoDbUserDatabase
+        return MongoDbUserDatabase(**module_config)
+    # Other supported databases may be added here
+
+
 class NeonUsersService:
-    def __init__(self, config: Optional[dict] = None):
+    def __init__(self, config: Optional[dict] = None,
+                 invalidation: Optional[InvalidationChannel] = None):
+        """
+        @param config: `neon_users_service` configuration
+        @param invalidation: Optional channel used to notify peer services of
+            modified users and to receive their notifications
+        """
         self.config = config or Configuration().get("neon_users_service", {})
+        self.metrics = Metrics() if self.config.get("metrics") is not None \
+            else NullMetrics()
         self.database = self.init_database()
         if not self.database:
             raise ConfigurationError(f"`{self.config.get('module')}` is not a "
                                      f"valid database module.")
+        if self.metrics:
+            self.database = MeteredUserDatabase(self.database, self.metrics)
+        self.cache: Optional[CachedUserDatabase] = None
+        if self.config.get("cache"):
+            self.cache = CachedUserDatabase(self.database,
+                                            **self.config["cache"])
+            self.database = self.cache
+            self.metrics.register_collector("cache", lambda: self.cache.stats)
+        self.hasher = PasswordHasher(**self.config.get("password_hashing",
+                                                       {}))
+        self.auth_cache: Optional[AuthCache] = None
+        if self.config.get("auth_cache"):
+            self.auth_cache = AuthCache(**self.config["auth_cache"])
+            self.metrics.register_collector("auth_cache",
+                                            lambda: self.auth_cache.stats)
+        # Optionally share in-progress reads between concurrent requests
+        self.single_flight: Optional[SingleFlight] = None
+        if self.config.get("coalesce_reads"):
+            self.single_flight = SingleFlight(
+                lambda user: user.model_copy(deep=True))
+            self.metrics.register_collector(
+                "single_flight", lambda: self.single_flight.stats)
+        self.exporter = init_exporter(self.metrics,
+                                      **(self.config.get("metrics") or {}))
+        self.invalidation = invalidation
+        if self.invalidation:
+            self.invalidation.subscribe(self._on_invalidation)
 
     def init_database(self) -> UserDatabase:
-        module = self.config.get("module")
-        module_config = self.config.get(module)
-        if module == "sqlite":
-            from neon_users_service.databases.sqlite import SQLiteUserDatabase
-            return SQLiteUserDatabase(**module_config)
-        elif module == "mongodb":
-            from neon_users_service.databases.mongodb import MongoDbUserDatabase
-            return MongoDbUserDatabase(**module_config)
-        # Other supported databases may be added here
+        return init_database(self.config)
 
-    @staticmethod
-    def _ensure_hashed(password: str) -> str:
+    def _on_invalidation(self, user_id: Optional[str],
+                         username: Optional[str]):
+        """
+        Drop locally cached data for a user modified by a peer service.
+        """
+        if self.cache:
+            self.cache.invalidate(user_id, username)
+        if self.auth_cache:
+            self.auth_cache.invalidate(user_id, username)
+        if self.single_flight:
+            self.single_flight.forget()
+
+    def _publish_invalidation(self, user: User):
         """
-        Generate the sha-256 hash for an input password to be stored in the
-        database. If the password is already a valid hash string, it will be
-        returned with no changes.
+        Drop cached authentication results for a modified user and notify peer
+        services that the user has been modified.
+        """
+        if self.auth_cache:
+            self.auth_cache.invalidate(user.user_id)
+        if self.single_flight:
+            self.single_flight.forget()
+        if not self.invalidation:
+            return
+        try:
+            self.invalidation.publish(user.user_id, user.username)
+        except Exception as e:
+            LOG.error(f"Failed to publish invalidation for "
+                      f"{user.user_id}: {e}")
+
+    def _ensure_hashed(self, password: str) -> str:
+        """
+        Generate the hash for an input password to be stored in the database,
+        using the configured `password_hashing` scheme. If the password is
+        already a valid hash string, it will be returned with no changes.
         @param password: Input password string to be hashed
-        @retruns: A hexadecimal string representation of the sha-256 hash
+        @returns: Encoded password hash
+        """
+        return self.hasher.ensure_hashed(password)
+
+    def _with_hashed_password(self, user: User) -> User:
+        """
+        Get `user` with its password hashed, as in `_ensure_hashed`. The input
+        object is not modified; it is only copied if its password is replaced.
+        """
+        if self.hasher.is_hashed(user.password_hash):
+            return user
+        return user.model_copy(
+            update={"password_hash": self.hasher.hash(user.password_hash)})
+
+    def _ensure_hashed_many(self, users: List[User]) -> List[User]:
+        """
+        Get each user with its password hashed, as in `_with_hashed_password`,
+        hashing in parallel where possible.
         """
-        if re.compile(r"^[a-f0-9]{64}$").match(password):
-            password_hash = password
-        else:
-            password_hash = hashlib.sha256(password.encode("utf-8")).hexdigest()
-        return password_hash
+        users = list(users)
+        to_hash = [idx for idx, user in enumerate(users)
+                   if not self.hasher.is_hashed(user.password_hash)]
+        for idx, password_hash in zip(to_hash, self.hasher.hash_many(
+                [users[idx].password_hash for idx in to_hash])):
+            users[idx] = users[idx].model_copy(
+                update={"password_hash": password_hash})
+        return users
 
     def create_user(self, user: User) -> User:
         """
@@ -69,23 +167,79 @@ class NeonUsersService:
         @param user: The user to be created
         @returns: The user as added to the database
         """
-        # Create a copy to prevent modifying the input object
-        user = copy(user)
-        user.password_hash = self._ensure_hashed(user.password_hash)
-        return self.database.create_user(user)
+        return self.database.create_user(self._with_hashed_password(user))
 
     def _read_user(self, user_spec: str, password: Optional[str] = None,
                    auth_token: Optional[HanaToken] = None) -> User:
-        user = self.database.read_user(user_spec)
-        if password and self._ensure_hashed(password) == user.password_hash:
-            return user
-        elif auth_token and any((tok.jti == f"{auth_token.jti}.refresh"
-                                 for tok in user.tokens)):
-            return user
-        else:
-            user.password_hash = None
-            user.tokens = []
-            return user
+        if password:
+            user = self._coalesce("read_user", self.database.read_user,
+                                  user_spec)
+            valid, new_hash = self.hasher.verify_and_update(
+                password, user.password_hash)
+            if valid:
+                return self._rehash(user, new_hash) if new_hash else user
+            if not auth_token:
+                return self._redact(user)
+        if auth_token:
+            try:
+                user = self.authenticate_token(auth_token)
+                if user_spec in (user.user_id, user.username):
+                    return user
+            except AuthenticationError:
+                pass
+        return self.read_unauthenticated_user(user_spec)
+
+    def _coalesce(self, method: str, func: Callable[[str], User],
+                  user_spec: str) -> User:
+        """
+        Read a user with `func`, sharing the read with concurrent calls of the
+        same `method` for the same `user_spec` if `coalesce_reads` is enabled.
+        Each caller receives its own copy of the user.
+        """
+        if not self.single_flight:
+            return func(user_spec)
+        return self.single_flight.do((method, user_spec), func, user_spec)
+
+    def _rehash(self, user: User, password_hash: str) -> User:
+        """
+        Store an upgraded password hash for a user who has just authenticated,
+        unless their password was changed since the user was read. Failures
+        are logged so that they do not prevent authentication.
+        """
+        try:
+            user = self.database.patch_user(
+                user.user_id, {"password_hash": password_hash},
+                expected={"password_hash": user.password_hash})
+            self._publish_invalidation(user)
+        except UserNotFoundError:
+            LOG.debug(f"Not upgrading password hash for {user.user_id}; "
+                      f"the password was changed")
+        except Exception as e:
+            LOG.error(f"Failed to upgrade password hash for "
+                      f"{user.user_id}: {e}")
+        return user
+
+    def authenticate_token(self, auth_token: HanaToken) -> User:
+        """
+        Helper to get the user that an access token was issued to. Raises an
+        `AuthenticationError` if the token's refresh token is not associated
+        with any user.
+        @param auth_token: A valid authentication token
+        @returns: User object from the database that owns the token
+        """
+        try:
+            return self.database.authenticate_token(f"{auth_token.jti}.refresh")
+        except UserNotFoundError:
+            raise AuthenticationError(f"Invalid token: {auth_token.jti}")
+
+    @staticmethod
+    def _redact(user: User) -> User:
+        """
+        Remove sensitive authentication data from a `User` object in place.
+        """
+        user.password_hash = None
+        user.tokens = []
+        return user
 
     def read_unauthenticated_user(self, user_spec: str) -> User:
         """
@@ -95,7 +249,8 @@ class NeonUsersService:
         @param user_spec: username or user_id to retrieve
         @returns: Redacted User object with sensitive information removed
         """
-        return self._read_user(user_spec)
+        return self._coalesce("read_redacted_user",
+                              self.database.read_redacted_user, user_spec)
 
     def read_authenticated_user(self, username: str,
                                 password: Optional[str] = None,
@@ -108,17 +263,56 @@ class NeonUsersService:
         @param auth_token: A valid authentication token for the username
         @returns: User object from the database if authentication was successful
         """
-        # This will raise a `UserNotFound` exception if the user doesn't exist
-        if password:
-            user = self._read_user(username, password)
-        elif auth_token:
-            user = self._read_user(username, auth_token=auth_token)
-        else:
+        if not password and not auth_token:
             raise AuthenticationError("No password or token provided")
-        if user.password_hash is None:
+        with self.metrics.timer("stage_seconds", stage="auth"):
+            return self._read_authenticated_user(username, password,
+                                                 auth_token)
+
+    def _read_authenticated_user(self, username: str,
+                                 password: Optional[str],
+                                 auth_token: Optional[HanaToken]) -> User:
+        # A supplied password takes precedence over a token
+        auth_token = None if password else auth_token
+        if self.auth_cache:
+            key = self.auth_cache.get_key(
+                username, password, auth_token.jti if auth_token else None)
+            cached = self.auth_cache.get(key)
+            if cached:
+                _, user = cached
+                if user is None:
+                    raise AuthenticationError(f"Invalid password for "
+                                              f"{username}")
+                return user.model_copy(deep=True)
+            generation = self.auth_cache.generation
+        # This will raise a `UserNotFound` exception if the user doesn't exist
+        user = self._read_user(username, password, auth_token)
+        authenticated = user.password_hash is not None
+        if self.auth_cache:
+            self.auth_cache.put(key, user.user_id,
+                                user.model_copy(deep=True) if authenticated
+                                else None, generation)
+        if not authenticated:
             raise AuthenticationError(f"Invalid password for {username}")
         return user
 
+    def list_users(self, limit: int = 100, after: Optional[str] = None,
+                   filter: Optional[Dict[str, Any]] = None) -> \
+            Tuple[List[User], Optional[str]]:
+        """
+        Helper to get a page of users, ordered by `user_id`, with sensitive
+        data removed.
+        @param limit: Maximum number of users to return
+        @param after: Continuation token returned with a previous page
+        @param filter: Dotted field paths to values that users must match
+        @returns: List of redacted users and a continuation token for the next
+            page, or `None` if there are no more users
+        """
+        users = list(islice(self.database.iter_users(limit + 1, after, filter),
+                            limit + 1))
+        next_token = users[limit - 1].user_id if len(users) > limit else None
+        return [self._redact(user) for user in users[:limit]], next_token
+
     def update_user(self, user: User) -> User:
         """
         Helper to update a user. If the supplied user's password is not defined,
@@ -126,15 +320,36 @@ class NeonUsersService:
         @param user: The updated user object to update in the database
         @retruns: User object as it exists in the database, after updating
         """
-        # Create a copy to prevent modifying the input object
-        user = copy(user)
         if not user.password_hash:
             raise ValueError("Supplied user password is empty")
         if not isinstance(user.tokens, list):
             raise ValueError("Supplied tokens configuration is not a list")
-        user.password_hash = self._ensure_hashed(user.password_hash)
         # This will raise a `UserNotFound` exception if the user doesn't exist
-        return self.database.update_user(user)
+        user = self.database.update_user(self._with_hashed_password(user))
+        self._publish_invalidation(user)
+        return user
+
+    def patch_user(self, user_id: str, patch: Dict[str, Any]) -> User:
+        """
+        Helper to update only the specified fields of a user. A patched
+        `password_hash` is validated and hashed as in `update_user`.
+        @param user_id: The `user_id` of the user to update
+        @param patch: Dotted field paths to updated values
+        @returns: User object as it exists in the database, after updating
+        """
+        # Create a copy to prevent modifying the input object
+        patch = dict(patch)
+        if "password_hash" in patch:
+            if not patch["password_hash"]:
+                raise ValueError("Supplied user password is empty")
+            patch["password_hash"] = self._ensure_hashed(
+                patch["password_hash"])
+        if "tokens" in patch and not isinstance(patch["tokens"], list):
+            raise ValueError("Supplied tokens configuration is not a list")
+        # This will raise a `UserNotFound` exception if the user doesn't exist
+        user = self.database.patch_user(user_id, patch)
+        self._publish_invalidation(user)
+        return user
 
     def delete_user(self, user: User) -> User:
         """
@@ -146,10 +361,88 @@ class NeonUsersService:
         db_user = self.database.read_user_by_id(user.user_id)
         if db_user != user:
             raise UserNotMatchedError(user)
-        return self.database.delete_user(user.user_id)
+        user = self.database.delete_user(user.user_id)
+        self._publish_invalidation(user)
+        return user
+
+    def create_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        """
+        Helper to create multiple users, as in `create_user`.
+        @param users: The users to be created
+        @returns: The created user or raised exception for each input user
+        """
+        return self.database.create_users(self._ensure_hashed_many(users))
+
+    def read_unauthenticated_users(self, user_specs: List[str]) -> \
+            List[Union[User, Exception]]:
+        """
+        Helper to get multiple users with sensitive data removed, as in
+        `read_unauthenticated_user`.
+        @param user_specs: usernames or user_ids to retrieve
+        @returns: The redacted user or raised exception for each input spec
+        """
+        return [self._redact(user) if isinstance(user, User) else user
+                for user in self.database.read_users(user_specs)]
+
+    def update_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        """
+        Helper to update multiple users, as in `update_user`.
+        @param users: The updated user objects to update in the database
+        @returns: The updated user or raised exception for each input user
+        """
+        results = [None] * len(users)
+        to_update = []
+        for idx, user in enumerate(users):
+            if not user.password_hash:
+                results[idx] = ValueError("Supplied user password is empty")
+            elif not isinstance(user.tokens, list):
+                results[idx] = ValueError("Supplied tokens configuration is "
+                                          "not a list")
+            else:
+                to_update.append((idx, user))
+        updated = self.database.update_users(self._ensure_hashed_many(
+            [user for _, user in to_update]))
+        for (idx, _), user in zip(to_update, updated):
+            results[idx] = user
+            if isinstance(user, User):
+                self._publish_invalidation(user)
+        return results
+
+    def delete_users(self, users: List[User]) -> List[Union[User, Exception]]:
+        """
+        Helper to remove multiple users, as in `delete_user`. Each supplied
+        user must exactly match its database entry.
+        @param users: The user objects to remove from the database
+        @returns: The removed user or raised exception for each input user
+        """
+        results = [None] * len(users)
+        to_delete = []
+        db_users = self.database.read_users([user.user_id for user in users])
+        for idx, (user, db_user) in enumerate(zip(users, db_users)):
+            if isinstance(db_user, Exception):
+                results[idx] = db_user
+            elif db_user.user_id != user.user_id:
+                # Matched by username rather than `user_id`
+                results[idx] = UserNotFoundError(user.user_id)
+            elif db_user != user:
+                results[idx] = UserNotMatchedError(user)
+            else:
+                to_delete.append(idx)
+        deleted = self.database.delete_users([users[idx].user_id
+                                              for idx in to_delete])
+        for idx, user in zip(to_delete, deleted):
+            results[idx] = user
+            if isinstance(user, User):
+                self._publish_invalidation(user)
+        return results
 
     def shutdown(self):
         """
         Shutdown the service.
         """
+        if self.invalidation:
+            self.invalidation.shutdown()
+        if self.exporter:
+            self.exporter.shutdown()
+        self.hasher.shutdown()
         self.database.shutdown()
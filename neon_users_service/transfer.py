@@ -0,0 +1,85 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from itertools import islice
+from time import monotonic
+from typing import Iterator, TextIO, Tuple
+
+from ovos_utils.log import LOG
+
+from neon_users_service.databases import UserDatabase
+from neon_data_models.models.user import User
+
+
+def _log_progress(action: str, count: int, start_time: float):
+    elapsed = monotonic() - start_time
+    rate = count / elapsed if elapsed else 0.0
+    LOG.info(f"{action} {count} users in {elapsed:.2f}s ({rate:.1f} users/s)")
+
+
+def export_users(database: UserDatabase, stream: TextIO,
+                 batch_size: int = 1000) -> int:
+    """
+    Write every user in `database` to `stream` as JSON Lines.
+    @param database: `UserDatabase` to read users from
+    @param stream: Text stream to write serialized users to
+    @param batch_size: Number of users to read from the database at a time
+    @return: Number of users exported
+    """
+    start_time = monotonic()
+    count = 0
+    for user in database.iter_users(batch_size):
+        stream.write(user.model_dump_json())
+        stream.write("\n")
+        count += 1
+        if count % batch_size == 0:
+            _log_progress("Exported", count, start_time)
+    _log_progress("Exported", count, start_time)
+    return count
+
+
+def _read_users(stream: TextIO) -> Iterator[User]:
+    for line in stream:
+        if line.strip():
+            yield User.model_validate_json(line)
+
+
+def import_users(database: UserDatabase, stream: TextIO,
+                 batch_size: int = 1000) -> Tuple[int, int]:
+    """
+    Add users from a JSON Lines `stream` to `database`. Users are written in
+    batches of `batch_size`; users that already exist are skipped.
+    @param database: `UserDatabase` to write users to
+    @param stream: Text stream of serialized users, one per line
+    @param batch_size: Number of users to write to the database at a time
+    @return: Number of users imported and number of users that failed
+    """
+    start_time = monotonic()
+    imported = 0
+    failed = 0
+    users = _read_users(stream)
+    while True:
+        batch = list(islice(users, batch_size))
+        if not batch:
+            break
+        for user, result in zip(batch, database.create_users(batch)):
+            if isinstance(result, Exception):
+                LOG.debug(f"Failed to import {user.user_id}: {result!r}")
+                failed += 1
+            else:
+                imported += 1
+        _log_progress("Imported", imported, start_time)
+    _log_progress("Imported", imported, start_time)
+    return imported, failed
@@ -76,7 +76,8 @@ setup(
     install_requires=get_requirements("requirements.txt"),
     extras_require={"test": get_requirements("test_requirements.txt"),
                     "mq": get_requirements("mq.txt"),
-                    "mongodb": get_requirements("mongodb.txt")},
+                    "mongodb": get_requirements("mongodb.txt"),
+                    "msgpack": get_requirements("msgpack.txt")},
     zip_safe=True,
     classifiers=[
         'Intended Audience :: Developers',
@@ -0,0 +1,110 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+
+from unittest import TestCase
+
+from neon_users_service.hashing import PasswordHasher
+
+
+class TestPasswordHasher(TestCase):
+    password = "super secret password"
+    prehash = hashlib.sha256(password.encode()).hexdigest()
+    hashers = {"sha256": {},
+               "pbkdf2_sha256": {"iterations": 1000},
+               "scrypt": {"n": 2 ** 10, "r": 8, "p": 1}}
+
+    def test_hash_and_verify(self):
+        for scheme, params in self.hashers.items():
+            for workers in (0, 2):
+                hasher = PasswordHasher(scheme, workers=workers, **params)
+                password_hash = hasher.hash(self.password)
+                self.assertTrue(hasher.is_hashed(password_hash))
+                self.assertFalse(hasher.is_hashed(self.password))
+                self.assertFalse(hasher.needs_rehash(password_hash))
+                # Plaintext and SHA-256 digest are accepted
+                self.assertTrue(hasher.verify(self.password, password_hash))
+                self.assertTrue(hasher.verify(self.prehash, password_hash))
+                if scheme != "sha256":
+                    # The stored hash is not a password
+                    self.assertFalse(hasher.verify(password_hash,
+                                                   password_hash))
+                self.assertFalse(hasher.verify("bad password",
+                                               password_hash))
+                self.assertFalse(hasher.verify("", password_hash))
+                self.assertEqual(hasher.ensure_hashed(password_hash),
+                                 password_hash)
+                hasher.shutdown()
+
+    def test_salted_hashes(self):
+        hasher = PasswordHasher("pbkdf2_sha256", iterations=1000)
+        hashes = hasher.hash_many([self.password, self.password])
+        self.assertNotEqual(hashes[0], hashes[1])
+        self.assertTrue(all(hasher.verify(self.password, password_hash)
+                            for password_hash in hashes))
+
+    def test_legacy_hash(self):
+        self.assertEqual(PasswordHasher().hash(self.password), self.prehash)
+        hasher = PasswordHasher("scrypt", **self.hashers["scrypt"])
+        self.assertFalse(hasher.is_hashed(self.prehash))
+        self.assertTrue(hasher.needs_rehash(self.prehash))
+
+        # A legacy hash is upgraded after a successful verification
+        valid, new_hash = hasher.verify_and_update(self.password,
+                                                   self.prehash)
+        self.assertTrue(valid)
+        self.assertTrue(new_hash.startswith("scrypt$1024$8$1$"))
+        self.assertTrue(hasher.verify(self.password, new_hash))
+        self.assertTrue(hasher.verify_and_update(self.prehash,
+                                                 self.prehash)[0])
+        self.assertEqual(hasher.verify_and_update("bad password",
+                                                  self.prehash), (False, None))
+
+    def test_cost_change(self):
+        old_hasher = PasswordHasher("pbkdf2_sha256", iterations=1000)
+        new_hasher = PasswordHasher("pbkdf2_sha256", iterations=2000)
+        old_hash = old_hasher.hash(self.password)
+        self.assertTrue(new_hasher.needs_rehash(old_hash))
+        valid, new_hash = new_hasher.verify_and_update(self.password,
+                                                       old_hash)
+        self.assertTrue(valid)
+        self.assertFalse(new_hasher.needs_rehash(new_hash))
+
+        # The stored hash is rejected unless explicitly enabled, and then
+        # cannot be upgraded without the password
+        self.assertEqual(new_hasher.verify_and_update(old_hash, old_hash),
+                         (False, None))
+        legacy_hasher = PasswordHasher("pbkdf2_sha256", iterations=2000,
+                                       accept_stored_hash=True)
+        self.assertEqual(legacy_hasher.verify_and_update(old_hash, old_hash),
+                         (True, None))
+
+    def test_no_downgrade(self):
+        kdf_hash = PasswordHasher("pbkdf2_sha256",
+                                  iterations=1000).hash(self.password)
+        hasher = PasswordHasher()
+        self.assertFalse(hasher.needs_rehash(kdf_hash))
+        self.assertEqual(hasher.verify_and_update(self.password, kdf_hash),
+                         (True, None))
+
+    def test_invalid_config(self):
+        with self.assertRaises(ValueError):
+            PasswordHasher("md5")
+        hasher = PasswordHasher("pbkdf2_sha256", iterations=1000)
+        for invalid in ("pbkdf2_sha256$1000$salt", "scrypt$1$2$abc$def",
+                        "pbkdf2_sha256$x$c2FsdA==$a2V5"):
+            self.assertFalse(hasher.is_hashed(invalid))
+            self.assertFalse(hasher.verify(self.password, invalid))
@@ -0,0 +1,119 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from time import sleep
+from unittest import TestCase
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from neon_users_service.metrics import (Histogram, Metrics, NullMetrics,
+                                        LogExporter, PrometheusExporter,
+                                        init_exporter)
+
+
+class TestMetrics(TestCase):
+    def test_histogram(self):
+        histogram = Histogram((1.0, 2.0, 4.0))
+        self.assertEqual(histogram.quantile(0.5), 0.0)
+        for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 16.5)
+        self.assertEqual(histogram.quantile(0.2), 1.0)
+        self.assertEqual(histogram.quantile(0.5), 1.75)
+        # Values above the last bound are reported as the last bound
+        self.assertEqual(histogram.quantile(0.99), 4.0)
+
+    def test_metrics(self):
+        metrics = Metrics(buckets=(0.1, 1.0))
+        self.assertTrue(metrics)
+        with metrics.timer("request_seconds", operation="read"):
+            pass
+        metrics.observe("request_seconds", 0.5, operation="read")
+        metrics.observe("request_seconds", 0.5, operation="create")
+        metrics.increment("responses_total", code="200")
+        metrics.increment("responses_total", 2, code="200")
+        metrics.register_collector("cache", lambda: {"hits": 3})
+        metrics.register_collector("broken", lambda: 1 / 0)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"],
+                         {'responses_total{code="200"}': 3})
+        read = snapshot["histograms"]['request_seconds{operation="read"}']
+        self.assertEqual(read["count"], 2)
+        self.assertGreaterEqual(read["sum"], 0.5)
+        self.assertEqual(snapshot["gauges"], {"cache_hits": 3})
+
+        text = metrics.render_prometheus()
+        self.assertIn("# TYPE neon_users_responses_total counter\n"
+                      "neon_users_responses_total{code=\"200\"} 3\n", text)
+        self.assertEqual(text.count("# TYPE neon_users_request_seconds "
+                                    "histogram"), 1)
+        self.assertIn('neon_users_request_seconds_bucket{operation="read",'
+                      'le="1.0"} 2\n', text)
+        self.assertIn('neon_users_request_seconds_bucket{operation="read",'
+                      'le="+Inf"} 2\n', text)
+        self.assertIn('neon_users_request_seconds_count{operation="create"} '
+                      '1\n', text)
+        self.assertIn("neon_users_cache_hits 3\n", text)
+
+    def test_null_metrics(self):
+        metrics = NullMetrics()
+        self.assertFalse(metrics)
+        with metrics.timer("request_seconds", operation="read"):
+            pass
+        metrics.observe("request_seconds", 1.0)
+        metrics.increment("responses_total")
+        metrics.register_collector("cache", lambda: {"hits": 1})
+        self.assertEqual(metrics.snapshot(), {"counters": {},
+                                              "histograms": {},
+                                              "gauges": {}})
+
+    def test_prometheus_exporter(self):
+        metrics = Metrics()
+        metrics.increment("responses_total", code="200")
+        exporter = init_exporter(metrics, "prometheus", host="127.0.0.1",
+                                 port=0)
+        self.assertIsInstance(exporter, PrometheusExporter)
+        try:
+            with urlopen(f"http://127.0.0.1:{exporter.port}/metrics",
+                         timeout=5) as response:
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.read().decode(),
+                                 metrics.render_prometheus())
+            with self.assertRaises(HTTPError):
+                urlopen(f"http://127.0.0.1:{exporter.port}/other", timeout=5)
+        finally:
+            exporter.shutdown()
+
+    def test_log_exporter(self):
+        metrics = Metrics()
+        exporter = LogExporter(metrics, interval=60)
+        self.assertEqual(exporter.format_summary(), "")
+        metrics.observe("request_seconds", 0.002, operation="read")
+        metrics.increment("responses_total", operation="read", code="200")
+        sleep(0.01)
+        summary = exporter.format_summary()
+        self.assertIn('request_seconds{operation="read"} rate=', summary)
+        self.assertIn("p50=", summary)
+        self.assertIn('responses_total{code="200",operation="read"}=1',
+                      summary)
+        # Rates are reported for new observations only
+        self.assertNotIn("rate=", exporter.format_summary())
+
+        self.assertIsNone(init_exporter(metrics))
+        with self.assertRaises(ValueError):
+            init_exporter(metrics, "invalid")
@@ -0,0 +1,551 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+import zlib
+
+from os.path import join, dirname, isfile
+from queue import Queue, Empty
+from threading import Event
+from unittest import TestCase
+from unittest.mock import Mock, patch
+
+import pika
+import pika.exceptions
+
+from neon_mq_connector.utils.network_utils import dict_to_b64, b64_to_dict
+from neon_data_models.enum import AccessRoles
+from neon_data_models.models.user import User
+from neon_users_service.mq_connector import (NeonUsersConnector,
+                                             MQInvalidationChannel,
+                                             _BlockingConsumerThread)
+
+
+class FakeConnection:
+    """
+    Stand-in for a pika connection; callbacks scheduled from other threads
+    run when `process_callbacks` is called.
+    """
+    def __init__(self):
+        self.callbacks = Queue()
+        self.queues = dict()
+        self.is_open = True
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+    def process_callbacks(self, count: int, timeout: float = 5):
+        for _ in range(count):
+            self.callbacks.get(timeout=timeout)()
+
+
+class FakeChannel:
+    """
+    Stand-in for a pika channel that records published messages and acks.
+    Declared queues and their arguments are shared by channels on the same
+    connection.
+    """
+    def __init__(self, connection: FakeConnection = None):
+        self.connection = connection or FakeConnection()
+        self.is_open = True
+        self.declared = []
+        self.queue_arguments = self.connection.queues
+        self.published = []
+        self.acked = []
+        self.prefetch_count = None
+
+    def basic_qos(self, prefetch_count: int):
+        self.prefetch_count = prefetch_count
+
+    def queue_declare(self, queue: str, passive: bool = False,
+                      arguments: dict = None):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed")
+        if passive and queue not in self.queue_arguments:
+            self.is_open = False
+            raise pika.exceptions.ChannelClosedByBroker(404, "NOT_FOUND")
+        if not passive and queue in self.queue_arguments and \
+                self.queue_arguments[queue] != arguments:
+            self.is_open = False
+            raise pika.exceptions.ChannelClosedByBroker(
+                406, "PRECONDITION_FAILED")
+        self.declared.append(queue)
+        self.queue_arguments.setdefault(queue, arguments)
+
+    def exchange_declare(self, exchange: str, exchange_type, auto_delete):
+        self.declared.append(exchange)
+
+    def close(self):
+        self.is_open = False
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if properties.content_encoding == "zlib":
+            body = json.loads(zlib.decompress(body))
+        elif properties.content_type == "application/json":
+            body = json.loads(body)
+        else:
+            body = b64_to_dict(body)
+        self.published.append((routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class TestNeonUsersConnector(TestCase):
+    test_db_path = join(dirname(__file__), 'test_db.sqlite')
+    mq_config = {"server": "localhost",
+                 "users": {"neon_users_service": {"user": "test",
+                                                  "password": "test"}}}
+
+    def setUp(self):
+        if isfile(self.test_db_path):
+            os.remove(self.test_db_path)
+
+    def _get_connector(self, **kwargs) -> NeonUsersConnector:
+        service_config = {"module": "sqlite",
+                          "sqlite": {"db_path": self.test_db_path},
+                          **kwargs}
+        return NeonUsersConnector({"MQ": self.mq_config,
+                                   "neon_users_service": service_config})
+
+    @staticmethod
+    def _get_request(delivery_tag: int, **kwargs):
+        method = Mock()
+        method.delivery_tag = delivery_tag
+        return method, None, dict_to_b64(kwargs)
+
+    def test_handle_request(self):
+        connector = self._get_connector()
+        channel = FakeChannel()
+        user = User(username="test_user", password_hash="test")
+        method, properties, body = self._get_request(
+            1, operation="create", user=user.model_dump(),
+            message_id="create", routing_key="test_output")
+        connector.handle_request(channel, method, properties, body)
+        self.assertEqual(channel.acked, [1])
+        routing_key, response, _ = channel.published[0]
+        self.assertEqual(routing_key, "test_output")
+        self.assertTrue(response["success"])
+        self.assertEqual(response["message_id"], "create")
+        self.assertEqual(response["user"]["user_id"], user.user_id)
+
+        # Invalid request body is not acknowledged
+        connector.handle_request(channel, method, properties, "invalid")
+        self.assertEqual(len(channel.published), 1)
+        self.assertEqual(channel.acked, [1])
+        connector.service.shutdown()
+
+    def test_response_encoding(self):
+        connector = self._get_connector()
+        channel = FakeChannel()
+        connector.service.create_user(User(username="test_user",
+                                           password_hash="test"))
+        request = {"operation": "read", "user_spec": "test_user",
+                   "auth_user_spec": "test_user", "password": "test"}
+
+        # Base64 by default
+        connector.handle_request(channel, *self._get_request(1, **request))
+        _, response, properties = channel.published[-1]
+        self.assertIsNone(properties.content_type)
+        self.assertEqual(response["user"]["username"], "test_user")
+
+        # Encoding requested in the request body
+        for encoding, content_encoding in (("json", None), ("zlib", "zlib")):
+            connector.handle_request(channel, *self._get_request(
+                2, response_encoding=encoding, **request))
+            _, encoded, properties = channel.published[-1]
+            self.assertEqual(properties.content_type, "application/json")
+            self.assertEqual(properties.content_encoding, content_encoding)
+            self.assertEqual(encoded, response)
+
+        # JSON requests get JSON responses by default
+        method = Mock()
+        method.delivery_tag = 3
+        properties = pika.BasicProperties(content_type="application/json",
+                                          content_encoding="zlib")
+        connector.handle_request(channel, method, properties, zlib.compress(
+            json.dumps(request).encode()))
+        _, encoded, properties = channel.published[-1]
+        self.assertEqual(properties.content_encoding, "zlib")
+        self.assertEqual(encoded, response)
+        self.assertEqual(channel.acked, [1, 2, 2, 3])
+        connector.service.shutdown()
+
+    def test_response_properties(self):
+        connector = self._get_connector()
+        channel = FakeChannel()
+        connector.handle_request(channel, *self._get_request(
+            1, operation="read", user_spec="user", message_id="message",
+            routing_key="test_output"))
+        routing_key, _, properties = channel.published[-1]
+        self.assertEqual(routing_key, "test_output")
+        self.assertEqual(properties.expiration, "1000")
+        self.assertIsNone(properties.priority)
+        self.assertEqual(properties.correlation_id, "message")
+
+        # Standard reply properties take precedence over the request body
+        method, _, body = self._get_request(
+            2, operation="read", user_spec="user", message_id="message",
+            routing_key="test_output")
+        connector.handle_request(channel, method, pika.BasicProperties(
+            reply_to="amq.gen-reply", correlation_id="correlation"), body)
+        routing_key, response, properties = channel.published[-1]
+        self.assertEqual(routing_key, "amq.gen-reply")
+        self.assertEqual(properties.correlation_id, "correlation")
+        self.assertEqual(response["message_id"], "message")
+        # Client-owned reply queues are not declared
+        self.assertEqual(channel.declared, ["test_output"])
+        connector.service.shutdown()
+
+        connector = self._get_connector(responses={"expiration_ms": 30000,
+                                                   "priority": 5,
+                                                   "use_reply_to": False})
+        connector.handle_request(channel, method, pika.BasicProperties(
+            reply_to="amq.gen-reply"), body)
+        routing_key, _, properties = channel.published[-1]
+        self.assertEqual(routing_key, "test_output")
+        self.assertEqual(properties.expiration, "30000")
+        self.assertEqual(properties.priority, 5)
+        connector.service.shutdown()
+
+        connector = self._get_connector(responses={"expiration_ms": None})
+        connector.handle_request(channel, method, None, body)
+        self.assertIsNone(channel.published[-1][2].expiration)
+        connector.service.shutdown()
+
+    def test_expired_responses(self):
+        with patch.object(NeonUsersConnector,
+                          "register_subscriber") as register:
+            connector = self._get_connector(
+                metrics={}, responses={"dead_letter_exchange": "expired"})
+        self.assertEqual(register.call_args.kwargs["exchange"], "expired")
+        channel = FakeChannel()
+        connector.handle_request(channel, *self._get_request(
+            1, operation="read", user_spec="user", routing_key="test_output"))
+        self.assertEqual(channel.queue_arguments["test_output"],
+                         {"x-dead-letter-exchange": "expired"})
+
+        # Queues declared by clients are used without re-declaring them
+        channel.queue_arguments["client_queue"] = None
+        connector.handle_request(channel, *self._get_request(
+            2, operation="read", user_spec="user", routing_key="client_queue"))
+        self.assertTrue(channel.is_open)
+        self.assertEqual(channel.published[-1][0], "client_queue")
+        self.assertEqual(channel.acked[-1], 2)
+        self.assertIsNone(channel.queue_arguments["client_queue"])
+
+        connector.handle_expired_response(channel, Mock(), None, b"")
+        connector.handle_expired_response(channel, Mock(), None, b"")
+        self.assertEqual(connector.expired_responses, 2)
+        self.assertEqual(connector.metrics.snapshot()["counters"]
+                         ["responses_expired_total"], 2)
+        connector.service.shutdown()
+
+    def test_reply_queue_declare_cache(self):
+        connector = self._get_connector()
+        channel = FakeChannel()
+        for idx in range(3):
+            connector.handle_request(channel, *self._get_request(
+                idx, operation="read", user_spec="user",
+                routing_key="test_output"))
+        connector.handle_request(channel, *self._get_request(
+            3, operation="read", user_spec="user", routing_key="other"))
+        self.assertEqual(channel.declared, ["test_output", "other"])
+        self.assertEqual(len(channel.published), 4)
+        connector.service.shutdown()
+
+        connector = self._get_connector(
+            responses={"declare_cache_size": 0})
+        channel = FakeChannel()
+        for idx in range(2):
+            connector.handle_request(channel, *self._get_request(
+                idx, operation="read", user_spec="user",
+                routing_key="test_output"))
+        self.assertEqual(channel.declared, ["test_output", "test_output"])
+        connector.service.shutdown()
+
+    def test_log_response(self):
+        connector = self._get_connector(responses={"log_sample_rate": 0})
+        user = connector.service.create_user(User(username="test_user",
+                                                  password_hash="test"))
+        response = {"success": True, "user": user.model_dump(),
+                    "message_id": "test"}
+        with patch("neon_users_service.mq_connector.LOG") as log:
+            log.level = "INFO"
+            connector._log_response("test_output", response, 100)
+            log.info.assert_not_called()
+            log.debug.assert_not_called()
+
+            connector._log_sample_rate = 1.0
+            connector._log_response("test_output", response, 100)
+            message = log.info.call_args[0][0]
+            self.assertIn("message_id=test", message)
+            self.assertNotIn(user.password_hash, message)
+
+            # Debug logs identify the user without including user data
+            log.level = "DEBUG"
+            connector._log_response("test_output", response, 100)
+            message = log.debug.call_args[0][0] % log.debug.call_args[0][1:]
+            self.assertIn(user.user_id, message)
+            self.assertNotIn(user.password_hash, message)
+
+            # Nothing is logged if the level is higher
+            log.reset_mock()
+            log.level = "WARNING"
+            connector._log_response("test_output", response, 100)
+            log.info.assert_not_called()
+            log.debug.assert_not_called()
+        connector.service.shutdown()
+
+    def test_handle_request_metrics(self):
+        connector = self._get_connector(metrics={})
+        channel = FakeChannel()
+        user = User(username="test_user", password_hash="test")
+        connector.handle_request(channel, *self._get_request(
+            1, operation="create", user=user.model_dump()))
+        connector.handle_request(channel, *self._get_request(
+            2, operation="create", user=user.model_dump()))
+        connector.handle_request(channel, *self._get_request(
+            3, operation="read", user_spec="test_user"))
+        connector.handle_request(channel, *self._get_request(
+            4, operation="unknown"))
+        snapshot = connector.metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {
+            'responses_total{code="200",operation="create"}': 1,
+            'responses_total{code="409",operation="create"}': 1,
+            'responses_total{code="401",operation="read"}': 1,
+            'responses_total{code="500",operation="invalid"}': 1})
+        histograms = snapshot["histograms"]
+        self.assertEqual(histograms['request_seconds{operation="create"}']
+                         ["count"], 2)
+        # Each stage is recorded once per request that reaches it
+        self.assertEqual({name: histogram["count"]
+                          for name, histogram in histograms.items()
+                          if name.startswith("stage_seconds")}, {
+            'stage_seconds{stage="decode"}': 4,
+            'stage_seconds{stage="parse"}': 4,
+            'stage_seconds{stage="serialize"}': 1,
+            'stage_seconds{stage="encode"}': 3,
+            'stage_seconds{stage="publish"}': 3})
+        connector.service.shutdown()
+
+    def test_batch_request(self):
+        connector = self._get_connector()
+        admin = connector.service.create_user(User(username="admin",
+                                                   password_hash="admin"))
+        admin.permissions.users = AccessRoles.ADMIN
+        connector.service.update_user(admin)
+        user = User(username="test_user", password_hash="test")
+        response = connector.parse_mq_request({
+            "operation": "batch",
+            "requests": [
+                {"operation": "create", "user": user.model_dump()},
+                {"operation": "create", "user": user.model_dump()},
+                {"operation": "read", "user_spec": "test_user",
+                 "auth_user_spec": "admin", "password": "admin"},
+                {"operation": "read", "user_spec": "test_user",
+                 "password": "bad"},
+                {"operation": "invalid"},
+                {"operation": "update", "user": {**user.model_dump(),
+                                                 "username": "renamed"},
+                 "auth_username": "admin", "auth_password": "admin"},
+                {"operation": "delete", "user": admin.model_dump()}
+            ]})
+        self.assertTrue(response["success"])
+        codes = [r.get("code") for r in response["results"]]
+        self.assertEqual(codes, [None, 409, None, 401, 500, None, None])
+        results = response["results"]
+        self.assertEqual(results[0]["user"]["user_id"], user.user_id)
+        self.assertIsNone(results[2]["user"]["password_hash"])
+        self.assertEqual(results[5]["user"]["username"], "renamed")
+        connector.service.shutdown()
+
+    def test_list_request(self):
+        connector = self._get_connector()
+        admin = connector.service.create_user(User(username="admin",
+                                                   password_hash="admin"))
+        connector.service.create_users([User(username=f"user_{i}",
+                                             password_hash="test")
+                                        for i in range(3)])
+        request = {"operation": "list", "auth_user_spec": "admin",
+                   "password": "admin", "limit": 3}
+
+        # Listing requires admin permissions
+        response = connector.parse_mq_request(request)
+        self.assertFalse(response["success"])
+        admin.permissions.users = AccessRoles.ADMIN
+        connector.service.update_user(admin)
+
+        response = connector.parse_mq_request(request)
+        self.assertTrue(response["success"])
+        self.assertEqual(len(response["users"]), 3)
+        self.assertIsNotNone(response["next_token"])
+        response = connector.parse_mq_request(
+            {**request, "after": response["next_token"]})
+        self.assertEqual(len(response["users"]), 1)
+        self.assertIsNone(response["next_token"])
+        self.assertTrue(all(u["password_hash"] is None
+                            for u in response["users"]))
+        connector.service.shutdown()
+
+    def test_patch_request(self):
+        connector = self._get_connector()
+        user = connector.service.create_user(User(username="user",
+                                                  password_hash="test"))
+        other = connector.service.create_user(User(username="other",
+                                                   password_hash="test"))
+        request = {"operation": "patch", "user_id": user.user_id,
+                   "auth_username": "user", "auth_password": "test",
+                   "patch": {"neon.units.time": 24,
+                             "permissions.users": AccessRoles.ADMIN}}
+
+        # Users may patch themselves, but not their permissions
+        response = connector.parse_mq_request(request)
+        self.assertTrue(response["success"])
+        self.assertEqual(response["user"]["neon"]["units"]["time"], 24)
+        self.assertEqual(response["user"]["permissions"]["users"],
+                         user.permissions.users)
+
+        # Users may not patch other users
+        response = connector.parse_mq_request({**request,
+                                               "user_id": other.user_id})
+        self.assertFalse(response["success"])
+        self.assertEqual(connector.service.read_unauthenticated_user(
+            other.user_id).neon.units.time, other.neon.units.time)
+
+        # Invalid values are rejected
+        response = connector.parse_mq_request(
+            {**request, "patch": {"neon.units.time": 13}})
+        self.assertFalse(response["success"])
+        self.assertEqual(response["code"], 500)
+        connector.service.shutdown()
+
+    def test_handle_request_threaded(self):
+        connector = self._get_connector(concurrency={"workers": 2,
+                                                     "max_pending": 4})
+        channel = FakeChannel()
+        block = Event()
+        parse_request = connector.parse_mq_request
+
+        def _blocking_parse(request):
+            block.wait(5)
+            return parse_request(request)
+        connector.parse_mq_request = _blocking_parse
+
+        users = [User(username=f"user_{i}", password_hash="test")
+                 for i in range(4)]
+        for idx, user in enumerate(users):
+            connector.handle_request(channel, *self._get_request(
+                idx, operation="create", user=user.model_dump(),
+                message_id=str(idx)))
+
+        # Nothing is published from worker threads directly
+        self.assertEqual(channel.published, [])
+        block.set()
+        channel.connection.process_callbacks(len(users))
+        with self.assertRaises(Empty):
+            channel.connection.callbacks.get(timeout=0.1)
+        self.assertEqual(sorted(channel.acked), [0, 1, 2, 3])
+        self.assertTrue(all(resp["success"]
+                            for _, resp, _ in channel.published))
+        connector.stop()
+        connector.service.shutdown()
+
+    def test_consumer_prefetch(self):
+        # Inline request handling keeps the default prefetch count
+        connector = self._get_connector()
+        with patch.object(connector, "get_connection_params"):
+            connector.pre_run()
+        self.assertEqual(
+            connector.consumers["neon_users_consumer"].prefetch_count, 50)
+        connector.service.shutdown()
+
+        connector = self._get_connector(concurrency={"workers": 2})
+        with patch.object(connector, "get_connection_params"):
+            connector.pre_run()
+        consumer = connector.consumers["neon_users_consumer"]
+        self.assertEqual(consumer.prefetch_count, 2)
+
+        # QoS is set on the consumer channel before consuming starts
+        consumer.channel = Mock()
+        consumer.set_qos()
+        consumer.channel.basic_qos.assert_called_once_with(
+            prefetch_count=2, callback=consumer.start_consuming)
+        consumer.channel.basic_consume.assert_not_called()
+
+        blocking = _BlockingConsumerThread(
+            **connector.consumer_properties["neon_users_consumer"]
+            ["properties"])
+        with patch("pika.BlockingConnection") as connection:
+            blocking._create_connection()
+        channel = connection.return_value.channel.return_value
+        calls = [call[0] for call in channel.method_calls]
+        self.assertLess(calls.index("basic_qos"), calls.index("basic_consume"))
+        channel.basic_qos.assert_called_once_with(prefetch_count=2)
+
+        # Restarted consumers keep the configured prefetch count
+        with patch.object(connector, "run_consumers"):
+            connector.restart_consumer("neon_users_consumer")
+        self.assertIsNot(connector.consumers["neon_users_consumer"], consumer)
+        self.assertEqual(
+            connector.consumers["neon_users_consumer"].prefetch_count, 2)
+        connector.stop()
+        connector.service.shutdown()
+
+
+class TestMQInvalidationChannel(TestCase):
+    def test_publish(self):
+        failing = FakeConnection()
+        failing.channel = Mock(return_value=Mock(
+            is_open=True, basic_publish=Mock(side_effect=OSError("closed"))))
+        connection = FakeConnection()
+        channel = FakeChannel(connection)
+        connection.channel = Mock(return_value=channel)
+        connector = Mock(vhost="/neon_users")
+        connector.create_mq_connection.side_effect = [failing, connection]
+
+        invalidation = MQInvalidationChannel(connector, exchange="test")
+        connector.register_subscriber.assert_called_once()
+        # A failed publish is logged and the next one reconnects
+        invalidation.publish("user_1", "name_1")
+        invalidation.publish("user_2", "name_2")
+        invalidation.publish("user_3")
+        invalidation.shutdown()
+        self.assertFalse(failing.is_open)
+        self.assertFalse(connection.is_open)
+        self.assertEqual(connector.create_mq_connection.call_count, 2)
+        self.assertEqual(channel.declared, ["test"])
+        self.assertEqual([body for _, body, _ in channel.published], [
+            {"user_id": "user_2", "username": "name_2",
+             "origin": invalidation.origin},
+            {"user_id": "user_3", "username": None,
+             "origin": invalidation.origin}])
+
+    def test_publish_queue_full(self):
+        connector = Mock(vhost="/neon_users")
+        connector.create_mq_connection.side_effect = OSError("unavailable")
+        invalidation = MQInvalidationChannel(connector, max_pending=1)
+        # Publishing never raises, even when invalidations are dropped
+        for idx in range(10):
+            invalidation.publish(f"user_{idx}")
+        invalidation.shutdown()
+        self.assertFalse(invalidation._publisher.is_alive())
@@ -15,13 +15,21 @@
 
 import hashlib
 import os
+from threading import Event, Thread
+from time import sleep, time
 from unittest import TestCase
+from unittest.mock import patch
 from os.path import join, dirname, isfile
 
 from neon_users_service.databases import UserDatabase
+from neon_users_service.databases.cached import CachedUserDatabase
+from neon_users_service.databases.metered import MeteredUserDatabase
+from neon_users_service.invalidation import LocalInvalidationChannel
 from neon_users_service.databases.sqlite import SQLiteUserDatabase
 from neon_users_service.exceptions import ConfigurationError, AuthenticationError, UserNotFoundError, \
-    UserNotMatchedError
+    UserNotMatchedError, UserExistsError
+from neon_data_models.enum import AccessRoles
+from neon_data_models.models.api.jwt import HanaToken
 from neon_data_models.models.user import User
 from neon_users_service.service import NeonUsersService
 
@@ -48,6 +56,13 @@ class TestUsersService(TestCase):
         self.assertTrue(isfile(self.test_db_path))
         service.shutdown()
 
+        # Create with a cache in front of the database
+        service = NeonUsersService({**self.test_config,
+                                    "cache": {"max_size": 8, "ttl": 5}})
+        self.assertIsInstance(service.database, CachedUserDatabase)
+        self.assertIsInstance(service.database.database, SQLiteUserDatabase)
+        service.shutdown()
+
         # Create with invalid configuration
         with self.assertRaises(ConfigurationError):
             NeonUsersService({"module": None})
@@ -84,6 +99,70 @@ class TestUsersService(TestCase):
             service.read_authenticated_user("user_1", hashed_password)
         service.shutdown()
 
+    def test_password_rehash(self):
+        service = NeonUsersService(self.test_config)
+        user = service.create_user(User(username="user",
+                                        password_hash="test"))
+        self.assertEqual(user.password_hash, hashlib.sha256(b"test").hexdigest())
+        service.shutdown()
+
+        # Legacy hashes are upgraded on login with a configured KDF
+        service = NeonUsersService({**self.test_config, "password_hashing": {
+            "scheme": "pbkdf2_sha256", "iterations": 1000}})
+        auth_user = service.read_authenticated_user("user", "test")
+        self.assertTrue(auth_user.password_hash.startswith("pbkdf2_sha256$"))
+        self.assertEqual(service.read_authenticated_user(
+            "user", "test").password_hash, auth_user.password_hash)
+        with self.assertRaises(AuthenticationError):
+            service.read_authenticated_user("user", auth_user.password_hash)
+        with self.assertRaises(AuthenticationError):
+            service.read_authenticated_user("user", "bad password")
+
+        # Stored hashes are not re-hashed on update
+        self.assertEqual(service.update_user(auth_user).password_hash,
+                         auth_user.password_hash)
+        created = service.create_users([User(username="user_2",
+                                             password_hash="test")])
+        self.assertTrue(created[0].password_hash.startswith("pbkdf2_sha256$"))
+
+        # Upgraded hashes do not overwrite a password changed concurrently
+        stale = service.read_authenticated_user("user", "test")
+        changed = service.update_user(User(**{**stale.model_dump(),
+                                              "password_hash": "changed"}))
+        self.assertEqual(service._rehash(stale, "upgraded"), stale)
+        self.assertEqual(service.read_authenticated_user(
+            "user", "changed").password_hash, changed.password_hash)
+        service.shutdown()
+
+    def test_read_token_authenticated_user(self):
+        service = NeonUsersService(self.test_config)
+        token = HanaToken(exp=round(time()) + 60, iat=round(time()),
+                          jti="token_1", client_id="test", roles=[])
+        refresh = HanaToken(**{**token.model_dump(), "jti": "token_1.refresh",
+                               "purpose": "refresh"})
+        user = service.create_user(User(username="user", password_hash="test",
+                                        tokens=[refresh]))
+        service.create_user(User(username="other", password_hash="test"))
+        self.assertEqual(service.authenticate_token(token), user)
+        self.assertEqual(service.read_authenticated_user(
+            "user", auth_token=token), user)
+        self.assertEqual(service.read_authenticated_user(
+            user.user_id, auth_token=token), user)
+
+        # Tokens only authenticate the user they belong to
+        with self.assertRaises(AuthenticationError):
+            service.read_authenticated_user("other", auth_token=token)
+        with self.assertRaises(AuthenticationError):
+            service.authenticate_token(refresh)
+        with self.assertRaises(UserNotFoundError):
+            service.read_authenticated_user("not_a_user", auth_token=token)
+
+        # Revoked tokens no longer authenticate
+        service.patch_user(user.user_id, {"tokens": []})
+        with self.assertRaises(AuthenticationError):
+            service.read_authenticated_user("user", auth_token=token)
+        service.shutdown()
+
     def test_read_unauthenticated_user(self):
         service = NeonUsersService(self.test_config)
         user_1 = service.create_user(User(username="user",
@@ -137,6 +216,28 @@ class TestUsersService(TestCase):
 
         service.shutdown()
 
+    def test_patch_user(self):
+        service = NeonUsersService(self.test_config)
+        user = service.create_user(User(username="user",
+                                        password_hash="test"))
+        patched = service.patch_user(user.user_id,
+                                     {"password_hash": "new password",
+                                      "neon.language.input_languages":
+                                          ["en-us", "uk-ua"]})
+        self.assertEqual(patched.password_hash,
+                         hashlib.sha256(b"new password").hexdigest())
+        self.assertEqual(patched.neon.language.input_languages,
+                         ["en-us", "uk-ua"])
+        self.assertEqual(patched.username, user.username)
+
+        with self.assertRaises(ValueError):
+            service.patch_user(user.user_id, {"password_hash": ""})
+        with self.assertRaises(ValueError):
+            service.patch_user(user.user_id, {"tokens": None})
+        with self.assertRaises(UserNotFoundError):
+            service.patch_user("not_a_user", {"username": "test"})
+        service.shutdown()
+
     def test_delete_user(self):
         service = NeonUsersService(self.test_config)
         user_1 = service.create_user(User(username="user",
@@ -161,3 +262,246 @@ class TestUsersService(TestCase):
             service.read_unauthenticated_user(user_1.user_id)
 
         service.shutdown()
+
+    def test_batch_operations(self):
+        service = NeonUsersService(self.test_config)
+        created = service.create_users([User(username="user_1",
+                                             password_hash="test"),
+                                        User(username="user_2",
+                                             password_hash="test"),
+                                        User(username="user_1",
+                                             password_hash="test")])
+        user_1, user_2 = created[:2]
+        self.assertEqual(user_1.password_hash,
+                         hashlib.sha256(b"test").hexdigest())
+        self.assertIsInstance(created[2], UserExistsError)
+
+        read = service.read_unauthenticated_users(["user_1", "user_3"])
+        self.assertIsNone(read[0].password_hash)
+        self.assertEqual(read[0].user_id, user_1.user_id)
+        self.assertIsInstance(read[1], UserNotFoundError)
+
+        user_1.username = "renamed_user"
+        user_2.password_hash = None
+        updated = service.update_users([user_1, user_2])
+        self.assertEqual(updated[0], user_1)
+        self.assertIsInstance(updated[1], ValueError)
+
+        deleted = service.delete_users([read[0], user_1])
+        self.assertIsInstance(deleted[0], UserNotMatchedError)
+        self.assertEqual(deleted[1], user_1)
+        service.shutdown()
+
+    def test_list_users(self):
+        service = NeonUsersService(self.test_config)
+        users = service.create_users([User(username=f"user_{i}",
+                                           password_hash="test")
+                                      for i in range(5)])
+        users.sort(key=lambda u: u.user_id)
+
+        page, token = service.list_users(limit=2)
+        self.assertEqual([u.user_id for u in page],
+                         [u.user_id for u in users[:2]])
+        self.assertIsNone(page[0].password_hash)
+        page, token = service.list_users(limit=2, after=token)
+        self.assertEqual([u.user_id for u in page],
+                         [u.user_id for u in users[2:4]])
+        page, token = service.list_users(limit=2, after=token)
+        self.assertEqual([u.user_id for u in page], [users[4].user_id])
+        self.assertIsNone(token)
+
+        page, token = service.list_users(filter={"username": "user_3"})
+        self.assertEqual([u.username for u in page], ["user_3"])
+        self.assertIsNone(token)
+        service.shutdown()
+
+    def test_metrics(self):
+        service = NeonUsersService(self.test_config)
+        self.assertFalse(service.metrics)
+        self.assertIsInstance(service.database, SQLiteUserDatabase)
+        service.shutdown()
+
+        service = NeonUsersService({**self.test_config, "metrics": {},
+                                    "cache": {"max_size": 8, "ttl": 60}})
+        self.assertIsNone(service.exporter)
+        self.assertIsInstance(service.database.database, MeteredUserDatabase)
+        user = service.create_user(User(username="user",
+                                        password_hash="test"))
+        service.read_authenticated_user("user", "test")
+        service.read_authenticated_user("user", "test")
+        with self.assertRaises(UserNotFoundError):
+            service.read_unauthenticated_user("other")
+        snapshot = service.metrics.snapshot()
+        histograms = snapshot["histograms"]
+        self.assertEqual(histograms['db_seconds{backend="SQLiteUserDatabase",'
+                                    'method="create_user"}']["count"], 1)
+        # The second read is served from the cache
+        self.assertEqual(histograms['db_seconds{backend="SQLiteUserDatabase",'
+                                    'method="read_user"}']["count"], 2)
+        self.assertEqual(histograms['stage_seconds{stage="auth"}']["count"],
+                         2)
+        self.assertEqual(snapshot["gauges"]["cache_hits"], 1)
+        self.assertEqual(user, service.read_authenticated_user("user",
+                                                               "test"))
+        service.shutdown()
+
+    def test_coalesce_reads(self):
+        service = NeonUsersService({**self.test_config,
+                                    "coalesce_reads": True})
+        user = service.create_user(User(username="user",
+                                        password_hash="test"))
+        started = Event()
+        release = Event()
+        read_redacted_user = service.database.read_redacted_user
+
+        def _blocking_read(user_spec):
+            started.set()
+            release.wait(5)
+            return read_redacted_user(user_spec)
+
+        results = []
+        errors = []
+
+        def _read(spec):
+            try:
+                results.append(service.read_unauthenticated_user(spec))
+            except Exception as e:
+                errors.append(e)
+
+        with patch.object(service.database, "read_redacted_user",
+                          side_effect=_blocking_read) as read:
+            threads = [Thread(target=_read, args=("user",))
+                       for _ in range(4)]
+            threads[0].start()
+            self.assertTrue(started.wait(5))
+            for thread in threads[1:]:
+                thread.start()
+            while service.single_flight.stats["shared"] < 3:
+                sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(read.call_count, 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 4)
+        self.assertEqual(len({id(result) for result in results}), 4)
+        redacted = service.read_unauthenticated_user("user")
+        for result in results:
+            self.assertEqual(result, redacted)
+        # Each caller has an independent copy
+        results[0].neon.user.first_name = "Modified"
+        self.assertEqual(results[1], redacted)
+
+        # Errors are raised to every caller
+        started.clear()
+        release.clear()
+        results.clear()
+        with patch.object(service.database, "read_redacted_user",
+                          side_effect=_blocking_read) as read:
+            threads = [Thread(target=_read, args=("missing",))
+                       for _ in range(3)]
+            threads[0].start()
+            self.assertTrue(started.wait(5))
+            for thread in threads[1:]:
+                thread.start()
+            while service.single_flight.stats["shared"] < 5:
+                sleep(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(read.call_count, 1)
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all(isinstance(e, UserNotFoundError)
+                            for e in errors))
+
+        # Sequential reads are not shared
+        self.assertEqual(service.read_authenticated_user("user", "test"),
+                         user)
+        self.assertEqual(service.read_authenticated_user("user", "test"),
+                         user)
+        self.assertEqual(service.single_flight.stats["in_flight"], 0)
+        service.shutdown()
+
+    def test_auth_cache(self):
+        service = NeonUsersService({**self.test_config,
+                                    "auth_cache": {"max_size": 8, "ttl": 60}})
+        user = service.create_user(User(username="user",
+                                        password_hash="test"))
+        with patch.object(service.database, "read_user",
+                          wraps=service.database.read_user) as read_user:
+            # Repeated positive and negative results are cached
+            for _ in range(3):
+                self.assertEqual(service.read_authenticated_user("user",
+                                                                 "test"),
+                                 user)
+                with self.assertRaises(AuthenticationError):
+                    service.read_authenticated_user("user", "bad password")
+            self.assertEqual(read_user.call_count, 2)
+            self.assertEqual(service.auth_cache.stats["hits"], 4)
+            self.assertEqual(service.auth_cache.stats["misses"], 2)
+
+            # Cached users may be modified without affecting the cache
+            auth_user = service.read_authenticated_user("user", "test")
+            auth_user.permissions.users = AccessRoles.OWNER
+            self.assertEqual(service.read_authenticated_user("user", "test"),
+                             user)
+
+            # A password change invalidates the cached results
+            user.password_hash = "new password"
+            service.update_user(user)
+            with self.assertRaises(AuthenticationError):
+                service.read_authenticated_user("user", "test")
+            self.assertEqual(service.read_authenticated_user(
+                "user", "new password").password_hash,
+                hashlib.sha256(b"new password").hexdigest())
+            read_count = read_user.call_count
+
+            # Any modification to the user invalidates the cached results
+            service.patch_user(user.user_id,
+                               {"permissions.users": AccessRoles.ADMIN})
+            self.assertEqual(service.read_authenticated_user(
+                "user", "new password").permissions.users, AccessRoles.ADMIN)
+            self.assertEqual(read_user.call_count, read_count + 1)
+        service.shutdown()
+
+    def test_cache_invalidation(self):
+        config = {**self.test_config, "cache": {"max_size": 8, "ttl": 60},
+                  "auth_cache": {"max_size": 8, "ttl": 60}}
+        service_1 = NeonUsersService(config, LocalInvalidationChannel("test"))
+        service_2 = NeonUsersService(config, LocalInvalidationChannel("test"))
+        user_1 = service_1.create_user(User(username="user_1",
+                                            password_hash="test"))
+        user_2 = service_1.create_user(User(username="user_2",
+                                            password_hash="test"))
+
+        # Populate both caches
+        for service in (service_1, service_2):
+            for user in (user_1, user_2):
+                service.read_unauthenticated_user(user.username)
+        self.assertEqual(service_2.cache.stats["size"], 2)
+
+        # Rename on one service is seen by the other; other users stay cached
+        user_1.username = "renamed_user"
+        service_1.update_user(user_1)
+        self.assertEqual(service_2.cache.stats["size"], 1)
+        with self.assertRaises(UserNotFoundError):
+            service_2.read_unauthenticated_user("user_1")
+        self.assertEqual(
+            service_2.read_unauthenticated_user("renamed_user").username,
+            "renamed_user")
+
+        # Deletion on one service is seen by the other
+        service_2.delete_user(service_2.read_authenticated_user("user_2",
+                                                                "test"))
+        with self.assertRaises(UserNotFoundError):
+            service_1.read_unauthenticated_user(user_2.user_id)
+
+        # Password changes on one service are seen by the other
+        service_2.read_authenticated_user("renamed_user", "test")
+        user_1.password_hash = "new password"
+        service_1.update_user(user_1)
+        with self.assertRaises(AuthenticationError):
+            service_2.read_authenticated_user("renamed_user", "test")
+
+        service_1.shutdown()
+        service_2.shutdown()
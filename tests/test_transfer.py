@@ -0,0 +1,60 @@
+# Copyright (C) 2024 Neongecko.com Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from io import StringIO
+from os import remove
+from os.path import join, dirname, isfile
+from unittest import TestCase
+
+from neon_users_service.databases.sqlite import SQLiteUserDatabase
+from neon_users_service.transfer import export_users, import_users
+from neon_data_models.models.user import User
+
+
+class TestTransfer(TestCase):
+    source_db_file = join(dirname(__file__), 'test_source_db.sqlite')
+    dest_db_file = join(dirname(__file__), 'test_dest_db.sqlite')
+
+    def setUp(self):
+        for db_file in (self.source_db_file, self.dest_db_file):
+            if isfile(db_file):
+                remove(db_file)
+        self.source = SQLiteUserDatabase(self.source_db_file)
+        self.dest = SQLiteUserDatabase(self.dest_db_file)
+
+    def tearDown(self):
+        self.source.shutdown()
+        self.dest.shutdown()
+        for db_file in (self.source_db_file, self.dest_db_file):
+            remove(db_file)
+
+    def test_export_import(self):
+        users = self.source.create_users([User(username=f"user_{i}",
+                                               password_hash="test")
+                                          for i in range(25)])
+        stream = StringIO()
+        self.assertEqual(export_users(self.source, stream, batch_size=10), 25)
+        self.assertEqual(len(stream.getvalue().splitlines()), 25)
+
+        stream.seek(0)
+        self.assertEqual(import_users(self.dest, stream, batch_size=10),
+                         (25, 0))
+        for user in users:
+            self.assertEqual(self.dest.read_user_by_id(user.user_id), user)
+
+        # Existing users are skipped
+        stream.seek(0)
+        self.assertEqual(import_users(self.dest, stream, batch_size=10),
+                         (0, 25))